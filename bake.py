@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import json
+import os.path as osp
+import time
+import numpy as np
+import open3d as o3d
+import torch
+from src.baked import BakedUDF
+from src.evaluate import evaluate
+from src.inverses import inverse
+from src.model import SIREN
+from src.util import load_experiment_parameters, normalize
+
+
+def sample( model, points, device, max_batch=2**16 ):
+    """Output and gradient of `model` at `points`, as Nx4."""
+    gradients = np.zeros((len(points), 3))
+    values = evaluate( model, points, max_batch=max_batch, device=device, gradients=gradients )
+    return np.concatenate([values, gradients], axis=-1)
+
+
+def grid_vertices( indices, resolution ):
+    """Coordinates in [-1, 1]^3 of integer vertices of a grid with
+    `resolution` cells per side.
+    """
+    return indices.astype(np.float32) * (2 / resolution) - 1
+
+
+def bake( model, resolution, block_size, band, gt_mode, alpha, device, dtype=np.float16, blocks_per_batch=256 ):
+    """
+    Samples `model` on a coarse grid and, where the surface may be closer
+    than `band`, on blocks of the fine grid. A coarse cell gets a block if
+    the distance at one of its corners is below `band` plus its diagonal;
+    since distances are 1-Lipschitz, no point further than `band` from
+    every block is missed. Returns the arrays of a BakedUDF.
+    """
+    if resolution % block_size != 0:
+        raise ValueError(f'The resolution ({resolution}) must be a multiple of the block size ({block_size}).')
+    coarse_resolution = resolution // block_size
+
+    side = np.arange(coarse_resolution + 1)
+    vertices = np.stack(np.meshgrid(side, side, side, indexing='ij'), axis=-1).reshape(-1, 3)
+    coarse = sample( model, grid_vertices( vertices, coarse_resolution ), device )
+
+    distances = inverse( gt_mode, np.abs(coarse[:, 0]), alpha ).reshape((coarse_resolution + 1,) * 3)
+    corner_distances = np.min([
+        distances[i:i + coarse_resolution, j:j + coarse_resolution, k:k + coarse_resolution]
+        for i in range(2) for j in range(2) for k in range(2)
+    ], axis=0)
+    allocated = corner_distances < band + 2 * np.sqrt(3) / coarse_resolution
+
+    block_index = np.full(allocated.shape, -1, dtype=np.int32)
+    block_index[allocated] = np.arange(np.sum(allocated))
+    origins = np.argwhere(allocated) * block_size
+
+    side = np.arange(block_size + 1)
+    local = np.stack(np.meshgrid(side, side, side, indexing='ij'), axis=-1).reshape(-1, 3)
+    blocks = np.zeros((len(origins), len(local), 4), dtype=dtype)
+    for start in range(0, len(origins), blocks_per_batch):
+        batch = origins[start:start + blocks_per_batch]
+        vertices = (batch[:, None, :] + local[None, :, :]).reshape(-1, 3)
+        blocks[start:start + len(batch)] = sample( model, grid_vertices( vertices, resolution ), device ).reshape(len(batch), len(local), 4)
+
+    return (
+        coarse.reshape((coarse_resolution + 1,) * 3 + (4,)).astype(dtype),
+        block_index,
+        blocks.reshape((len(origins),) + (block_size + 1,) * 3 + (4,))
+    )
+
+
+def error_report( model, baked, surface_points, parameter_dict, sigmas, samples, device ):
+    """
+    Distance and gradient direction errors of `baked` against `model` at
+    points of the input point cloud displaced by gaussian noise of every
+    standard deviation in `sigmas`, and at uniform points of the domain,
+    along with the throughput of both.
+    """
+    generator = np.random.default_rng(123)
+    bands = [ (f'sigma_{sigma}', surface_points[generator.integers(0, len(surface_points), samples)] + generator.normal(0, sigma, (samples, 3)))
+              for sigma in sigmas ]
+    bands.append(( 'uniform', generator.uniform(-1, 1, (samples, 3)) ))
+
+    report = {}
+    for name, points in bands:
+        points = np.clip(points, -1, 1).astype(np.float32)
+        results = []
+        for m in [model, baked]:
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start_time = time.perf_counter()
+            values = sample( m, points, device )
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            results.append(( values, time.perf_counter() - start_time ))
+        (reference, model_seconds), (approximation, baked_seconds) = results
+
+        distance_error = np.abs(
+            inverse( parameter_dict["gt_mode"], np.abs(approximation[:, :1]), parameter_dict["alpha"] ) -
+            inverse( parameter_dict["gt_mode"], np.abs(reference[:, :1]), parameter_dict["alpha"] )
+        )
+        cosines = np.sum(normalize(approximation[:, 1:]) * normalize(reference[:, 1:]), axis=-1)
+        angle_error = np.degrees(np.arccos(np.clip(cosines, -1, 1)))
+
+        report[name] = {
+            'mean_distance_error': float(np.mean(distance_error)),
+            'p99_distance_error': float(np.percentile(distance_error, 99)),
+            'max_distance_error': float(np.max(distance_error)),
+            'mean_gradient_angle_error': float(np.mean(angle_error)),
+            'p99_gradient_angle_error': float(np.percentile(angle_error, 99)),
+            'model_points_per_second': samples / model_seconds,
+            'baked_points_per_second': samples / baked_seconds,
+            'speedup': model_seconds / baked_seconds
+        }
+        print(f"{name}: max distance error {report[name]['max_distance_error']:.3e}, "
+              f"mean angle error {report[name]['mean_gradient_angle_error']:.2f} degrees, speedup {report[name]['speedup']:.1f}")
+
+    return report
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description='Bake a trained SIREN into a sparse block grid of outputs and gradients that can replace it in the generators'
+    )
+    p.add_argument('experiment_path', type=str, help='train config of the network (e.g. params.json of the experiment)')
+    p.add_argument('model_path', type=str, help='trained weights')
+    p.add_argument('-o', '--output', type=str, default=None, help='path of the baked volume (.npz), next to the trained weights by default')
+    p.add_argument('-r', '--resolution', type=int, default=256, help='cells per side of the fine grid')
+    p.add_argument('-b', '--block_size', type=int, default=8, help='cells per side of a block')
+    p.add_argument('--band', type=float, default=0.05, help='distance to the surface covered by the fine grid')
+    p.add_argument('--float32', action='store_true', help='store values in float32 instead of float16')
+    p.add_argument('-s', '--sigmas', type=float, nargs='+', default=[0, 0.001, 0.01, 0.05], help='noise around the surface of every error band')
+    p.add_argument('-n', '--samples', type=int, default=100000, help='points per error band')
+    p.add_argument('-d', '--device', type=int, default=0, help='cuda device')
+    args = p.parse_args()
+
+    parameter_dict = load_experiment_parameters(args.experiment_path)
+    if not bool(parameter_dict):
+        raise ValueError("JSON experiment not found")
+    network_params = parameter_dict["network"]
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+
+    model = SIREN(
+        n_in_features= 3,
+        n_out_features=1,
+        hidden_layer_config=network_params["hidden_layer_nodes"],
+        w0=network_params["w0"],
+        ww=network_params.get("ww", None),
+        delay_init=True,
+        activation=network_params.get('activation', 'sine'),
+        fused_sine=network_params.get('fused_sine', False),
+        encoding=network_params.get('encoding', None)
+    )
+    model.load_state_dict( torch.load(args.model_path, map_location=device) )
+    model.to(device)
+    model.eval()
+
+    start_time = time.time()
+    coarse, block_index, blocks = bake(
+        model, args.resolution, args.block_size, args.band, parameter_dict["gt_mode"], parameter_dict["alpha"], device,
+        dtype=np.float32 if args.float32 else np.float16
+    )
+    bake_time = time.time() - start_time
+    print(f'Baked {len(blocks)} of {block_index.size} blocks in {bake_time:.1f} s')
+
+    baked = BakedUDF(
+        args.resolution, args.block_size, torch.from_numpy(coarse), torch.from_numpy(block_index).long(), torch.from_numpy(blocks)
+    ).to(device)
+    surface_points = np.asarray(o3d.io.read_point_cloud(parameter_dict["dataset"] + '_pc.ply').points)
+    report = error_report( model, baked, surface_points, parameter_dict, args.sigmas, args.samples, device )
+
+    output_path = args.output or osp.splitext(args.model_path)[0] + '_baked.npz'
+    np.savez_compressed(
+        output_path,
+        resolution=args.resolution,
+        block_size=args.block_size,
+        coarse=coarse,
+        block_index=block_index,
+        blocks=blocks,
+        gt_mode=parameter_dict["gt_mode"],
+        alpha=parameter_dict["alpha"],
+        band=args.band,
+        max_distance_error=max( r['max_distance_error'] for r in report.values() )
+    )
+    print(f'Saved to {output_path}')
+
+    with open(osp.splitext(output_path)[0] + '.json', 'w+') as fout:
+        json.dump({
+            'model_path': args.model_path,
+            'baked_path': output_path,
+            'resolution': args.resolution,
+            'block_size': args.block_size,
+            'band': args.band,
+            'blocks': len(blocks),
+            'bake_time': bake_time,
+            'float_size_mb': osp.getsize(args.model_path) / 2 ** 20,
+            'baked_size_mb': osp.getsize(output_path) / 2 ** 20,
+            'errors': report
+        }, fout, indent=4)
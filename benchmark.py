@@ -0,0 +1,999 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import json
+import os
+import os.path as osp
+import resource
+import time
+import numpy as np
+import open3d as o3d
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from scipy.spatial import cKDTree
+from src.dataset import PointCloud, KDTreeDistance, o3c_to_torch, torch_to_o3c
+from src.eigensolver import eigh3
+from src.evaluate import evaluate
+from src.distributed import init_distributed, broadcast_parameters, average_gradients
+from src.loss_functions import loss_s1, loss_s2, loss_siren, lazy_weights, s1_residuals, S1_TERMS
+from src.model import SIREN
+from src.timing import timer
+from src.util import load_experiment_parameters, unsigned_sampling
+from train import make_lbfgs
+
+
+def peak_memory_mb( device ):
+    """Peak memory of the benchmark so far, in MB. For CPU runs this is the
+    resident set size of the whole process.
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def build_model( network_params ):
+    return SIREN(
+        n_in_features= 3,
+        n_out_features=1,
+        hidden_layer_config=network_params["hidden_layer_nodes"],
+        w0=network_params["w0"],
+        ww=network_params.get("ww", None),
+        activation= network_params.get('activation', 'sine'),
+        checkpoint_activations=network_params.get('checkpoint_activations', False),
+        fused_sine=network_params.get('fused_sine', False),
+        encoding=network_params.get('encoding', None)
+    )
+
+
+def write_report( report, output_path ):
+    text = json.dumps(report, indent=4)
+    if output_path is None:
+        print(text)
+    else:
+        with open(output_path, 'w+') as fout:
+            fout.write(text)
+        print(f'Saved to {output_path}')
+
+
+def _isolated_target( queue, fn, args ):
+    queue.put( fn(*args) )
+
+
+def run_isolated( fn, *args ):
+    """Runs fn(*args) in a freshly spawned process and returns its result, so
+    that peak memory is measured for that call alone.
+    """
+    context = mp.get_context('spawn')
+    queue = context.SimpleQueue()
+    process = context.Process(target=_isolated_target, args=(queue, fn, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _loss_worker( parameter_dict, batch_size, surface_subset, steps, warmup_steps, device ):
+    torch.manual_seed(123)
+    np.random.seed(123)
+    device = torch.device(device)
+
+    dataset = PointCloud(
+        meshPath= parameter_dict["dataset"],
+        batchSize= batch_size,
+        samplingPercentiles=parameter_dict["sampling_percentiles"],
+        batchesPerEpoch = 1,
+        unsignedDistances = unsigned_sampling( parameter_dict )
+    )
+    batches = [ next(iter(dataset)) for _ in range(warmup_steps + steps) ]
+    model = build_model( parameter_dict["network"] ).to(device)
+    optim = torch.optim.Adam(lr=parameter_dict["optimizer"]["lr_s1"], params=model.parameters())
+
+    for step, (input_data, normals, sdf, _) in enumerate(batches):
+        if step == warmup_steps:
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start_time = time.time()
+
+        optim.zero_grad()
+        loss = loss_s1(
+            model,
+            input_data.to(device),
+            {'normals': normals.to(device), 'sdf': sdf.to(device)},
+            parameter_dict["loss_s1_weights"],
+            parameter_dict["alpha"],
+            surface_subset=surface_subset
+        )
+        train_loss = torch.zeros((1, 1), device=device)
+        for l in loss.values():
+            train_loss += l
+        train_loss.backward()
+        optim.step()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.time() - start_time) / steps, peak_memory_mb(device), train_loss.item()
+
+
+def benchmark_loss( args ):
+    """Stage 1 training step with second order terms evaluated on the whole
+    batch or only on its on surface samples, for several batch sizes. Every
+    measurement runs in its own process.
+    """
+    parameter_dict = load_experiment_parameters(args.config)
+
+    results = []
+    for batch_size in args.batch_sizes:
+        for surface_subset in [False, True]:
+            seconds_per_step, peak_memory, last_loss = run_isolated(
+                _loss_worker, parameter_dict, batch_size, surface_subset, args.steps, args.warmup_steps, args.device
+            )
+            results.append({
+                'batch_size': batch_size,
+                'surface_subset': surface_subset,
+                'seconds_per_step': seconds_per_step,
+                'peak_memory_mb': peak_memory,
+                'loss': last_loss
+            })
+            print(f'Batch size {batch_size}, surface subset {surface_subset}: {seconds_per_step:.3f} s per step, {peak_memory:.0f} MB')
+
+    write_report({
+        'benchmark': 'loss',
+        'dataset': parameter_dict["dataset"],
+        'device': args.device,
+        'hidden_layer_nodes': parameter_dict["network"]["hidden_layer_nodes"],
+        'results': results
+    }, args.output)
+
+
+def _train_worker( parameter_dict, stage, batch_size, hidden_layer_nodes, checkpoint_activations, fused_sine, loss_weights, steps, warmup_steps, device ):
+    torch.manual_seed(123)
+    np.random.seed(123)
+    device = torch.device(device)
+
+    dataset = PointCloud(
+        meshPath= parameter_dict["dataset"],
+        batchSize= batch_size,
+        samplingPercentiles=parameter_dict["sampling_percentiles"],
+        batchesPerEpoch = 1,
+        unsignedDistances = unsigned_sampling( parameter_dict )
+    )
+    if stage == 's2' and parameter_dict.get('s2_surface_only', True):
+        dataset.sample_surface_only( parameter_dict.get('s2_batch_size') or dataset.samplesOnSurface )
+    network_params = dict(
+        parameter_dict["network"], hidden_layer_nodes=hidden_layer_nodes, checkpoint_activations=checkpoint_activations, fused_sine=fused_sine
+    )
+    model = build_model( network_params ).to(device)
+    optim = torch.optim.Adam(lr=1e-6, params=model.parameters())
+
+    if stage == 'siren':
+        loss_fn = lambda *args: loss_siren(*args[:-1])
+    else:
+        loss_fn = loss_s1 if stage == 's1' else loss_s2
+
+    timer.device = device
+    for step in range(warmup_steps + steps):
+        if step == warmup_steps:
+            timer.reset()
+            timer.enabled = True
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start_time = time.perf_counter()
+
+        with timer.section('sampling'):
+            input_data, normals, sdf, weights = next(iter(dataset))
+            input_data, normals, sdf, weights = input_data.to(device), normals.to(device), sdf.to(device), weights.to(device)
+
+        loss = loss_fn(
+            model,
+            input_data,
+            {'normals': normals, 'sdf': sdf, 'weights': weights},
+            loss_weights,
+            parameter_dict.get("alpha", 1)
+        )
+
+        with timer.section('backward'):
+            train_loss = torch.zeros((1, 1), device=device)
+            for l in loss.values():
+                train_loss = train_loss + l
+            train_loss.backward()
+
+        with timer.section('optimizer'):
+            optim.step()
+            optim.zero_grad()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    seconds = time.perf_counter() - start_time
+    timer.enabled = False
+
+    return {
+        'samples_per_second': input_data.shape[1] * steps / seconds,
+        'ms_per_step': 1000 * seconds / steps,
+        'sections_ms_per_step': timer.milliseconds_per_step(steps),
+        'peak_memory_mb': peak_memory_mb(device)
+    }
+
+
+def benchmark_train( args ):
+    """Throughput of short fixed-seed training segments, sweeping batch size,
+    network size, activation checkpointing, fused sine layers and the loss
+    terms of the first stage with non-zero weight. Time is split into
+    sampling, forward, every loss term, backward and optimizer step, with the
+    device synchronized around every section. Runs with activation
+    checkpointing report the relative cost of recomputing activations against
+    the same run without it, and runs with fused sine layers their speedup
+    and memory saving against the same run without them.
+    """
+    parameter_dict = load_experiment_parameters(args.config)
+    if parameter_dict["gt_mode"] == 'siren':
+        stages = ['siren']
+        first_weights = parameter_dict["loss_weights"]
+    else:
+        stages = args.stages
+        first_weights = parameter_dict["loss_s1_weights"]
+
+    batch_sizes = args.batch_sizes if args.batch_sizes is not None else [parameter_dict["batch_size"]]
+    networks = (
+        [ [ int(width) ] * int(depth) for depth, width in ( n.split('x') for n in args.networks ) ]
+        if args.networks is not None else [ parameter_dict["network"]["hidden_layer_nodes"] ]
+    )
+    masks = args.loss_masks if args.loss_masks is not None else [ '1' * len(first_weights) ]
+    for mask in masks:
+        if len(mask) != len(first_weights):
+            raise ValueError(f'Loss mask {mask} must have one digit per first stage loss weight.')
+
+    checkpointing = { 'off': [False], 'on': [True], 'both': [False, True] }[args.checkpoint_activations]
+    fusing = { 'off': [False], 'on': [True], 'both': [False, True] }[args.fused_sine]
+
+    results = []
+    for batch_size in batch_sizes:
+        for hidden_layer_nodes in networks:
+            for stage in stages:
+                # only the first stage weights are masked
+                for mask in (masks if stage != 's2' else [None]):
+                    if mask is None:
+                        loss_weights = parameter_dict["loss_s2_weights"]
+                    else:
+                        loss_weights = [ w if keep == '1' else 0 for w, keep in zip(first_weights, mask) ]
+
+                    for checkpoint_activations in checkpointing:
+                        for fused_sine in fusing:
+                            result = run_isolated(
+                                _train_worker, parameter_dict, stage, batch_size, hidden_layer_nodes, checkpoint_activations,
+                                fused_sine, loss_weights, args.steps, args.warmup_steps, args.device
+                            )
+                            result = {
+                                'stage': stage,
+                                'batch_size': batch_size,
+                                'hidden_layer_nodes': hidden_layer_nodes,
+                                'checkpoint_activations': checkpoint_activations,
+                                'fused_sine': fused_sine,
+                                'loss_weights': loss_weights,
+                                **result
+                            }
+                            if checkpoint_activations and len(checkpointing) == 2:
+                                baseline = results[-len(fusing)]
+                                result['recompute_overhead'] = result['ms_per_step'] / baseline['ms_per_step'] - 1
+                                result['memory_saving'] = 1 - result['peak_memory_mb'] / baseline['peak_memory_mb']
+                            if fused_sine and len(fusing) == 2:
+                                baseline = results[-1]
+                                result['fused_speedup'] = baseline['ms_per_step'] / result['ms_per_step']
+                                result['fused_memory_saving'] = 1 - result['peak_memory_mb'] / baseline['peak_memory_mb']
+                            results.append(result)
+                            print(f"{stage}, batch {batch_size}, {len(hidden_layer_nodes)}x{hidden_layer_nodes[0]}, "
+                                  f"checkpointing {checkpoint_activations}, fused {fused_sine}, weights {loss_weights}: "
+                                  f"{result['samples_per_second']:.0f} samples/s, {result['ms_per_step']:.1f} ms per step, {result['peak_memory_mb']:.0f} MB")
+
+    write_report({
+        'benchmark': 'train',
+        'dataset': parameter_dict["dataset"],
+        'device': args.device,
+        'steps': args.steps,
+        'results': results
+    }, args.output)
+
+
+def random_symmetric( n, generator ):
+    """Random symmetric matrices in float64, a quarter of them with a repeated
+    eigenvalue and a few multiples of the identity.
+    """
+    rotations, _ = torch.linalg.qr(torch.randn(n, 3, 3, dtype=torch.float64, generator=generator))
+    eigenvalues = torch.randn(n, 3, dtype=torch.float64, generator=generator) * 10.0 ** torch.randint(-3, 4, (n, 1), generator=generator)
+    eigenvalues[: n // 4, 1] = eigenvalues[: n // 4, 0]
+    eigenvalues[: n // 64, 2] = eigenvalues[: n // 64, 0]
+    return rotations @ torch.diag_embed(eigenvalues) @ rotations.transpose(-1, -2)
+
+
+def _time( fn, repetitions, device ):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start_time = time.time()
+    for _ in range(repetitions):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.time() - start_time) / repetitions
+
+
+def benchmark_eigh( args ):
+    """Accuracy of the closed form 3x3 eigensolver against torch.linalg.eigh
+    in float64, and its speed against torch.linalg.eigh in float32.
+    """
+    device = torch.device(args.device)
+    generator = torch.Generator().manual_seed(123)
+
+    matrices = random_symmetric( args.accuracy_samples, generator )
+    reference_values, reference_vectors = torch.linalg.eigh(matrices)
+    values, vectors = eigh3(matrices.to(device))
+    values, vectors = values.cpu().double(), vectors.cpu().double()
+
+    magnitude = torch.amax(torch.abs(reference_values), dim=-1, keepdim=True)
+    residual = torch.linalg.norm(matrices @ vectors - vectors * values[..., None, :], dim=(-2, -1)) / magnitude.squeeze(-1)
+    # the dominant direction is only defined when the largest eigenvalue is simple
+    simple = (reference_values[:, 2] - reference_values[:, 1]) > 1e-3 * magnitude.squeeze(-1)
+    alignment = torch.abs(torch.sum(vectors[simple, :, 2] * reference_vectors[simple, :, 2], dim=-1))
+
+    gradient_input = matrices[:args.accuracy_samples // 8].float().to(device).requires_grad_()
+    eigh3(gradient_input)[1][..., 2].sum().backward()
+
+    accuracy = {
+        'matrices': args.accuracy_samples,
+        'max_relative_eigenvalue_error': torch.max(torch.abs(values - reference_values) / magnitude).item(),
+        'max_relative_residual': torch.max(residual).item(),
+        'max_orthogonality_error': torch.max(torch.abs(vectors.transpose(-1, -2) @ vectors - torch.eye(3, dtype=torch.float64))).item(),
+        'max_dominant_direction_error': torch.max(1 - alignment).item(),
+        'finite_gradients': bool(torch.all(torch.isfinite(gradient_input.grad)))
+    }
+    print(accuracy)
+
+    speed = []
+    for n in args.sizes:
+        batch = random_symmetric( n, generator ).float().to(device)
+        seconds_eigh3 = _time( lambda: eigh3(batch), args.repetitions, device )
+        seconds_torch = _time( lambda: torch.linalg.eigh(batch), args.repetitions, device )
+        speed.append({
+            'matrices': n,
+            'eigh3_seconds': seconds_eigh3,
+            'torch_eigh_seconds': seconds_torch,
+            'speedup': seconds_torch / seconds_eigh3
+        })
+        print(f'{n} matrices: eigh3 {seconds_eigh3:.4f} s, torch.linalg.eigh {seconds_torch:.4f} s')
+
+    write_report({
+        'benchmark': 'eigh',
+        'device': args.device,
+        'accuracy': accuracy,
+        'speed': speed
+    }, args.output)
+
+
+def benchmark_sampling( args ):
+    """Time to sample a training batch with signed and with unsigned distance
+    queries, and checks that unsigned distances are valid for the mesh of
+    the config even if it is open: they must match the absolute signed
+    distance, vanish on the surface point cloud and never exceed the
+    distance to its closest point. Also compares the approximate distances
+    of the point cloud only mode with them.
+    """
+    parameter_dict = load_experiment_parameters(args.config)
+    dataset = PointCloud(
+        meshPath= parameter_dict["dataset"],
+        batchSize= args.batch_size or parameter_dict["batch_size"],
+        samplingPercentiles=parameter_dict["sampling_percentiles"],
+        batchesPerEpoch = 1
+    )
+
+    seconds = {}
+    batches = {}
+    for unsigned in [False, True]:
+        dataset.unsignedDistances = unsigned
+        np.random.seed(123)
+        torch.manual_seed(123)
+        next(iter(dataset))
+
+        start_time = time.perf_counter()
+        batches[unsigned] = [ next(iter(dataset)) for _ in range(args.batches) ]
+        seconds[unsigned] = (time.perf_counter() - start_time) / args.batches
+        print(f'{"Unsigned" if unsigned else "Signed"} distances: {seconds[unsigned]:.4f} s per batch')
+
+    # same seeds, so both modes sampled the same points
+    signed_sdf = torch.cat([ sdf.flatten() for _, _, sdf, _ in batches[False] ])
+    unsigned_sdf = torch.cat([ sdf.flatten() for _, _, sdf, _ in batches[True] ])
+
+    positions = torch.from_numpy(dataset.surface_pc.point['positions'].numpy()).float()
+    check_indices = torch.randint(0, len(positions), (args.check_points,))
+    on_surface = o3c_to_torch(dataset.scene.compute_distance( torch_to_o3c(positions[check_indices].contiguous()) ))
+
+    queries = batches[True][0][0][0]
+    queries_sdf = batches[True][0][2][0, :, 0]
+    queries, queries_sdf = queries[:args.check_points], queries_sdf[:args.check_points]
+    closest = torch.full((len(queries),), float('inf'))
+    for chunk in torch.split(positions, 2 ** 16):
+        closest = torch.minimum(closest, torch.cdist(queries, chunk).amin(dim=-1))
+
+    validation = {
+        'max_abs_difference': torch.max(torch.abs(torch.abs(signed_sdf) - unsigned_sdf)).item(),
+        'negative_signed_fraction': torch.mean((signed_sdf < 0).float()).item(),
+        'min_unsigned_distance': torch.min(unsigned_sdf).item(),
+        'max_distance_on_surface': torch.max(on_surface).item(),
+        'max_excess_over_closest_point': torch.max(queries_sdf - closest).item()
+    }
+    print(validation)
+
+    # distances of the point cloud only mode against the ones of the mesh
+    start_time = time.perf_counter()
+    kdtree = KDTreeDistance(
+        dataset.surface_pc.point['positions'].numpy(),
+        dataset.surface_pc.point['normals'].numpy()
+    )
+    build_seconds = time.perf_counter() - start_time
+    samples = torch.cat([ points[0] for points, _, _, _ in batches[True] ])
+    start_time = time.perf_counter()
+    approximate_sdf = o3c_to_torch(kdtree.compute_distance( torch_to_o3c(samples.contiguous()) ))
+    query_seconds = (time.perf_counter() - start_time) / args.batches
+    kdtree_error = torch.abs(approximate_sdf - unsigned_sdf)
+    point_cloud_only = {
+        'points': len(positions),
+        'build_seconds': build_seconds,
+        'query_seconds_per_batch': query_seconds,
+        'error_bound': kdtree.samplingRadius,
+        'max_error': torch.max(kdtree_error).item(),
+        'mean_error': torch.mean(kdtree_error).item(),
+        'within_bound_fraction': torch.mean((kdtree_error <= kdtree.samplingRadius).float()).item()
+    }
+    print(point_cloud_only)
+
+    write_report({
+        'benchmark': 'sampling',
+        'dataset': parameter_dict["dataset"],
+        'batch_size': dataset.batchSize,
+        'batches': args.batches,
+        'signed_seconds_per_batch': seconds[False],
+        'unsigned_seconds_per_batch': seconds[True],
+        'speedup': seconds[False] / seconds[True],
+        'validation': validation,
+        'point_cloud_only': point_cloud_only
+    }, args.output)
+
+
+def _lazy_worker( parameter_dict, interval, terms, steps, eval_batches, device ):
+    np.random.seed(321)
+    device = torch.device(device)
+
+    dataset = PointCloud(
+        meshPath= parameter_dict["dataset"],
+        batchSize= parameter_dict["batch_size"],
+        samplingPercentiles=parameter_dict["sampling_percentiles"],
+        batchesPerEpoch = 1,
+        unsignedDistances = unsigned_sampling( parameter_dict )
+    )
+    # same held out batches for every interval
+    evaluation = [ next(iter(dataset)) for _ in range(eval_batches) ]
+
+    torch.manual_seed(123)
+    np.random.seed(123)
+    model = build_model( parameter_dict["network"] ).to(device)
+    optim = torch.optim.Adam(lr=parameter_dict.get("warmup_lr", 1e-4), params=model.parameters())
+    loss_weights = parameter_dict["loss_s1_weights"]
+
+    seconds = 0
+    for step in range(steps):
+        input_data, normals, sdf, weights = next(iter(dataset))
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start_time = time.perf_counter()
+
+        optim.zero_grad()
+        loss = loss_s1(
+            model,
+            input_data.to(device),
+            {'normals': normals.to(device), 'sdf': sdf.to(device), 'weights': weights.to(device)},
+            lazy_weights( loss_weights, step, interval, terms ),
+            parameter_dict["alpha"]
+        )
+        train_loss = torch.zeros((1, 1), device=device)
+        for l in loss.values():
+            train_loss += l
+        train_loss.backward()
+        optim.step()
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        seconds += time.perf_counter() - start_time
+
+    # quality is measured with every term at its configured weight
+    terms_sum = {}
+    distance_error = 0
+    for input_data, normals, sdf, weights in evaluation:
+        gt = {'normals': normals.to(device), 'sdf': sdf.to(device), 'weights': weights.to(device)}
+        loss = loss_s1( model, input_data.to(device), gt, loss_weights, parameter_dict["alpha"] )
+        for it, l in loss.items():
+            terms_sum[it] = terms_sum.get(it, 0) + l.item() / eval_batches
+        distance_error += s1_residuals( model, input_data.to(device), gt, parameter_dict["alpha"] ).mean().item() / eval_batches
+
+    return seconds / steps, terms_sum, distance_error
+
+
+def benchmark_lazy( args ):
+    """Speed and quality of stage 1 training when the second order terms are
+    only evaluated every k steps (lazy regularization). Every configuration
+    is trained from the same initialization and batches for the same amount
+    of steps in its own process, and evaluated with the full loss on held
+    out batches.
+    """
+    results = []
+    for config in args.configs:
+        parameter_dict = load_experiment_parameters(config)
+        baseline = None
+        for interval in args.intervals:
+            seconds_per_step, terms, distance_error = run_isolated(
+                _lazy_worker, parameter_dict, interval, args.terms, args.steps, args.eval_batches, args.device
+            )
+            full_loss = sum(terms.values())
+            if baseline is None:
+                baseline = (seconds_per_step, full_loss, distance_error)
+            results.append({
+                'config': config,
+                'interval': interval,
+                'seconds_per_step': seconds_per_step,
+                'speedup': baseline[0] / seconds_per_step,
+                'loss': full_loss,
+                'loss_terms': terms,
+                'relative_loss': full_loss / baseline[1],
+                'distance_error': distance_error,
+                'relative_distance_error': distance_error / baseline[2]
+            })
+            print(f'{config}, k = {interval}: {seconds_per_step:.3f} s per step, loss {full_loss:.4e}, distance error {distance_error:.4e}')
+
+    write_report({
+        'benchmark': 'lazy',
+        'device': args.device,
+        'steps': args.steps,
+        'terms': args.terms,
+        'results': results
+    }, args.output)
+
+
+def _s2_worker( parameter_dict, weights_path, method, epochs, eval_every, eval_points, device ):
+    np.random.seed(321)
+    device = torch.device(device)
+
+    dataset = PointCloud(
+        meshPath= parameter_dict["dataset"],
+        batchSize= parameter_dict["batch_size"],
+        samplingPercentiles=parameter_dict["sampling_percentiles"],
+        batchesPerEpoch = parameter_dict["batches_per_epoch"],
+        unsignedDistances = unsigned_sampling( parameter_dict )
+    )
+    # same held out surface points for both methods
+    dataset.sample_surface_only( eval_points )
+    eval_input = next(iter(dataset))[0].to(device)
+    dataset.sample_surface_only( parameter_dict.get('s2_batch_size') or int(parameter_dict["batch_size"] * parameter_dict["sampling_percentiles"][0]) )
+
+    torch.manual_seed(123)
+    np.random.seed(123)
+    model = build_model( parameter_dict["network"] ).to(device)
+    model.load_state_dict(torch.load(weights_path, map_location=device))
+    loss_weights = parameter_dict["loss_s2_weights"]
+    opt_params = parameter_dict["optimizer"]
+
+    def evaluate_surface():
+        with torch.no_grad():
+            surface = model(eval_input)['model_out'].flatten()
+        return torch.abs(torch.mean(surface)).item(), torch.std(surface).item()
+
+    if method == 'lbfgs':
+        optim = make_lbfgs( model, opt_params.get('s2', {}) )
+        subset = next(iter(dataset))
+    else:
+        optim = torch.optim.Adam(lr=opt_params["lr_s2"], params=model.parameters())
+        s2_epochs = parameter_dict["num_epochs"] - parameter_dict["s1_epochs"]
+
+    mean, std = evaluate_surface()
+    curve = [ {'epoch': 0, 'seconds': 0.0, 'sdf_on_surf': mean, 'std_on_surf': std} ]
+    seconds = 0
+    for epoch in range(epochs):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start_time = time.perf_counter()
+
+        if method == 'lbfgs':
+            input_data, normals, sdf, weights = subset
+            gt = {'normals': normals.to(device), 'sdf': sdf.to(device), 'weights': weights.to(device)}
+            def closure():
+                optim.zero_grad()
+                loss = loss_s2( model, input_data.to(device), gt, loss_weights, parameter_dict["alpha"] )
+                train_loss = loss['sdf_on_surf'] + loss['std_on_surf']
+                train_loss.backward()
+                return train_loss
+            optim.step(closure)
+        else:
+            # cosine schedule of train.py
+            lr = 0.5 * (np.cos((epoch + parameter_dict["s1_epochs"]) / s2_epochs * np.pi) + 1) * opt_params["lr_s2"]
+            for g in optim.param_groups:
+                g['lr'] = lr
+            for input_data, normals, sdf, weights in iter(dataset):
+                optim.zero_grad()
+                gt = {'normals': normals.to(device), 'sdf': sdf.to(device), 'weights': weights.to(device)}
+                loss = loss_s2( model, input_data.to(device), gt, loss_weights, parameter_dict["alpha"] )
+                (loss['sdf_on_surf'] + loss['std_on_surf']).sum().backward()
+                optim.step()
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        seconds += time.perf_counter() - start_time
+
+        if (epoch + 1) % eval_every == 0 or epoch + 1 == epochs:
+            mean, std = evaluate_surface()
+            curve.append({'epoch': epoch + 1, 'seconds': seconds, 'sdf_on_surf': mean, 'std_on_surf': std})
+
+    return curve
+
+
+def benchmark_s2( args ):
+    """Second step refinement of stage 1 weights with the Adam cosine schedule
+    of train.py against L-BFGS on a fixed surface subset. Reports the mean
+    and standard deviation of the distance on held out surface points along
+    training, and the epochs and time L-BFGS needs to reach the final values
+    of Adam.
+    """
+    parameter_dict = load_experiment_parameters(args.config)
+    adam_epochs = args.adam_epochs or parameter_dict["num_epochs"] - parameter_dict["s1_epochs"]
+
+    curves = {
+        'adam': run_isolated( _s2_worker, parameter_dict, args.weights, 'adam', adam_epochs, args.eval_every, args.eval_points, args.device ),
+        'lbfgs': run_isolated( _s2_worker, parameter_dict, args.weights, 'lbfgs', args.lbfgs_epochs, 1, args.eval_points, args.device )
+    }
+    target = curves['adam'][-1]
+    reached = [
+        point for point in curves['lbfgs']
+        if point['sdf_on_surf'] <= target['sdf_on_surf'] and point['std_on_surf'] <= target['std_on_surf']
+    ]
+
+    summary = {
+        'adam_epochs': target['epoch'],
+        'adam_seconds': target['seconds'],
+        'adam_sdf_on_surf': target['sdf_on_surf'],
+        'adam_std_on_surf': target['std_on_surf'],
+        'lbfgs_epochs_to_adam': reached[0]['epoch'] if reached else None,
+        'lbfgs_seconds_to_adam': reached[0]['seconds'] if reached else None,
+        'lbfgs_sdf_on_surf': curves['lbfgs'][-1]['sdf_on_surf'],
+        'lbfgs_std_on_surf': curves['lbfgs'][-1]['std_on_surf']
+    }
+    print(summary)
+
+    write_report({
+        'benchmark': 's2',
+        'dataset': parameter_dict["dataset"],
+        'weights': args.weights,
+        'device': args.device,
+        'summary': summary,
+        'curves': curves
+    }, args.output)
+
+
+def _scaling_worker( rank, world_size, parameter_dict, steps, warmup_steps, queue ):
+    init_distributed( rank, world_size )
+
+    torch.manual_seed(123 + rank)
+    np.random.seed(123 + rank)
+
+    dataset = PointCloud(
+        meshPath= parameter_dict["dataset"],
+        batchSize= parameter_dict["batch_size"] // world_size,
+        samplingPercentiles=parameter_dict["sampling_percentiles"],
+        batchesPerEpoch = 1,
+        unsignedDistances = unsigned_sampling( parameter_dict )
+    )
+    model = build_model( parameter_dict["network"] )
+    broadcast_parameters(model)
+    optim = torch.optim.Adam(lr=parameter_dict["optimizer"]["lr_s1"], params=model.parameters())
+
+    for step in range(warmup_steps + steps):
+        if step == warmup_steps:
+            dist.barrier()
+            start_time = time.time()
+
+        for input_data, normals, sdf, _ in iter(dataset):
+            optim.zero_grad()
+            loss = loss_s1(
+                model,
+                input_data,
+                {'normals': normals, 'sdf': sdf},
+                parameter_dict["loss_s1_weights"],
+                parameter_dict["alpha"]
+            )
+            train_loss = torch.zeros((1, 1))
+            for l in loss.values():
+                train_loss += l
+            train_loss.backward()
+            if world_size > 1:
+                average_gradients(model)
+            optim.step()
+
+    dist.barrier()
+    if rank == 0:
+        queue.put( (time.time() - start_time) / steps )
+    dist.destroy_process_group()
+
+
+def benchmark_scaling( args ):
+    """Data-parallel scaling of a stage 1 training step on CPU: the same
+    global batch is split across 1, 2, 4, ... processes with the gloo
+    backend.
+    """
+    parameter_dict = load_experiment_parameters(args.config)
+    if args.batch_size is not None:
+        parameter_dict["batch_size"] = args.batch_size
+
+    context = mp.get_context('spawn')
+    results = []
+    for world_size in args.processes:
+        if parameter_dict["batch_size"] % world_size != 0:
+            raise ValueError('Batch size must be divisible by the amount of processes.')
+
+        # fresh port for every group, previous sockets may still be closing
+        os.environ['MASTER_PORT'] = str(args.port + world_size)
+        queue = context.SimpleQueue()
+        mp.spawn(
+            _scaling_worker,
+            args=(world_size, parameter_dict, args.steps, args.warmup_steps, queue),
+            nprocs=world_size
+        )
+        seconds_per_step = queue.get()
+
+        results.append({
+            'processes': world_size,
+            'seconds_per_step': seconds_per_step,
+            'samples_per_second': parameter_dict["batch_size"] / seconds_per_step
+        })
+        print(f'{world_size} processes: {seconds_per_step:.3f} s per step')
+
+    for result in results:
+        result['speedup'] = results[0]['seconds_per_step'] / result['seconds_per_step']
+        result['efficiency'] = result['speedup'] * results[0]['processes'] / result['processes']
+
+    write_report({
+        'benchmark': 'scaling',
+        'dataset': parameter_dict["dataset"],
+        'batch_size': parameter_dict["batch_size"],
+        'hidden_layer_nodes': parameter_dict["network"]["hidden_layer_nodes"],
+        'results': results
+    }, args.output)
+
+
+def _generators_worker( parameter_dict, weights_path, fused_sine, points, chunk_size, repetitions, device ):
+    device = torch.device(device)
+    model = build_model( dict(parameter_dict["network"], checkpoint_activations=False, fused_sine=fused_sine) ).to(device)
+    if weights_path is not None:
+        model.load_state_dict(torch.load(weights_path, map_location=device))
+    model.eval()
+
+    generator = torch.Generator().manual_seed(123)
+    samples = torch.rand((points, 3), generator=generator) * 2 - 1
+    gradients = np.zeros((points, 3))
+    hessians = np.zeros((points, 3, 3))
+
+    # marching cubes and sphere tracing need gradients, point sampling and curvatures Hessians
+    result = {
+        'gradient_seconds': _time(
+            lambda: evaluate( model, samples, max_batch=chunk_size, device=device, gradients=gradients ), repetitions, device
+        ),
+        'hessian_seconds': _time(
+            lambda: evaluate( model, samples, max_batch=chunk_size, device=device, gradients=gradients, hessians=hessians ), repetitions, device
+        ),
+        'peak_memory_mb': peak_memory_mb( device )
+    }
+    distances = evaluate( model, samples, max_batch=chunk_size, device=device, gradients=gradients, hessians=hessians )
+    return result, distances, gradients, hessians
+
+
+def benchmark_generators( args ):
+    """Query cost of the generators with and without fused sine layers:
+    distances with gradients, as meshing and rendering use them, and with
+    Hessians, as point sampling does. Both networks have the same weights,
+    the largest differences of their outputs are reported as well.
+    """
+    parameter_dict = load_experiment_parameters(args.config)
+    runs = [
+        run_isolated( _generators_worker, parameter_dict, args.weights, fused_sine, args.points, args.chunk_size, args.repetitions, args.device )
+        for fused_sine in [False, True]
+    ]
+    (baseline, *outputs), (fused, *fused_outputs) = runs
+
+    summary = {
+        'gradient_speedup': baseline['gradient_seconds'] / fused['gradient_seconds'],
+        'hessian_speedup': baseline['hessian_seconds'] / fused['hessian_seconds'],
+        'memory_saving': 1 - fused['peak_memory_mb'] / baseline['peak_memory_mb'],
+        'max_difference': {
+            name: float(np.max(np.abs(a - b))) for name, a, b in zip(['distance', 'gradient', 'hessian'], outputs, fused_outputs)
+        }
+    }
+    print(summary)
+
+    write_report({
+        'benchmark': 'generators',
+        'device': args.device,
+        'points': args.points,
+        'hidden_layer_nodes': parameter_dict["network"]["hidden_layer_nodes"],
+        'baseline': baseline,
+        'fused': fused,
+        'summary': summary
+    }, args.output)
+
+
+def _query_worker( experiment, points, chunk_size, repetitions, device ):
+    device = torch.device(device)
+    parameter_dict = load_experiment_parameters(osp.join(experiment, 'params.json'))
+    model = build_model( parameter_dict["network"] ).to(device)
+    model.load_state_dict(torch.load(osp.join(experiment, 'models', 'model_best.pth'), map_location=device))
+    model.eval()
+
+    generator = torch.Generator().manual_seed(123)
+    query = (torch.rand((points, 3), generator=generator) * 2 - 1).to(device)
+
+    def distances():
+        with torch.no_grad():
+            for chunk in torch.split(query, chunk_size):
+                model(chunk)
+
+    def gradients():
+        # what meshing, sphere tracing and point sampling ask for
+        for chunk in torch.split(query, chunk_size):
+            output = model(chunk)
+            torch.autograd.grad(output['model_out'].sum(), output['model_in'])
+
+    return {
+        'parameters': sum( p.numel() for p in model.parameters() ),
+        'distance_seconds': _time( distances, repetitions, device ),
+        'gradient_seconds': _time( gradients, repetitions, device ),
+        'peak_memory_mb': peak_memory_mb( device )
+    }
+
+
+def chamfer( experiment, parameter_dict ):
+    """Chamfer distance between the vertices of the reconstruction of an
+    experiment and its input point cloud, None if it was not meshed.
+    """
+    mesh_name = 'mc_mesh_best_MU.obj' if parameter_dict["gt_mode"] == 'tanh' else 'mc_mesh_best.obj'
+    mesh_path = osp.join(experiment, 'reconstructions', mesh_name)
+    if not osp.exists(mesh_path):
+        return None
+
+    vertices = np.asarray(o3d.io.read_triangle_mesh(mesh_path).vertices)
+    points = np.asarray(o3d.io.read_point_cloud(parameter_dict["dataset"] + '_pc.ply').points)
+    to_points, _ = cKDTree(points).query(vertices, workers=-1)
+    to_vertices, _ = cKDTree(vertices).query(points, workers=-1)
+    return float(np.mean(to_points) + np.mean(to_vertices))
+
+
+def benchmark_encoding( args ):
+    """Query throughput and reconstruction quality of trained experiments,
+    typically a small network with a hash grid encoding against the 8x256
+    baseline. Every experiment folder needs its params.json and best
+    weights; the chamfer distance is computed if it was meshed. The first
+    experiment is the baseline.
+    """
+    results = []
+    for experiment in args.experiments:
+        parameter_dict = load_experiment_parameters(osp.join(experiment, 'params.json'))
+        timing = run_isolated( _query_worker, experiment, args.points, args.chunk_size, args.repetitions, args.device )
+        result = {
+            'experiment': experiment,
+            'hidden_layer_nodes': parameter_dict["network"]["hidden_layer_nodes"],
+            'encoding': parameter_dict["network"].get('encoding', None),
+            **timing,
+            'distance_points_per_second': args.points / timing['distance_seconds'],
+            'gradient_points_per_second': args.points / timing['gradient_seconds'],
+            'chamfer': chamfer( experiment, parameter_dict )
+        }
+        results.append(result)
+        print(f"{experiment}: {result['distance_points_per_second']:.3e} distances/s, "
+              f"{result['gradient_points_per_second']:.3e} gradients/s, chamfer {result['chamfer']}")
+
+    baseline = results[0]
+    for result in results:
+        result['distance_speedup'] = baseline['distance_seconds'] / result['distance_seconds']
+        result['gradient_speedup'] = baseline['gradient_seconds'] / result['gradient_seconds']
+        if result['chamfer'] is not None and baseline['chamfer'] is not None:
+            result['relative_chamfer'] = result['chamfer'] / baseline['chamfer']
+
+    write_report({
+        'benchmark': 'encoding',
+        'device': args.device,
+        'points': args.points,
+        'chunk_size': args.chunk_size,
+        'results': results
+    }, args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Training and inference benchmarks. Results are reported as JSON.')
+    parser.add_argument('-o', '--output', type=str, default=None, help='path to output JSON, printed if not given')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    scaling = subparsers.add_parser('scaling', help='data-parallel scaling of training across CPU processes')
+    scaling.add_argument('config', metavar='path/to/json', type=str, help='path to train config')
+    scaling.add_argument('-p', '--processes', type=int, nargs='+', default=[1, 2, 4, 8], help='amounts of processes to benchmark')
+    scaling.add_argument('-b', '--batch_size', type=int, default=None, help='global batch size, overrides the config')
+    scaling.add_argument('-s', '--steps', type=int, default=10, help='timed steps')
+    scaling.add_argument('-w', '--warmup_steps', type=int, default=2, help='untimed steps')
+    scaling.add_argument('--port', type=int, default=29500, help='base port of the process groups')
+    scaling.set_defaults(run=benchmark_scaling)
+
+    loss = subparsers.add_parser('loss', help='second order loss terms on the surface subset against the whole batch')
+    loss.add_argument('config', metavar='path/to/json', type=str, help='path to train config')
+    loss.add_argument('-b', '--batch_sizes', type=int, nargs='+', default=[30000, 60000, 120000], help='batch sizes to benchmark')
+    loss.add_argument('-s', '--steps', type=int, default=10, help='timed steps')
+    loss.add_argument('-w', '--warmup_steps', type=int, default=2, help='untimed steps')
+    loss.add_argument('-d', '--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu', help='torch device')
+    loss.set_defaults(run=benchmark_loss)
+
+    eigh = subparsers.add_parser('eigh', help='closed form 3x3 eigensolver against torch.linalg.eigh')
+    eigh.add_argument('-n', '--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='amounts of matrices to time')
+    eigh.add_argument('-a', '--accuracy_samples', type=int, default=100000, help='amount of matrices to check accuracy on')
+    eigh.add_argument('-r', '--repetitions', type=int, default=10, help='timed repetitions')
+    eigh.add_argument('-d', '--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu', help='torch device')
+    eigh.set_defaults(run=benchmark_eigh)
+
+    sampling = subparsers.add_parser('sampling', help='batch sampling with signed, unsigned and point cloud only distance queries')
+    sampling.add_argument('config', metavar='path/to/json', type=str, help='path to train config')
+    sampling.add_argument('-b', '--batch_size', type=int, default=None, help='batch size, the one of the config if not given')
+    sampling.add_argument('-n', '--batches', type=int, default=20, help='timed batches of each mode')
+    sampling.add_argument('-c', '--check_points', type=int, default=2000, help='points to validate unsigned distances on')
+    sampling.set_defaults(run=benchmark_sampling)
+
+    train = subparsers.add_parser('train', help='training throughput split by sections')
+    train.add_argument('config', metavar='path/to/json', type=str, help='path to train config')
+    train.add_argument('-b', '--batch_sizes', type=int, nargs='+', default=None, help='batch sizes, the one of the config if not given')
+    train.add_argument('-n', '--networks', type=str, nargs='+', default=None, help='hidden layers as DEPTHxWIDTH, e.g. 8x256, the ones of the config if not given')
+    train.add_argument('-m', '--loss_masks', type=str, nargs='+', default=None, help='first stage loss terms to keep, one digit per weight, e.g. 1101')
+    train.add_argument('-c', '--checkpoint_activations', type=str, default='off', choices=['off', 'on', 'both'], help='activation checkpointing of the network, both compares them')
+    train.add_argument('-f', '--fused_sine', type=str, default='off', choices=['off', 'on', 'both'], help='fused sine layers, both compares them')
+    train.add_argument('--stages', type=str, nargs='+', default=['s1', 's2'], choices=['s1', 's2'], help='stages of tanh training to benchmark')
+    train.add_argument('-s', '--steps', type=int, default=20, help='timed steps')
+    train.add_argument('-w', '--warmup_steps', type=int, default=3, help='untimed steps')
+    train.add_argument('-d', '--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu', help='torch device')
+    train.set_defaults(run=benchmark_train)
+
+    lazy = subparsers.add_parser('lazy', help='stage 1 speed and quality when second order terms are evaluated every k steps')
+    lazy.add_argument('configs', metavar='path/to/json', type=str, nargs='+', help='paths to train configs')
+    lazy.add_argument('-k', '--intervals', type=int, nargs='+', default=[1, 2, 4, 8], help='intervals to compare, the first one is the baseline')
+    lazy.add_argument('-t', '--terms', type=str, nargs='+', default=['hessian_constraint'], choices=S1_TERMS[2:], help='lazy terms')
+    lazy.add_argument('-s', '--steps', type=int, default=500, help='training steps')
+    lazy.add_argument('-e', '--eval_batches', type=int, default=10, help='held out batches to evaluate on')
+    lazy.add_argument('-d', '--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu', help='torch device')
+    lazy.set_defaults(run=benchmark_lazy)
+
+    s2 = subparsers.add_parser('s2', help='second step with the Adam schedule against L-BFGS on a fixed surface subset')
+    s2.add_argument('config', metavar='path/to/json', type=str, help='path to train config, L-BFGS settings are read from optimizer.s2')
+    s2.add_argument('weights', metavar='path/to/pth', type=str, help='weights at the end of the first step')
+    s2.add_argument('--adam_epochs', type=int, default=None, help='epochs of the Adam schedule, the second step epochs of the config if not given')
+    s2.add_argument('--lbfgs_epochs', type=int, default=50, help='L-BFGS steps')
+    s2.add_argument('--eval_every', type=int, default=50, help='Adam epochs between evaluations')
+    s2.add_argument('--eval_points', type=int, default=100000, help='held out surface points')
+    s2.add_argument('-d', '--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu', help='torch device')
+    s2.set_defaults(run=benchmark_s2)
+
+    generators = subparsers.add_parser('generators', help='gradient and Hessian queries with and without fused sine layers')
+    generators.add_argument('config', metavar='path/to/json', type=str, help='path to train config, its network is used')
+    generators.add_argument('-w', '--weights', type=str, default=None, help='trained weights, a random initialization if not given')
+    generators.add_argument('-n', '--points', type=int, default=2 ** 18, help='query points')
+    generators.add_argument('-c', '--chunk_size', type=int, default=64 ** 2, help='points per forward pass')
+    generators.add_argument('-r', '--repetitions', type=int, default=3, help='timed repetitions')
+    generators.add_argument('-d', '--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu', help='torch device')
+    generators.set_defaults(run=benchmark_generators)
+
+    encoding = subparsers.add_parser('encoding', help='query throughput and chamfer distance of trained networks, e.g. hash grid encoded against 8x256')
+    encoding.add_argument('experiments', metavar='path/to/experiment', type=str, nargs='+', help='trained experiment folders, the first one is the baseline')
+    encoding.add_argument('-n', '--points', type=int, default=2 ** 20, help='query points')
+    encoding.add_argument('-c', '--chunk_size', type=int, default=2 ** 16, help='points per forward pass')
+    encoding.add_argument('-r', '--repetitions', type=int, default=5, help='timed repetitions')
+    encoding.add_argument('-d', '--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu', help='torch device')
+    encoding.set_defaults(run=benchmark_encoding)
+
+    args = parser.parse_args()
+    args.run(args)
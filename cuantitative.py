@@ -1,6 +1,11 @@
 import torch
 from train import setup_train
+from train_ensemble import setup_train_ensemble
+import argparse
+import copy
+import json
 import os
+import time
 import gc
 from pytorch3d.loss import chamfer_distance
 import trimesh as tm
@@ -18,7 +23,69 @@ def metrics( mesh, pointcloud, norm, cuda_device ):
     
     return cd.cpu().numpy(), nc.cpu().numpy()
 
+def trained_epochs( outfolder, experiment_name ):
+    with open(os.path.join(outfolder, experiment_name, 'params.json')) as params_file:
+        params = json.load(params_file)
+    return params.get('schedule', {}).get('num_epochs', params['num_epochs'])
+
+def epochs_to_target( outfolder, experiment_name, dataset_file, target_cd, cuda_device ):
+    """
+    First checkpoint epoch whose MeshUDF reconstruction has an L1 chamfer
+    distance to the ground truth point cloud below target_cd, None if no
+    checkpoint reaches it.
+    """
+    gt_pc = o3d.io.read_point_cloud(dataset_file)
+    reconstructions = os.path.join(outfolder, experiment_name, 'reconstructions')
+    epochs = sorted(
+        int(file[len('mc_mesh_'):-len('_MU.obj')]) for file in os.listdir(reconstructions)
+        if file.startswith('mc_mesh_') and file.endswith('_MU.obj') and file[len('mc_mesh_'):-len('_MU.obj')].isdigit()
+    )
+    for epoch in epochs:
+        mesh = o3d.io.read_triangle_mesh(os.path.join(reconstructions, f'mc_mesh_{epoch}_MU.obj'))
+        mesh.compute_vertex_normals(normalized=True)
+        L1CD, _ = metrics( mesh, gt_pc, norm=1, cuda_device=cuda_device )
+        if L1CD <= target_cd:
+            return epoch
+    return None
+
+def write_metrics( outfolder, experiment_name, dataset_file, training_time, meshMU, meshCAP, cuda_device ):
+    print('Computing chamfer distances...')
+    gt_pc = o3d.io.read_point_cloud(dataset_file)
+
+    cap_mesh = meshCAP.as_open3d
+    mu_mesh = meshMU.as_open3d
+
+    cap_mesh.compute_vertex_normals(normalized=True)
+    mu_mesh.compute_vertex_normals(normalized=True)
+
+    L1CD_CAP, NC_CAP = metrics( cap_mesh, gt_pc, norm=1, cuda_device=cuda_device )
+    L2CD_CAP, _ = metrics( cap_mesh, gt_pc, norm=2, cuda_device=cuda_device )
+    L1CD_MU, NC_MU = metrics( mu_mesh, gt_pc, norm=1, cuda_device=cuda_device )
+    L2CD_MU, _ = metrics( mu_mesh, gt_pc, norm=2, cuda_device=cuda_device )
+
+    with open(os.path.join(outfolder, 'results.csv'), 'a') as result_file:
+        result_file.write(f'{experiment_name},{training_time},{trained_epochs(outfolder, experiment_name)},{L1CD_CAP},{L2CD_CAP},{NC_CAP},{L1CD_MU},{L2CD_MU},{NC_MU}\n')
+
 if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Train and evaluate every shape of a dataset')
+    parser.add_argument('-k', '--ensemble_size', type=int, default=1,
+                    help='amount of shapes trained at once with a vectorized ensemble (1 trains them one after another)')
+    parser.add_argument('--adaptive_sampling', action='store_true',
+                    help='sample close to surface points by training error')
+    parser.add_argument('--target_cd', type=float, default=None,
+                    help='report the first checkpoint epoch reaching this L1 chamfer distance')
+    parser.add_argument('--checkpoint_every', type=int, default=100,
+                    help='epochs between checkpoint reconstructions when using --target_cd')
+    parser.add_argument('--early_stopping', action='store_true',
+                    help='end stages when the loss plateaus, the saved epochs are reported with the chamfer distances')
+    args = parser.parse_args()
+
+    if args.ensemble_size > 1:
+        # ensembles neither sample adaptively, stop early nor mesh checkpoints
+        for flag, given in [ ('--adaptive_sampling', args.adaptive_sampling), ('--early_stopping', args.early_stopping), ('--target_cd', args.target_cd is not None) ]:
+            if given:
+                raise ValueError(f'{flag} is not supported when training ensembles (-k > 1).')
+
     net_width = 256
     net_depth = 8
     layer_nodes = [net_width] * net_depth
@@ -58,10 +125,27 @@ if __name__=='__main__':
         "resolution": 256
     }
 
+    if args.adaptive_sampling:
+        exp_config['adaptive_sampling'] = { "resolution": 16, "decay": 0.9, "mixing": 0.5 }
+
+    if args.target_cd is not None:
+        exp_config['epochs_to_checkpoint'] = args.checkpoint_every
+        with open(os.path.join(outfolder, 'convergence.csv'), 'w+') as convergence_file:
+            convergence_file.write('mesh,epochs_to_target\n')
+
+    if args.early_stopping:
+        exp_config['early_stopping'] = {
+            "smoothing": 0.9,
+            "patience": 100,
+            "min_delta": 1e-3,
+            "min_epochs": { "warmup": 200, "s1": 500, "s2": 100 }
+        }
+
 
     with open(os.path.join(outfolder, 'results.csv'), 'w+') as result_file:
-        result_file.write('mesh,time,L1CD_CAP,L2CD_CAP,NC_CAP,L1CD_MU,L2CD_MU,NC_MU\n')
+        result_file.write('mesh,time,epochs,L1CD_CAP,L2CD_CAP,NC_CAP,L1CD_MU,L2CD_MU,NC_MU\n')
     
+    jobs = []
     for it, (dirpath, dirnames, filenames) in enumerate(os.walk(dataset)):
 
         try:
@@ -73,41 +157,45 @@ if __name__=='__main__':
         # comparo con la nube de puntos y no con los vertices de la malla original... tiene mas sentido
         dataset_file = os.path.join(dirpath, filenames[dataset_index])
 
-        print(f'Training for {filenames[gt_index]}')
-
         experiment_name = dirpath[dirpath.rfind('/')+1:]
 
-        exp_config['dataset'] = dataset_file[:-7]
-        exp_config['experiment_name'] = experiment_name
-
         if os.path.exists(os.path.join(outfolder, experiment_name)):
             print(f'Skipping {experiment_name}')
             continue
 
-        training_time, (meshMU, meshCAP) = setup_train( exp_config, cuda_device)
+        config = copy.deepcopy(exp_config)
+        config['dataset'] = dataset_file[:-7]
+        config['experiment_name'] = experiment_name
+        jobs.append( (experiment_name, dataset_file, config) )
 
-        torch.cuda.empty_cache()
-        gc.collect()
-
-        print('Computing chamfer distances...')
-        gt_pc = o3d.io.read_point_cloud(dataset_file)
-
-        time = training_time
-        cap_mesh = meshCAP.as_open3d
-        mu_mesh = meshMU.as_open3d
+    total_training_time = 0
+    start_time = time.time()
+    for head in range(0, len(jobs), args.ensemble_size):
+        group = jobs[head:head + args.ensemble_size]
+        print(f'Training for {", ".join(name for name, _, _ in group)}')
 
-        cap_mesh.compute_vertex_normals(normalized=True)
-        mu_mesh.compute_vertex_normals(normalized=True)
+        if len(group) == 1:
+            training_time, meshes = setup_train( group[0][2], cuda_device )
+            results = [ (training_time, meshes) ]
+        else:
+            training_time, results = setup_train_ensemble( [ config for _, _, config in group ], cuda_device )
 
-        L1CD_CAP, NC_CAP = metrics( cap_mesh, gt_pc, norm=1, cuda_device=cuda_device )
-        L2CD_CAP, _ = metrics( cap_mesh, gt_pc, norm=2, cuda_device=cuda_device )
-        L1CD_MU, NC_MU = metrics( mu_mesh, gt_pc, norm=1, cuda_device=cuda_device )
-        L2CD_MU, _ = metrics( mu_mesh, gt_pc, norm=2, cuda_device=cuda_device )
+        total_training_time += training_time
 
-        with open(os.path.join(outfolder, 'results.csv'), 'a') as result_file:
-            result_file.write(f'{experiment_name},{time},{L1CD_CAP},{L2CD_CAP},{NC_CAP},{L1CD_MU},{L2CD_MU},{NC_MU}\n')
+        torch.cuda.empty_cache()
+        gc.collect()
 
+        for (experiment_name, dataset_file, _), (shape_time, (meshMU, meshCAP)) in zip(group, results):
+            write_metrics( outfolder, experiment_name, dataset_file, shape_time, meshMU, meshCAP, cuda_device )
 
-    
+            if args.target_cd is not None:
+                with open(os.path.join(outfolder, 'convergence.csv'), 'a') as convergence_file:
+                    convergence_file.write(f'{experiment_name},{epochs_to_target(outfolder, experiment_name, dataset_file, args.target_cd, cuda_device)}\n')
 
-    
\ No newline at end of file
+    if len(jobs) > 0:
+        epochs = [ trained_epochs(outfolder, name) for name, _, _ in jobs ]
+        print(f'Trained {np.sum(epochs)} epochs out of {len(jobs) * exp_config["num_epochs"]} '
+              f'({100 * (1 - np.sum(epochs) / (len(jobs) * exp_config["num_epochs"])):.1f}% saved).')
+        print(f'Trained {len(jobs)} shapes with ensembles of {args.ensemble_size}: '
+              f'{len(jobs) / total_training_time * 3600:.2f} shapes per hour of training, '
+              f'{len(jobs) / (time.time() - start_time) * 3600:.2f} shapes per hour of wall clock.')
@@ -6,6 +6,7 @@ import open3d.core as o3c
 import argparse
 from src.model import SIREN
 from src.evaluate import evaluate
+from src.eigensolver import eigh3
 from PIL import Image
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
@@ -48,7 +49,9 @@ def generate_df( model_path, mesh_path, output_path, options ):
             hidden_layer_config=options['hidden_layer_nodes'],
             w0=options['weight0'],
             ww=None,
-            activation=options.get('activation', 'sine')
+            activation=options.get('activation', 'sine'),
+            fused_sine=options.get('fused_sine', False),
+            encoding=options.get('encoding', None)
     )
     model.load_state_dict( torch.load(model_path))
 
@@ -77,7 +80,7 @@ def generate_df( model_path, mesh_path, output_path, options ):
     pred_grad_norm = np.linalg.norm( gradients , axis=1 ).reshape((SAMPLES, 1))
 
     gradients = normalize(gradients)
-    eigenvalues, eigenvectors = torch.linalg.eigh( torch.from_numpy(hessians) )
+    eigenvalues, eigenvectors = eigh3( hessians )
     pred_normals = eigenvectors[..., 2].numpy()
 
     pred_normals = np.where(
@@ -5,6 +5,8 @@ import argparse
 import numpy as np
 import open3d as o3d
 import json
+import os.path as osp
+from src.profiling import make_profiler
 
 def generate_mc(model, gt_mode,device, N, output_path, alpha=None, algorithm='meshudf', from_file=None):
 
@@ -15,7 +17,9 @@ def generate_mc(model, gt_mode,device, N, output_path, alpha=None, algorithm='me
 			hidden_layer_config=from_file["hidden_layer_nodes"],
 			w0=from_file["w0"],
 			ww=None,
-			activation=from_file.get('activation','sine')
+			activation=from_file.get('activation','sine'),
+			fused_sine=from_file.get('fused_sine', False),
+			encoding=from_file.get('encoding', None)
 		)
 
 		model.load_state_dict( torch.load(from_file["model_path"]))
@@ -85,7 +89,9 @@ if __name__=='__main__':
 		n_out_features=1,
 		hidden_layer_config=config_dict["hidden_layer_nodes"],
 		w0=config_dict["w0"],
-		ww=None
+		ww=None,
+		fused_sine=config_dict.get('fused_sine', False),
+		encoding=config_dict.get('encoding', None)
 	)
 
 	model.load_state_dict( torch.load(config_dict["model_path"], map_location=device_torch))
@@ -93,5 +99,6 @@ if __name__=='__main__':
 
 	print('Generating mesh...')
 
-	generate_mc(model, config_dict['gt_mode'], device_torch, config_dict['nsamples'], config_dict['output_path'], config_dict['alpha'], algorithm=config_dict['algorithm'])
+	with make_profiler( config_dict.get('profile'), osp.dirname(config_dict['output_path']), 'generate_mc' ):
+		generate_mc(model, config_dict['gt_mode'], device_torch, config_dict['nsamples'], config_dict['output_path'], config_dict['alpha'], algorithm=config_dict['algorithm'])
 
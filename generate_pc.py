@@ -2,9 +2,11 @@ from src.render_pc import Sampler
 import json
 import open3d as o3d
 import argparse
+import os.path as osp
+from src.profiling import make_profiler
 
 def generate_pc( config ):
-        gen = Sampler( 3, checkpoint=config['model_path'], device=config['device'], w0=config['w0'], hidden_layers=config["hidden_layer_nodes"] )
+        gen = Sampler( 3, checkpoint=config['model_path'], device=config['device'], w0=config['w0'], hidden_layers=config["hidden_layer_nodes"], encoding=config.get('encoding', None), fused_sine=config.get('fused_sine', False), baked_path=config.get('baked_path', None) )
             
         points, normals = gen.generate_point_cloud(
             num_points=config['nsamples'], 
@@ -36,6 +38,7 @@ if __name__ == '__main__':
     with open(args.config_path) as config_file:
         config_dict = json.load(config_file)
 
-    point_cloud = generate_pc(config_dict)
+    with make_profiler( config_dict.get('profile'), osp.dirname(config_dict['output_path']), 'generate_pc' ):
+        point_cloud = generate_pc(config_dict)
     point_cloud.orient_normals_consistent_tangent_plane(10)
     o3d.t.io.write_point_cloud( config_dict['output_path'], point_cloud)
\ No newline at end of file
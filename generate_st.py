@@ -2,9 +2,13 @@ import torch
 import numpy as np
 from PIL import Image
 from src.model import SIREN
+from src.quantization import load_quantized_siren
+from src.baked import BakedUDF
 from src.render_st import create_projectional_image, create_projectional_image_gt
 import argparse
 import json
+import os.path as osp
+from src.profiling import make_profiler
 
 def get_pixels_camera( width, height, fov, noise ):
     image_x = np.arange(0, width)
@@ -113,17 +117,26 @@ def generate_st( config_dict ):
                 specular_comp=config_dict.get('specular', False))
         else:
             device_torch = torch.device(network_config["device"])
-            model = SIREN(
-                    n_in_features= 3,
-                    n_out_features=1,
-                    hidden_layer_config=network_config["hidden_layer_nodes"],
-                    w0=network_config["w0"],
-                    ww=None
-            )
-
-            model.load_state_dict( torch.load(network_config["model_path"], map_location=device_torch))
+            if network_config.get('baked_path') is not None:
+                # volume from bake.py instead of the network
+                model = BakedUDF.load( network_config['baked_path'], second_order=network_config['gt_mode'] != 'siren' )
+            else:
+                model = SIREN(
+                        n_in_features= 3,
+                        n_out_features=1,
+                        hidden_layer_config=network_config["hidden_layer_nodes"],
+                        w0=network_config["w0"],
+                        ww=None,
+                        fused_sine=network_config.get('fused_sine', False),
+                        encoding=network_config.get('encoding', None)
+                )
+                model.load_state_dict( torch.load(network_config["model_path"], map_location=device_torch))
             model.to(device_torch)
 
+            coarse_model = None
+            if network_config.get('quantized_model_path') is not None:
+                coarse_model = load_quantized_siren( network_config['quantized_model_path'], network_config )
+
             colores += create_projectional_image( 
                 model,
                 rays=ray_directions, 
@@ -131,7 +144,8 @@ def generate_st( config_dict ):
                 mask_rays=valid_rays,
                 network_config=network_config,
                 rendering_config=rendering_config,
-                device=device_torch
+                device=device_torch,
+                coarse_model=coarse_model
             )
 
         torch.cuda.empty_cache()
@@ -152,5 +166,6 @@ if __name__ == '__main__':
     with open(args.config_path) as config_file:
         config_dict = json.load(config_file)
 
-    im = generate_st(config_dict)
+    with make_profiler( config_dict.get('profile'), osp.dirname(config_dict["rendering_config"]["output_path"]), 'generate_st' ):
+        im = generate_st(config_dict)
     im.save(config_dict["rendering_config"]["output_path"], 'PNG')
\ No newline at end of file
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import copy
+import json
+import os
+import os.path as osp
+import random
+import numpy as np
+import torch
+from src.dataset import PointCloud
+from src.loss_functions import loss_s1
+from src.model import SIREN
+from src.util import load_experiment_parameters, unsigned_sampling
+import time
+
+
+def find_shapes( directory ):
+    """Dataset paths (without the '_pc.ply' and '_t.obj' suffixes) of every
+    preprocessed shape under `directory`.
+    """
+    shapes = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith('_pc.ply') and filename[:-7] + '_t.obj' in filenames:
+                shapes.append(osp.join(dirpath, filename[:-7]))
+    return sorted(shapes)
+
+
+def build_model( network_params ):
+    return SIREN(
+        n_in_features= 3,
+        n_out_features=1,
+        hidden_layer_config=network_params["hidden_layer_nodes"],
+        w0=network_params["w0"],
+        ww=network_params.get("ww", None),
+        activation= network_params.get('activation', 'sine'),
+        fused_sine=network_params.get('fused_sine', False),
+        encoding=network_params.get('encoding', None)
+    )
+
+
+def load_shape( shape, parameter_dict ):
+    return PointCloud(
+        meshPath= shape,
+        batchSize= parameter_dict["batch_size"],
+        samplingPercentiles=parameter_dict["sampling_percentiles"],
+        batchesPerEpoch = 1,
+        unsignedDistances = unsigned_sampling( parameter_dict )
+    )
+
+
+def fit( model, dataset, parameter_dict, steps, lr, device ):
+    """Trains `model` with the first step loss for `steps` batches of
+    `dataset`. Returns the loss of every step.
+    """
+    optim = torch.optim.Adam(lr=lr, params=model.parameters())
+    losses = []
+    while len(losses) < steps:
+        for input_data, normals, sdf, weights in iter(dataset):
+            optim.zero_grad()
+            loss = loss_s1(
+                model,
+                input_data.to(device),
+                {'normals': normals.to(device), 'sdf': sdf.to(device), 'weights': weights.to(device)},
+                parameter_dict["loss_s1_weights"],
+                parameter_dict["alpha"]
+            )
+            train_loss = torch.zeros((1, 1), device=device)
+            for l in loss.values():
+                train_loss += l
+            train_loss.backward()
+            optim.step()
+            losses.append(train_loss.item())
+
+    return losses[:steps]
+
+
+def reptile( datasets, model, parameter_dict, device, meta_iterations, inner_steps, inner_lr, meta_lr, meta_batch ):
+    """
+    Meta-learns an initialization of `model` with Reptile [1]: every
+    iteration, copies of the model are trained on `meta_batch` random shapes
+    for `inner_steps` steps, and the initialization moves towards the mean
+    of the trained weights. The outer step size decays linearly from
+    `meta_lr` to 0.
+
+    References
+    ----------
+    [1] Nichol, A., Achiam, J., & Schulman, J. (2018). On First-Order
+    Meta-Learning Algorithms. ArXiv. http://arxiv.org/abs/1803.02999
+    """
+    model.to(device)
+    for iteration in range(meta_iterations):
+        step_size = meta_lr * (1 - iteration / meta_iterations)
+        tasks = random.sample(range(len(datasets)), min(meta_batch, len(datasets)))
+
+        deltas = [ torch.zeros_like(p) for p in model.parameters() ]
+        task_losses = []
+        for task in tasks:
+            learner = copy.deepcopy(model)
+            losses = fit( learner, datasets[task], parameter_dict, inner_steps, inner_lr, device )
+            task_losses.append(losses[-1])
+
+            for delta, adapted, initial in zip(deltas, learner.parameters(), model.parameters()):
+                delta += adapted.detach() - initial.detach()
+
+        with torch.no_grad():
+            for p, delta in zip(model.parameters(), deltas):
+                p += step_size * delta / len(tasks)
+
+        print(f"Meta iteration: {iteration} - Inner loss: {np.mean(task_losses)} - Step size: {step_size:.3e}")
+
+    return model
+
+
+def epochs_to_quality( losses, target, window=10 ):
+    """First epoch at which the moving average of `losses` reaches
+    `target`, None if it never does.
+    """
+    smoothed = np.convolve(losses, np.ones(window) / window, mode='valid')
+    reached = np.flatnonzero(smoothed <= target)
+    return int(reached[0]) + window if len(reached) > 0 else None
+
+
+def evaluate_initialization( init_state, shapes, parameter_dict, device, epochs, lr, seed=123 ):
+    """
+    Trains every shape from the default initialization and from
+    `init_state` with the same batches, and counts the epochs each of them
+    needs to reach the final loss of the default initialization.
+    """
+    network_params = parameter_dict["network"]
+    results = []
+    for shape in shapes:
+        dataset = load_shape( shape, parameter_dict )
+
+        curves = {}
+        for name, state in [ ('default', None), ('meta', init_state) ]:
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            random.seed(seed)
+
+            model = build_model( network_params )
+            if state is not None:
+                model.load_state_dict(state)
+            model.to(device)
+            curves[name] = fit( model, dataset, parameter_dict, epochs, lr, device )
+
+        window = min(10, epochs)
+        target = np.mean(curves['default'][-window:])
+        result = {
+            'shape': shape,
+            'target_loss': float(target),
+            'default_epochs': epochs_to_quality( curves['default'], target, window ),
+            'meta_epochs': epochs_to_quality( curves['meta'], target, window ),
+            'default_final_loss': float(np.mean(curves['default'][-window:])),
+            'meta_final_loss': float(np.mean(curves['meta'][-window:]))
+        }
+        results.append(result)
+        print(f"{shape}: default initialization {result['default_epochs']} epochs, meta-learned {result['meta_epochs']} epochs")
+
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description='Meta-learn an initialization of SIREN over a directory of preprocessed shapes'
+    )
+    p.add_argument('experiment_path', type=str, help='train config, its network, sampling and first step loss are used')
+    p.add_argument('shapes', type=str, help='directory with preprocessed shapes (*_t.obj and *_pc.ply)')
+    p.add_argument('-o', '--output', type=str, default='results/meta_init/', help='output folder')
+    p.add_argument('-d', '--device', type=int, default=0, help='cuda device')
+    p.add_argument('--meta_iterations', type=int, default=1000, help='outer iterations')
+    p.add_argument('--meta_batch', type=int, default=4, help='shapes per outer iteration')
+    p.add_argument('--meta_lr', type=float, default=1.0, help='initial outer step size')
+    p.add_argument('--inner_steps', type=int, default=20, help='training steps per shape')
+    p.add_argument('--inner_lr', type=float, default=None, help='learning rate of the inner steps, warmup_lr of the config by default')
+    p.add_argument('--holdout', type=int, default=0, help='shapes left out of meta-training to compare against the default initialization')
+    p.add_argument('--eval_epochs', type=int, default=500, help='epochs of one batch trained for the comparison')
+    args = p.parse_args()
+
+    parameter_dict = load_experiment_parameters(args.experiment_path)
+    if not bool(parameter_dict):
+        raise ValueError("JSON experiment not found")
+    if parameter_dict["gt_mode"] != 'tanh':
+        raise ValueError('Meta-learning only supports the \'tanh\' ground truth mode.')
+
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    seed = 123
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    shapes = find_shapes(args.shapes)
+    random.shuffle(shapes)
+    heldout, shapes = shapes[:args.holdout], shapes[args.holdout:]
+    if len(shapes) == 0:
+        raise ValueError(f'No preprocessed shapes to meta-train on in {args.shapes}.')
+    print(f'Meta-training on {len(shapes)} shapes, {len(heldout)} held out.')
+
+    inner_lr = args.inner_lr if args.inner_lr is not None else parameter_dict.get('warmup_lr', 1e-4)
+    network_params = parameter_dict["network"]
+    model = build_model( network_params )
+
+    start_time = time.time()
+    reptile(
+        [ load_shape( shape, parameter_dict ) for shape in shapes ],
+        model,
+        parameter_dict,
+        device,
+        args.meta_iterations,
+        args.inner_steps,
+        inner_lr,
+        args.meta_lr,
+        args.meta_batch
+    )
+    meta_time = time.time() - start_time
+
+    os.makedirs(args.output, exist_ok=True)
+    init_path = osp.join(args.output, 'meta_init.pth')
+    torch.save(model.state_dict(), init_path)
+    # architecture of the weights, checked by train.py when they are used as pretrained_dict
+    with open(osp.join(args.output, 'meta_init.json'), 'w+') as fout:
+        json.dump({
+            'hidden_layer_nodes': network_params["hidden_layer_nodes"],
+            'w0': network_params["w0"],
+            'ww': network_params.get("ww", None),
+            'activation': network_params.get('activation', 'sine'),
+            'encoding': network_params.get('encoding', None),
+            'gt_mode': parameter_dict["gt_mode"],
+            'alpha': parameter_dict["alpha"],
+            'meta_iterations': args.meta_iterations,
+            'meta_batch': args.meta_batch,
+            'meta_lr': args.meta_lr,
+            'inner_steps': args.inner_steps,
+            'inner_lr': inner_lr,
+            'training_time': meta_time,
+            'shapes': shapes
+        }, fout, indent=4)
+    print(f'Saved to {init_path}')
+
+    if len(heldout) > 0:
+        results = evaluate_initialization(
+            model.state_dict(), heldout, parameter_dict, device, args.eval_epochs, parameter_dict.get('warmup_lr', 1e-4)
+        )
+        with open(osp.join(args.output, 'evaluation.json'), 'w+') as fout:
+            json.dump(results, fout, indent=4)
+
+        reached = [ r for r in results if r['meta_epochs'] is not None ]
+        if len(reached) > 0:
+            print(f"Meta-learned initialization reaches the quality of {args.eval_epochs} epochs from the default one in "
+                  f"{np.mean([ r['meta_epochs'] for r in reached ]):.0f} epochs on average ({len(reached)} of {len(results)} shapes).")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import json
+import os.path as osp
+import time
+import numpy as np
+import open3d as o3d
+import torch
+from src.inverses import inverse
+from src.model import SIREN
+from src.quantization import quantize_siren
+from src.util import load_experiment_parameters
+
+
+def distances( model, points, gt_mode, alpha, max_batch=64**2 ):
+    """Unsigned distances predicted by `model` at `points`, with the inverse
+    of the ground truth mode the renderers use, and the seconds it took.
+    """
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        outputs = torch.cat([ model(chunk)['model_out'] for chunk in torch.split(points, max_batch) ])
+    seconds = time.perf_counter() - start_time
+    return inverse( gt_mode, np.abs(outputs.squeeze(-1).numpy()), alpha ), seconds
+
+
+def error_report( model, quantized, surface_points, parameter_dict, sigmas, samples ):
+    """
+    Error of the distances of `quantized` against the ones of `model` at
+    points of the input point cloud displaced by gaussian noise of every
+    standard deviation in `sigmas`, and at uniform points of the domain.
+    Includes the time both take on the CPU.
+    """
+    generator = np.random.default_rng(123)
+    bands = [ (f'sigma_{sigma}', surface_points[generator.integers(0, len(surface_points), samples)] + generator.normal(0, sigma, (samples, 3)))
+              for sigma in sigmas ]
+    bands.append(( 'uniform', generator.uniform(-1, 1, (samples, 3)) ))
+
+    report = {}
+    for name, points in bands:
+        points = torch.from_numpy(points).float()
+        reference, float_seconds = distances( model, points, parameter_dict["gt_mode"], parameter_dict["alpha"] )
+        approximation, int8_seconds = distances( quantized, points, parameter_dict["gt_mode"], parameter_dict["alpha"] )
+
+        error = np.abs(approximation - reference)
+        report[name] = {
+            'mean_distance': float(np.mean(reference)),
+            'mean_abs_error': float(np.mean(error)),
+            'p99_abs_error': float(np.percentile(error, 99)),
+            'max_abs_error': float(np.max(error)),
+            'mean_relative_error': float(np.mean(error / np.maximum(reference, 1e-6))),
+            'float_points_per_second': samples / float_seconds,
+            'int8_points_per_second': samples / int8_seconds,
+            'speedup': float_seconds / int8_seconds
+        }
+        print(f"{name}: mean error {report[name]['mean_abs_error']:.3e}, max error {report[name]['max_abs_error']:.3e}, speedup {report[name]['speedup']:.2f}")
+
+    return report
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description='Export an int8 quantized copy of a trained SIREN for CPU inference, and report its error against the float model'
+    )
+    p.add_argument('experiment_path', type=str, help='train config of the network (e.g. params.json of the experiment)')
+    p.add_argument('model_path', type=str, help='trained weights')
+    p.add_argument('-o', '--output', type=str, default=None, help='path of the quantized weights, next to the trained ones by default')
+    p.add_argument('-s', '--sigmas', type=float, nargs='+', default=[0, 0.001, 0.01, 0.05], help='noise around the surface of every error band')
+    p.add_argument('-n', '--samples', type=int, default=100000, help='points per error band')
+    args = p.parse_args()
+
+    parameter_dict = load_experiment_parameters(args.experiment_path)
+    if not bool(parameter_dict):
+        raise ValueError("JSON experiment not found")
+    network_params = parameter_dict["network"]
+
+    model = SIREN(
+        n_in_features= 3,
+        n_out_features=1,
+        hidden_layer_config=network_params["hidden_layer_nodes"],
+        w0=network_params["w0"],
+        ww=network_params.get("ww", None),
+        delay_init=True,
+        activation=network_params.get('activation', 'sine'),
+        encoding=network_params.get('encoding', None)
+    )
+    model.load_state_dict( torch.load(args.model_path, map_location='cpu') )
+    model.eval()
+    quantized = quantize_siren( model )
+
+    output_path = args.output or osp.splitext(args.model_path)[0] + '_int8.pth'
+    torch.save(quantized.state_dict(), output_path)
+    print(f'Saved to {output_path}')
+
+    surface_points = np.asarray(o3d.io.read_point_cloud(parameter_dict["dataset"] + '_pc.ply').points)
+    report = error_report( model, quantized, surface_points, parameter_dict, args.sigmas, args.samples )
+
+    with open(osp.splitext(output_path)[0] + '.json', 'w+') as fout:
+        json.dump({
+            'model_path': args.model_path,
+            'quantized_model_path': output_path,
+            'float_size_mb': osp.getsize(args.model_path) / 2 ** 20,
+            'int8_size_mb': osp.getsize(output_path) / 2 ** 20,
+            'errors': report
+        }, fout, indent=4)
@@ -0,0 +1,159 @@
+# coding: utf-8
+
+import numpy as np
+import torch
+from torch import nn
+
+
+class _BakedLookup(torch.autograd.Function):
+    """Trilinear interpolation of the baked values whose gradient is the
+    trilinear interpolation of the baked gradients, instead of the
+    piecewise constant derivative of the interpolated values. The backward
+    pass returns the gradients interpolated in the forward pass; only with
+    `second_order` are they interpolated again, differentiably, so that
+    Hessians can be computed from them.
+    """
+    @staticmethod
+    def forward(ctx, x, volume, second_order):
+        ctx.volume = volume
+        ctx.second_order = second_order
+        interpolated = volume.interpolate(x)
+        ctx.save_for_backward(x, interpolated[..., 1:])
+        return interpolated[..., :1]
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        if not ctx.needs_input_grad[0]:
+            return None, None, None
+        x, gradients = ctx.saved_tensors
+        if ctx.second_order and torch.is_grad_enabled():
+            gradients = ctx.volume.interpolate(x)[..., 1:]
+        return grad_output * gradients, None, None
+
+
+class BakedUDF(nn.Module):
+    """Network output and gradient sampled on a sparse block grid, queried
+    with the interface of SIREN.
+
+    A coarse grid covers [-1, 1]^3 with `resolution / block_size` cells per
+    side, and blocks of `block_size` cells per side at the full
+    `resolution` are only stored where the surface is close. Every vertex
+    keeps the output of the network and its gradient. Queries interpolate
+    them trilinearly from the finest level that covers the point, so their
+    cost is a few memory reads and does not depend on the network.
+
+    Parameters
+    ----------
+    resolution: int
+        Cells per side of the fine level.
+
+    block_size: int
+        Cells per side of a block.
+
+    coarse: torch.Tensor
+        Output and gradient at the vertices of the coarse grid, of size
+        (R + 1)x(R + 1)x(R + 1)x4 with R = `resolution / block_size`.
+
+    block_index: torch.Tensor
+        Row of `blocks` of every coarse cell, -1 if it has no block. Size
+        RxRxR.
+
+    blocks: torch.Tensor
+        Output and gradient at the vertices of every block, of size
+        Kx(B + 1)x(B + 1)x(B + 1)x4 with B = `block_size`.
+
+    metadata: dict, optional
+        Information saved along the volume (ground truth mode, alpha,
+        error bounds, ...). Default value is None.
+
+    second_order: bool, optional
+        Whether the gradients can be differentiated again (for Hessians),
+        which interpolates them a second time in the backward pass. Default
+        value is False, the gradients of the forward pass are returned.
+    """
+    def __init__(self, resolution, block_size, coarse, block_index, blocks, metadata=None, second_order=False):
+        super().__init__()
+        self.resolution = resolution
+        self.block_size = block_size
+        self.coarse_resolution = resolution // block_size
+        self.metadata = metadata or {}
+        self.second_order = second_order
+
+        self.register_buffer('coarse', coarse)
+        self.register_buffer('block_index', block_index)
+        self.register_buffer('blocks', blocks)
+        self.register_buffer('corners', torch.tensor(
+            [ [i, j, k] for i in range(2) for j in range(2) for k in range(2) ]
+        ), persistent=False)
+
+    @classmethod
+    def load(cls, path, second_order=False):
+        """Volume saved by bake.py."""
+        data = np.load(path)
+        return cls(
+            int(data['resolution']),
+            int(data['block_size']),
+            torch.from_numpy(data['coarse']),
+            torch.from_numpy(data['block_index']).long(),
+            torch.from_numpy(data['blocks']),
+            { k: data[k].item() for k in data.files if data[k].ndim == 0 },
+            second_order
+        )
+
+    def _trilinear(self, position, resolution, fetch):
+        cell = torch.clamp(torch.floor(position).detach(), 0, resolution - 1)
+        t = position - cell
+        cell = cell.long()
+
+        result = 0
+        for corner in self.corners:
+            weight = torch.where(corner.bool(), t, 1 - t).prod(dim=-1, keepdim=True)
+            result = result + weight * fetch(cell + corner).float()
+        return result
+
+    def interpolate(self, x):
+        """Interpolated output and gradient at `x`, of size ...x4."""
+        position = ((x.reshape(-1, 3) + 1) / 2).clamp(0, 1)
+
+        result = self._trilinear(
+            position * self.coarse_resolution,
+            self.coarse_resolution,
+            lambda v: self.coarse[v[:, 0], v[:, 1], v[:, 2]]
+        )
+
+        cell = torch.clamp(torch.floor(position.detach() * self.resolution), 0, self.resolution - 1).long()
+        block = torch.div(cell, self.block_size, rounding_mode='floor')
+        ids = self.block_index[block[:, 0], block[:, 1], block[:, 2]]
+        inside = torch.nonzero(ids >= 0).flatten()
+        if len(inside) > 0:
+            ids, origin = ids[inside], block[inside] * self.block_size
+            fine = self._trilinear(
+                position[inside] * self.resolution,
+                self.resolution,
+                lambda v: self.blocks[ids, v[:, 0] - origin[:, 0], v[:, 1] - origin[:, 1], v[:, 2] - origin[:, 2]]
+            )
+            result = result.index_put((inside,), fine)
+
+        return result.reshape(*x.shape[:-1], 4)
+
+    def forward(self, x):
+        """Forward pass, same as SIREN.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The model input containing of size Nx3
+
+        Returns
+        -------
+        dict
+            Dictionary of tensors with the input coordinates under 'model_in'
+            and the interpolated output under 'model_out'.
+        """
+        coords_org = x.clone().detach().requires_grad_(True)
+        y = _BakedLookup.apply(coords_org, self, self.second_order)
+        return {"model_in": coords_org, "model_out": y}
+
+    def __repr__(self):
+        return (f"BakedUDF(resolution={self.resolution}, block_size={self.block_size}, "
+                f"blocks={self.blocks.shape[0]} of {self.block_index.numel()})")
@@ -0,0 +1,69 @@
+# coding: utf-8
+
+import numpy as np
+
+
+class PlateauDetector:
+    """Detects when an exponentially smoothed loss stops improving.
+
+    Parameters
+    ----------
+    smoothing: float, optional
+        Weight of the previous smoothed value in the exponential moving
+        average of the loss. Default value is 0.9.
+
+    patience: int, optional
+        Amount of consecutive updates without improvement after which the
+        loss is considered to have plateaued. Default value is 100.
+
+    min_delta: float, optional
+        Minimum relative decrease of the smoothed loss with respect to its
+        best value to count as an improvement. Default value is 1e-3.
+
+    min_updates: int, optional
+        Updates before a plateau can be reported at all. Default value is 0.
+    """
+    def __init__(self, smoothing=0.9, patience=100, min_delta=1e-3, min_updates=0):
+        self.smoothing = smoothing
+        self.patience = patience
+        self.min_delta = min_delta
+        self.min_updates = min_updates
+        self.reset()
+
+    def reset(self, min_updates=None):
+        if min_updates is not None:
+            self.min_updates = min_updates
+        self.smoothed = None
+        self.best = np.inf
+        self.updates = 0
+        self.wait = 0
+
+    def update(self, loss):
+        """Adds the loss of a new epoch. Returns True if the loss plateaued.
+        """
+        if self.smoothed is None:
+            self.smoothed = loss
+        else:
+            self.smoothed = self.smoothing * self.smoothed + (1 - self.smoothing) * loss
+
+        self.updates += 1
+        if self.best == np.inf or self.smoothed < self.best - self.min_delta * abs(self.best):
+            self.best = self.smoothed
+            self.wait = 0
+        else:
+            self.wait += 1
+
+        return self.updates >= self.min_updates and self.wait >= self.patience
+
+    def state_dict(self):
+        return {
+            'min_updates': self.min_updates,
+            'smoothed': self.smoothed,
+            'best': self.best,
+            'updates': self.updates,
+            'wait': self.wait
+        }
+
+    def load_state_dict(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
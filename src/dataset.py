@@ -2,7 +2,9 @@ import math
 import numpy as np
 import open3d as o3d
 import open3d.core as o3c
+import time
 import torch
+from scipy.spatial import cKDTree
 from torch.utils.data import IterableDataset
 
 def o3c_to_torch( tensor: o3c.Tensor ) -> torch.Tensor:
@@ -17,7 +19,23 @@ def sampleTrainingData(
         samplesOffSurface: int,
         scene,
         domainBounds: tuple = ([-1, -1, -1], [1, 1, 1]),
+        nearProbabilities: np.ndarray = None,
+        unsigned: bool = False,
 ):
+    """
+    Samples a training batch: points of the surface point cloud, points
+    uniformly distributed in the domain and points close to the surface.
+    Close points are drawn around uniformly chosen surface points, unless
+    `nearProbabilities` gives the probability of choosing each point of the
+    point cloud. Each sample then gets an importance weight, so that the
+    weighted mean of any per-sample loss is an unbiased estimate of its mean
+    under uniform sampling.
+
+    With `unsigned`, distances are queried without the inside / outside
+    test, which is meaningless for open meshes and not needed by losses
+    that only look at the absolute distance.
+    """
+    distance = scene.compute_distance if unsigned else scene.compute_signed_distance
     
     surfaceSamples = surface_pc.select_by_index( 
         o3c.Tensor.from_numpy( np.random.randint(0, len(surface_pc.point['positions']), samplesOnSurface) )
@@ -32,12 +50,18 @@ def sampleTrainingData(
         (samplesFar, 3)
     ), dtype=o3c.Dtype.Float32)
 
-    domainSDFs = torch.from_numpy(scene.compute_signed_distance(domainPoints).numpy())
+    domainSDFs = torch.from_numpy(distance(domainPoints).numpy())
     domainPoints = o3c_to_torch( domainPoints )
 
-    surfacePointsSubset = surfaceSamples.select_by_index( 
-        o3c.Tensor.from_numpy( np.random.randint(0, samplesOnSurface, (samplesNear,1)) )
-    )
+    if nearProbabilities is None:
+        surfacePointsSubset = surfaceSamples.select_by_index( 
+            o3c.Tensor.from_numpy( np.random.randint(0, samplesOnSurface, (samplesNear,1)) )
+        )
+        nearWeights = torch.ones(samplesNear)
+    else:
+        nearIndices = np.random.choice(len(nearProbabilities), (samplesNear,1), p=nearProbabilities)
+        surfacePointsSubset = surface_pc.select_by_index( o3c.Tensor.from_numpy( nearIndices ) )
+        nearWeights = torch.from_numpy( 1 / (len(nearProbabilities) * nearProbabilities[nearIndices[:,0]]) ).float()
 
     surfacePointsSubsetNormals = o3c_to_torch( surfacePointsSubset.point['normals'] ).squeeze(1)
     surfacePointsSubset = o3c_to_torch( surfacePointsSubset.point['positions'] ).squeeze(1)
@@ -47,7 +71,7 @@ def sampleTrainingData(
 
     closePoints = ( surfacePointsSubset + surfacePointsSubsetNormals * torch.normal(0, 0.01, (samplesNear, 1) ) )
 
-    closeSDFs = o3c_to_torch( scene.compute_signed_distance( torch_to_o3c(closePoints).to( o3c.Dtype.Float32 ) ) )
+    closeSDFs = o3c_to_torch( distance( torch_to_o3c(closePoints).to( o3c.Dtype.Float32 ) ) )
 
     domainNormals = torch.zeros((samplesOffSurface, 3))
 
@@ -66,20 +90,236 @@ def sampleTrainingData(
         domainSDFs,
         closeSDFs
     )).unsqueeze(1)
+    fullWeights = torch.cat((
+        torch.ones(samplesOnSurface + samplesFar),
+        nearWeights
+    )).unsqueeze(1)
+
+    return fullSamples.float().unsqueeze(0), fullNormals.float().unsqueeze(0), fullSDFs.float().unsqueeze(0), fullWeights.float().unsqueeze(0)
+
+def sampleSurfaceData( surface_pc: o3d.t.geometry.PointCloud, samplesOnSurface: int ):
+    """
+    Samples a batch of points of the surface point cloud only, in the same
+    format as sampleTrainingData. Their distance is 0 and the distance
+    queries of the other samples are skipped.
+    """
+    surfaceSamples = surface_pc.select_by_index( 
+        o3c.Tensor.from_numpy( np.random.randint(0, len(surface_pc.point['positions']), samplesOnSurface) )
+    )
+
+    surfaceNormals = o3c_to_torch( surfaceSamples.point['normals'] )
+    surfacePoints = o3c_to_torch( surfaceSamples.point['positions'] )
+
+    return (
+        surfacePoints.float().unsqueeze(0),
+        surfaceNormals.float().unsqueeze(0),
+        torch.zeros((1, samplesOnSurface, 1)),
+        torch.ones((1, samplesOnSurface, 1))
+    )
+
+def buildSampleBank(
+        surface_pc: o3d.t.geometry.PointCloud,
+        scene,
+        samples: int,
+        unsigned: bool = False
+):
+    """
+    Precomputes `samples` off surface samples with their distances, half of
+    them uniformly distributed in the domain and half close to the surface,
+    as drawn by sampleTrainingData.
+    """
+    points, _, sdf, _ = sampleTrainingData(
+        surface_pc=surface_pc,
+        samplesOnSurface=samples,
+        samplesOffSurface=samples,
+        scene=scene,
+        unsigned=unsigned
+    )
+    samplesFar = samples // 2
+    return {
+        'far_points': points[0, samples:samples + samplesFar].contiguous(),
+        'far_sdf': sdf[0, samples:samples + samplesFar].contiguous(),
+        'near_points': points[0, samples + samplesFar:].contiguous(),
+        'near_sdf': sdf[0, samples + samplesFar:].contiguous()
+    }
+
+def sampleBankData(
+        surface_pc: o3d.t.geometry.PointCloud,
+        bank: dict,
+        samplesOnSurface: int,
+        samplesOffSurface: int
+):
+    """
+    Samples a training batch in the format of sampleTrainingData, taking
+    the off surface samples from a bank built by buildSampleBank instead of
+    querying distances.
+    """
+    surfaceSamples = surface_pc.select_by_index( 
+        o3c.Tensor.from_numpy( np.random.randint(0, len(surface_pc.point['positions']), samplesOnSurface) )
+    )
+
+    samplesFar = samplesOffSurface // 2
+    samplesNear = samplesOffSurface - samplesFar
+    farIndices = torch.from_numpy( np.random.randint(0, len(bank['far_points']), samplesFar) )
+    nearIndices = torch.from_numpy( np.random.randint(0, len(bank['near_points']), samplesNear) )
+
+    fullSamples = torch.row_stack((
+        o3c_to_torch( surfaceSamples.point['positions'] ),
+        bank['far_points'][farIndices],
+        bank['near_points'][nearIndices]
+    ))
+    fullNormals = torch.row_stack((
+        o3c_to_torch( surfaceSamples.point['normals'] ),
+        torch.zeros((samplesOffSurface, 3))
+    ))
+    fullSDFs = torch.cat((
+        torch.zeros((samplesOnSurface, 1)),
+        bank['far_sdf'][farIndices],
+        bank['near_sdf'][nearIndices]
+    ))
+
+    return (
+        fullSamples.float().unsqueeze(0),
+        fullNormals.float().unsqueeze(0),
+        fullSDFs.float().unsqueeze(0),
+        torch.ones((1, samplesOnSurface + samplesOffSurface, 1))
+    )
+
+class ErrorGrid:
+    """Running estimate of the training error in each cell of a regular grid
+    over the domain.
+
+    Parameters
+    ----------
+    resolution: int, optional
+        Cells per axis. Default value is 16.
+
+    decay: float, optional
+        Weight of the previous estimate of a cell when it receives new
+        residuals. Default value is 0.9.
+    """
+    def __init__(self, resolution=16, decay=0.9, domainBounds=([-1, -1, -1], [1, 1, 1])):
+        self.resolution = resolution
+        self.decay = decay
+        self.lower = np.array(domainBounds[0], dtype=np.float64)
+        self.size = np.array(domainBounds[1], dtype=np.float64) - self.lower
+        self.errors = np.zeros(resolution ** 3)
+        self.seen = np.zeros(resolution ** 3, dtype=bool)
+
+    def cells(self, points):
+        ijk = np.clip( ((points - self.lower) / self.size * self.resolution).astype(np.int64), 0, self.resolution - 1 )
+        return (ijk[:,0] * self.resolution + ijk[:,1]) * self.resolution + ijk[:,2]
+
+    def update(self, points, residuals):
+        cells = self.cells(points)
+        sums = np.bincount(cells, weights=residuals, minlength=len(self.errors))
+        counts = np.bincount(cells, minlength=len(self.errors))
+        touched = counts > 0
+
+        means = sums[touched] / counts[touched]
+        self.errors[touched] = np.where(
+            self.seen[touched],
+            self.decay * self.errors[touched] + (1 - self.decay) * means,
+            means
+        )
+        self.seen |= touched
+
+class KDTreeDistance:
+    """Approximate unsigned distance to the surface sampled by a point cloud
+    with normals, with the compute_distance interface of
+    o3d.t.geometry.RaycastingScene, for shapes without a mesh.
+
+    Let p be the closest point of the cloud to a query q, n its normal, and h
+    the sampling radius of the cloud (the distance from any point of the
+    surface to its closest sample). The distance d from q to the surface
+    lies in [ |q - p| - h, |q - p| ]. Close to the surface the distance to the
+    tangent plane at p is much more accurate, so the estimate is
+
+        max( |(q - p) . n|, |q - p| - h )
+
+    which always lies in that interval, and is therefore within h of d
+    wherever the surface is sampled at least that densely. When h is
+    estimated from the cloud this is not a guarantee: the estimate is a
+    percentile of the spacing, so a small part of the surface may be further
+    from every sample, and nothing bounds the error over holes of the scan.
+
+    Parameters
+    ----------
+    points: np.ndarray
+        Positions of the point cloud, of shape Nx3.
 
-    return fullSamples.float().unsqueeze(0), fullNormals.float().unsqueeze(0), fullSDFs.float().unsqueeze(0)
+    normals: np.ndarray
+        Unit normals of the point cloud, of shape Nx3.
+
+    samplingRadius: float, optional
+        The sampling radius h. Default value is None, meaning that it is
+        estimated as the 99th percentile of the distance from a point of the
+        cloud to its closest neighbour, a statistical estimate that about 1%
+        of the spacings exceed.
+
+    workers: int, optional
+        Threads used for queries, -1 uses all of them. Default value is -1.
+    """
+    def __init__(self, points, normals, samplingRadius=None, workers=-1):
+        start_time = time.time()
+        self.points = np.asarray(points, dtype=np.float32)
+        # copied, the caller's arrays may be views of an Open3D point cloud
+        self.normals = np.array(normals, dtype=np.float32, copy=True)
+        self.normals /= np.maximum(np.linalg.norm(self.normals, axis=-1, keepdims=True), 1e-12)
+        self.workers = workers
+        # unbalanced trees without shrunk nodes build several times faster,
+        # and queries barely notice on surface samples
+        self.tree = cKDTree(self.points, leafsize=32, balanced_tree=False, compact_nodes=False)
+
+        if samplingRadius is None:
+            subset = self.points[np.random.randint(0, len(self.points), min(len(self.points), 100000))]
+            spacing, _ = self.tree.query(subset, k=2, workers=workers)
+            samplingRadius = float(np.percentile(spacing[:, 1], 99))
+        self.samplingRadius = samplingRadius
+
+        print(f"Built KD-tree over {len(self.points)} points in {time.time() - start_time:.2f} s, estimated sampling radius {self.samplingRadius:.2e}.")
+
+    def compute_distance(self, queries: o3c.Tensor) -> o3c.Tensor:
+        queries = queries.numpy()
+        pointDistances, closest = self.tree.query(queries, k=1, workers=self.workers)
+        planeDistances = np.abs(np.sum((queries - self.points[closest]) * self.normals[closest], axis=-1))
+
+        return o3c.Tensor(np.maximum(planeDistances, pointDistances - self.samplingRadius).astype(np.float32))
 
 class PointCloud(IterableDataset):
     def __init__(self, meshPath: str,
                  batchSize: int,
                  samplingPercentiles: list,
-                 batchesPerEpoch : int ):
+                 batchesPerEpoch : int,
+                 adaptiveSampling: dict = None,
+                 unsignedDistances: bool = False,
+                 pointCloudOnly: bool = False,
+                 sharedData: dict = None ):
         super().__init__()
 
-        print(f"Loading mesh \"{meshPath}\".")
+        self.sampleBank = None
+        if sharedData is not None:
+            # built by another process with share(), nothing to read or query
+            print(f"Using shared point cloud and sample bank of \"{meshPath}\".")
+            if adaptiveSampling is not None:
+                raise ValueError('Adaptive sampling needs distance queries, it can not use a sample bank.')
+            self.mesh = None
+            self.surface_pc = o3d.t.geometry.PointCloud()
+            self.surface_pc.point['positions'] = torch_to_o3c( sharedData['positions'] )
+            self.surface_pc.point['normals'] = torch_to_o3c( sharedData['normals'] )
+            self.sampleBank = sharedData['bank']
+            unsignedDistances = sharedData['unsigned']
+        elif pointCloudOnly:
+            print(f"Loading point cloud \"{meshPath}\".")
+            self.mesh = None
+            self.surface_pc = o3d.t.io.read_point_cloud(meshPath if meshPath.endswith('.ply') else meshPath + '_pc.ply')
+            if 'normals' not in self.surface_pc.point:
+                raise ValueError(f'Point cloud "{meshPath}" has no normals.')
+        else:
+            print(f"Loading mesh \"{meshPath}\".")
 
-        self.mesh = o3d.t.io.read_triangle_mesh(meshPath + '_t.obj')
-        self.surface_pc = o3d.t.io.read_point_cloud(meshPath + '_pc.ply')
+            self.mesh = o3d.t.io.read_triangle_mesh(meshPath + '_t.obj')
+            self.surface_pc = o3d.t.io.read_point_cloud(meshPath + '_pc.ply')
 
         self.batchSize = batchSize
         self.samplesOnSurface = int(self.batchSize * samplingPercentiles[0])
@@ -89,16 +329,119 @@ class PointCloud(IterableDataset):
         print(f"Fetching {self.samplesFarSurface} far from surface points per iteration.")
 
         self.batchesPerEpoch = batchesPerEpoch
+        self.surfaceOnly = False
+
+        # without a mesh there is no inside or outside
+        self.unsignedDistances = unsignedDistances or pointCloudOnly
+        if self.unsignedDistances:
+            print("Querying unsigned distances.")
+
+        if self.sampleBank is not None:
+            self.scene = None
+        elif pointCloudOnly:
+            print("Creating point-cloud and acceleration structures.")
+            self.scene = KDTreeDistance(
+                self.surface_pc.point['positions'].numpy(),
+                self.surface_pc.point['normals'].numpy()
+            )
+        else:
+            print("Creating point-cloud and acceleration structures.")
+            self.scene = o3d.t.geometry.RaycastingScene()
+            self.scene.add_triangles(self.mesh)
 
-        print("Creating point-cloud and acceleration structures.")
-        self.scene = o3d.t.geometry.RaycastingScene()
-        self.scene.add_triangles(self.mesh)
+        # Close to surface points are drawn around surface points chosen with
+        # a probability that grows with the error of the region they lie in.
+        self.errorGrid = None
+        self.nearProbabilities = None
+        if adaptiveSampling is not None:
+            print("Sampling close to surface points by training error.")
+            self.errorGrid = ErrorGrid(
+                resolution=adaptiveSampling.get('resolution', 16),
+                decay=adaptiveSampling.get('decay', 0.9)
+            )
+            self.mixing = adaptiveSampling.get('mixing', 0.5)
+            self.surfaceCells = self.errorGrid.cells( self.surface_pc.point['positions'].numpy() )
+
+    def update_errors(self, points, residuals):
+        """Adds the residuals of the model at `points` to the error estimate
+        and updates the probabilities of the close to surface samples. Half
+        uniform and half proportional to error by default, which bounds the
+        importance weights by 1 / (1 - mixing).
+        """
+        self.errorGrid.update(points, residuals)
+        errors = self.errorGrid.errors[self.surfaceCells]
+        if np.sum(errors) <= 0:
+            return
+
+        uniform = np.full(len(errors), 1 / len(errors))
+        self.nearProbabilities = (1 - self.mixing) * uniform + self.mixing * errors / np.sum(errors)
+        self.nearProbabilities /= np.sum(self.nearProbabilities)
+
+    def sampling_state(self):
+        """Error estimate and close to surface probabilities of adaptive
+        sampling, to resume it exactly. None without adaptive sampling.
+        """
+        if self.errorGrid is None:
+            return None
+        return {
+            'errors': self.errorGrid.errors.copy(),
+            'seen': self.errorGrid.seen.copy(),
+            'nearProbabilities': None if self.nearProbabilities is None else self.nearProbabilities.copy()
+        }
+
+    def load_sampling_state(self, state):
+        """Restores the state returned by `sampling_state`."""
+        if state is None or self.errorGrid is None:
+            return
+        self.errorGrid.errors = state['errors'].copy()
+        self.errorGrid.seen = state['seen'].copy()
+        self.nearProbabilities = None if state['nearProbabilities'] is None else state['nearProbabilities'].copy()
         
+    def share(self, bankSamples):
+        """Surface point cloud and a bank of `bankSamples` off surface
+        samples with their distances, in shared memory. Other processes can
+        pass them as `sharedData` to use this shape without reading its files,
+        building acceleration structures or querying distances.
+        """
+        bank = buildSampleBank( self.surface_pc, self.scene, bankSamples, self.unsignedDistances )
+        return {
+            'positions': o3c_to_torch( self.surface_pc.point['positions'] ).float().clone().share_memory_(),
+            'normals': o3c_to_torch( self.surface_pc.point['normals'] ).float().clone().share_memory_(),
+            'bank': { k: v.share_memory_() for k, v in bank.items() },
+            'unsigned': self.unsignedDistances
+        }
+
+    def sample_surface_only(self, samplesOnSurface):
+        """From now on, batches only hold `samplesOnSurface` points of the
+        surface, the only ones the second step loss looks at.
+        """
+        print(f"Fetching only {samplesOnSurface} on-surface points per iteration.")
+        self.surfaceOnly = True
+        self.samplesOnSurface = samplesOnSurface
+
     def __iter__(self):
         for _ in range(self.batchesPerEpoch):
+            if self.surfaceOnly:
+                yield sampleSurfaceData(
+                    surface_pc=self.surface_pc,
+                    samplesOnSurface=self.samplesOnSurface
+                )
+                continue
+
+            if self.sampleBank is not None:
+                yield sampleBankData(
+                    surface_pc=self.surface_pc,
+                    bank=self.sampleBank,
+                    samplesOnSurface=self.samplesOnSurface,
+                    samplesOffSurface=self.samplesFarSurface
+                )
+                continue
+
             yield sampleTrainingData(
                 surface_pc=self.surface_pc,
                 samplesOnSurface=self.samplesOnSurface,
                 samplesOffSurface=self.samplesFarSurface,
-                scene=self.scene
+                scene=self.scene,
+                nearProbabilities=self.nearProbabilities,
+                unsigned=self.unsignedDistances
             )
\ No newline at end of file
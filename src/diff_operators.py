@@ -3,6 +3,7 @@ from torch.autograd import grad
 import itertools
 
 import numpy as np
+from src.eigensolver import eigh3
 
 def gaussian_curvature(grad, hess):
     ''' curvature of a implicit surface (https://en.wikipedia.org/wiki/Gaussian_curvature#Alternative_formulas).
@@ -184,13 +185,17 @@ def gauss_bonnet_integral(grad,hess):
 #         status = -1
 #     return h.squeeze(2), status
 
-def hessian(y, x):
-    g = gradient(y, x).squeeze(0)
-    h0 = gradient(g[:,0], x).squeeze(0)[:,None,:]
-    h1 = gradient(g[:,1], x).squeeze(0)[:,None,:]
-    h2 = gradient(g[:,2], x).squeeze(0)[:,None,:]
-    h = torch.cat((h0,h1,h2), dim=1)
-    return h.unsqueeze(0)
+def hessian(y, x, g=None):
+    ''' hessian of y wrt x
+    y: shape (batch, num_observations) or (batch, num_observations, 1)
+    x: shape (batch, num_observations, 3)
+    g: gradient of y wrt x if already computed, shape (batch, num_observations, 3)
+    returns: shape (batch, num_observations, 3, 3)
+    '''
+    if g is None:
+        g = gradient(y, x)
+    h = torch.stack([ gradient(g[..., i], x) for i in range(g.shape[-1]) ], dim=-2)
+    return h
 
 
 def laplace(y, x):
@@ -227,5 +232,56 @@ def jacobian(y, x):
     return jac, status
 
 
-
-
+class DerivativeContext:
+    """Derivatives of the output of one forward pass with respect to its
+    input. Each of them is computed the first time it is asked for and kept,
+    so loss terms sharing a forward pass share the same graph nodes: the
+    Hessian is built from the stored gradient and the eigendecomposition
+    from the stored Hessian.
+
+    Parameters
+    ----------
+    y: torch.Tensor
+        Model output, of shape (batch, num_observations, 1).
+
+    x: torch.Tensor
+        Model input it was computed from, of shape (batch, num_observations, 3).
+    """
+    def __init__(self, y, x):
+        self.y = y
+        self.x = x
+        self._gradient = None
+        self._gradient_norm = None
+        self._hessian = None
+        self._eigh = None
+
+    @classmethod
+    def from_output(cls, model_output):
+        return cls(model_output['model_out'], model_output['model_in'])
+
+    @property
+    def gradient(self):
+        if self._gradient is None:
+            self._gradient = gradient(self.y, self.x)
+        return self._gradient
+
+    @property
+    def gradient_norm(self):
+        if self._gradient_norm is None:
+            self._gradient_norm = torch.linalg.norm(self.gradient, dim=-1)
+        return self._gradient_norm
+
+    @property
+    def hessian(self):
+        if self._hessian is None:
+            self._hessian = hessian(self.y, self.x, self.gradient)
+        return self._hessian
+
+    @property
+    def eigh(self):
+        """Eigenvalues in ascending order and eigenvectors (as columns) of the
+        Hessians, see src.eigensolver.eigh3.
+        """
+        if self._eigh is None:
+            self._eigh = eigh3(self.hessian)
+        return self._eigh
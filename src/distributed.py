@@ -0,0 +1,59 @@
+# coding: utf-8
+
+import os
+import torch
+import torch.distributed as dist
+import torch.distributed.nn.functional as dist_fn
+
+
+def init_distributed( rank, world_size, backend='gloo' ):
+    """Joins the process group of a single-machine data-parallel run.
+    """
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+    # processes share the machine, avoid oversubscribing its cores
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+
+def broadcast_parameters( model, src=0 ):
+    """Copies the parameters of rank `src` to every other rank.
+    """
+    for param in model.parameters():
+        dist.broadcast(param.data, src=src)
+
+
+def average_gradients( model ):
+    """All-reduces the gradients of the model in a single flat buffer and
+    divides them by the amount of processes. Every rank holds the mean of
+    the per-shard losses, which with equally sized shards is the loss of the
+    full batch.
+    """
+    grads = [ p.grad for p in model.parameters() if p.grad is not None ]
+    flat = torch.cat([ g.reshape(-1) for g in grads ])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def average_loss_terms( loss ):
+    """Averages the values of a dictionary of loss terms across ranks, for
+    logging purposes only: the returned tensors carry no graph.
+    """
+    names = list(loss.keys())
+    values = torch.stack([ loss[name].detach().reshape(-1)[0] for name in names ])
+    dist.all_reduce(values)
+    values /= dist.get_world_size()
+    return { name: values[i].reshape(1) for i, name in enumerate(names) }
+
+
+def all_reduce_sum( tensor ):
+    """Differentiable sum across ranks. Used to compute statistics over the
+    whole batch when every rank only holds a shard of it.
+    """
+    return dist_fn.all_reduce(tensor)
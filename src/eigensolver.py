@@ -0,0 +1,123 @@
+# coding: utf-8
+
+import numpy as np
+import torch
+
+
+def _rows_cross( m ):
+    """Normalized cross product of the pair of rows of each 3x3 matrix with
+    the largest norm, together with that squared norm. For a rank 2 matrix
+    this spans its null space.
+    """
+    crosses = torch.stack([
+        torch.cross(m[..., 0, :], m[..., 1, :], dim=-1),
+        torch.cross(m[..., 0, :], m[..., 2, :], dim=-1),
+        torch.cross(m[..., 1, :], m[..., 2, :], dim=-1)
+    ], dim=-2)
+    norms = torch.sum(crosses ** 2, dim=-1)
+    best = torch.argmax(norms, dim=-1, keepdim=True)
+
+    vector = torch.gather(crosses, -2, best[..., None].expand(*best.shape, 3)).squeeze(-2)
+    norm = torch.gather(norms, -1, best)
+    return vector / torch.sqrt(torch.clamp(norm, min=1e-36)), norm.squeeze(-1)
+
+
+def _rayleigh( m, v ):
+    return torch.sum(v * (m @ v[..., None]).squeeze(-1), dim=-1)
+
+
+def eigh3( matrices, fallback_threshold=1e-20 ):
+    """Eigenvalues and eigenvectors of a batch of real symmetric 3x3
+    matrices, with the same conventions as torch.linalg.eigh: eigenvalues in
+    ascending order and eigenvectors as the columns of the second output, so
+    that [..., 2] is the direction of the largest eigenvalue.
+
+    Eigenvalues are found in closed form with the trigonometric solution of
+    the characteristic cubic. The eigenvector of the eigenvalue farthest
+    from the other two comes from the cross product of two rows of
+    A - lambda I, and the remaining two from the 2x2 problem on the plane
+    orthogonal to it, so that repeated eigenvalues still get an orthonormal
+    basis. Matrices where that cross product vanishes numerically (multiples
+    of the identity) are solved with torch.linalg.eigh instead.
+
+    Computations are done in float32 and every operation is differentiable.
+
+    Parameters
+    ----------
+    matrices: torch.Tensor or np.ndarray
+        Symmetric matrices of shape (..., 3, 3). Only their symmetric part
+        is used.
+
+    fallback_threshold: float, optional
+        Squared norm of the cross product under which a matrix is solved by
+        torch.linalg.eigh. Default value is 1e-20.
+
+    Returns
+    -------
+    eigenvalues: torch.Tensor
+        Shape (..., 3), ascending.
+
+    eigenvectors: torch.Tensor
+        Shape (..., 3, 3), orthonormal columns.
+    """
+    if isinstance(matrices, np.ndarray):
+        matrices = torch.from_numpy(matrices)
+    matrices = matrices.float()
+    matrices = (matrices + matrices.transpose(-1, -2)) / 2
+    eye = torch.eye(3, dtype=matrices.dtype, device=matrices.device)
+
+    # shifting by the mean eigenvalue and scaling leaves the eigenvectors as
+    # they are and keeps the spread of the eigenvalues around 1
+    shift = torch.diagonal(matrices, dim1=-2, dim2=-1).sum(dim=-1) / 3
+    centered = matrices - shift[..., None, None] * eye
+    scale = torch.amax(torch.abs(centered), dim=(-2, -1))
+    scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+    d = centered / scale[..., None, None]
+
+    # trigonometric roots of det(d - lambda I) = 0, trace(d) is 0
+    p = torch.sqrt(torch.clamp(torch.sum(d ** 2, dim=(-2, -1)) / 6, min=1e-36))
+    b = d / p[..., None, None]
+    det = torch.sum(b[..., 0, :] * torch.cross(b[..., 1, :], b[..., 2, :], dim=-1), dim=-1)
+    phi = torch.acos(torch.clamp(det / 2, -1 + 1e-6, 1 - 1e-6)) / 3
+    largest = 2 * p * torch.cos(phi)
+    smallest = 2 * p * torch.cos(phi + 2 * np.pi / 3)
+    middle = -largest - smallest
+
+    # eigenvector of the most isolated eigenvalue
+    top_isolated = (largest - middle) >= (middle - smallest)
+    isolated_value = torch.where(top_isolated, largest, smallest)
+    isolated, cross_norm = _rows_cross(d - isolated_value[..., None, None] * eye)
+
+    # orthonormal basis (u, w) of the plane orthogonal to it
+    axis = torch.nn.functional.one_hot(torch.argmin(torch.abs(isolated), dim=-1), 3).to(d.dtype)
+    u = torch.cross(isolated, axis, dim=-1)
+    u = u / torch.sqrt(torch.clamp(torch.sum(u ** 2, dim=-1, keepdim=True), min=1e-36))
+    w = torch.cross(isolated, u, dim=-1)
+
+    # 2x2 symmetric problem on that plane, rotation angle of its eigenvectors
+    du = (d @ u[..., None]).squeeze(-1)
+    a = torch.sum(u * du, dim=-1)
+    c = _rayleigh(d, w)
+    off = torch.sum(w * du, dim=-1)
+    y, x = 2 * off, a - c
+    degenerate = (torch.abs(x) + torch.abs(y)) < 1e-18
+    theta = torch.atan2(y, torch.where(degenerate, torch.ones_like(x), x)) / 2
+    cos, sin = torch.cos(theta)[..., None], torch.sin(theta)[..., None]
+    upper = cos * u + sin * w
+    lower = cos * w - sin * u
+
+    top = top_isolated[..., None, None]
+    eigenvectors = torch.where(
+        top,
+        torch.stack([lower, upper, isolated], dim=-1),
+        torch.stack([isolated, lower, upper], dim=-1)
+    )
+    eigenvalues = torch.stack([ _rayleigh(d, eigenvectors[..., i]) for i in range(3) ], dim=-1)
+    eigenvalues = eigenvalues * scale[..., None] + shift[..., None]
+
+    fallback = (cross_norm < fallback_threshold) & torch.isfinite(matrices).all(dim=-1).all(dim=-1)
+    if torch.any(fallback):
+        eigenvalues, eigenvectors = eigenvalues.clone(), eigenvectors.clone()
+        eigenvalues[fallback], eigenvectors[fallback] = torch.linalg.eigh(matrices[fallback])
+
+    return eigenvalues, eigenvectors
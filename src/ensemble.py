@@ -0,0 +1,73 @@
+# coding: utf-8
+
+import copy
+from collections import OrderedDict
+import torch
+from torch import nn
+
+
+class EnsembleSIREN(nn.Module):
+    """Stack of K independent SIRENs evaluated with batched matrix products.
+
+    Every layer of the K networks is stored as a single (K, in, out) weight
+    and (K, 1, out) bias tensor, so one forward pass evaluates all the
+    networks at once through `torch.baddbmm`. The networks do not share any
+    parameter: the gradient of the sum of their losses with respect to the
+    slice k of a stacked tensor is the gradient of the k-th loss alone, and
+    element-wise optimizers like Adam update every network exactly as if it
+    was trained on its own.
+
+    Parameters
+    ----------
+    models: list[SIREN]
+        Networks to stack. All of them must share the same architecture.
+    """
+    def __init__(self, models):
+        super().__init__()
+        self.n_models = len(models)
+
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        activations = []
+        for i, block in enumerate(models[0].net):
+            linears = [ model.net[i][0] for model in models ]
+            self.weights.append(nn.Parameter(
+                torch.stack([ l.weight.detach().transpose(0, 1) for l in linears ]).contiguous()
+            ))
+            self.biases.append(nn.Parameter(
+                torch.stack([ l.bias.detach() for l in linears ]).unsqueeze(1).contiguous()
+            ))
+            activations.append(copy.deepcopy(block[1]) if len(block) > 1 else nn.Identity())
+
+        self.activations = nn.ModuleList(activations)
+
+    def forward(self, x):
+        """Forward pass of the ensemble.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The model input of size KxNx3, where row k is fed to network k.
+
+        Returns
+        -------
+        dict
+            Dictionary of tensors with the input coordinates under 'model_in'
+            and the KxNx1 model output under 'model_out'.
+        """
+        coords_org = x.clone().detach().requires_grad_(True)
+        y = coords_org
+        for weight, bias, activation in zip(self.weights, self.biases, self.activations):
+            y = activation(torch.baddbmm(bias, y, weight))
+
+        return {"model_in": coords_org, "model_out": y}
+
+    def model_state_dict(self, k):
+        """State dict of the k-th network, loadable by a `SIREN` with the
+        same architecture.
+        """
+        state = OrderedDict()
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            state[f"net.{i}.0.weight"] = weight[k].detach().transpose(0, 1).clone()
+            state[f"net.{i}.0.bias"] = bias[k, 0].detach().clone()
+        return state
@@ -1,6 +1,6 @@
 import torch
 import numpy as np
-from src.diff_operators import gradient, hessian
+from src.diff_operators import DerivativeContext
 
 def evaluate( model, samples, latent_vec=torch.Tensor([[]]), max_batch=64**2, output_size=1, device=torch.device(0), gradients=None, hessians=None ):
     # samples = ( amount_samples, 3 )    
@@ -24,12 +24,13 @@ def evaluate( model, samples, latent_vec=torch.Tensor([[]]), max_batch=64**2, ou
         inputs_subset = inputs_subset.to(device).unsqueeze(0)
 
         x, y =  model(inputs_subset).values()
+        derivatives = DerivativeContext(y, x)
 
         if gradients is not None:
-            gradients[head:min(head + max_batch, amount_samples)] = gradient(y,x).squeeze(0).detach().cpu().numpy()[..., feature_length:]
+            gradients[head:min(head + max_batch, amount_samples)] = derivatives.gradient.squeeze(0).detach().cpu().numpy()[..., feature_length:]
 
         if hessians is not None:
-            hessians[head:min(head + max_batch, amount_samples)] = hessian(y,x)[0].squeeze(0).detach().cpu().numpy()[..., feature_length:, feature_length:]
+            hessians[head:min(head + max_batch, amount_samples)] = derivatives.hessian[0].squeeze(0).detach().cpu().numpy()[..., feature_length:, feature_length:]
     
         evaluations[head:min(head + max_batch, amount_samples)] = y.squeeze(0).detach().cpu()
         head += max_batch
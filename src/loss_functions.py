@@ -3,6 +3,7 @@
 import torch
 import torch.nn.functional as F
 import src.diff_operators as dif
+from src.timing import timer
 import numpy as np
 
 
@@ -43,7 +44,7 @@ def off_surface_without_sdf_constraint(gt_sdf, pred_sdf, radius=1e2):
         )
 
 def principal_curvature_alignment( udf, gt_vectors, pred_normals ): # hessians, alpha ):
-    surface_points_mask = torch.flatten(udf == 0)
+    surface_points_mask = (udf == 0).squeeze(-1)
 
     return torch.where(
         surface_points_mask,
@@ -53,12 +54,12 @@ def principal_curvature_alignment( udf, gt_vectors, pred_normals ): # hessians,
     )
 
 
-def total_variation(  alpha, udf, gradient, coords ):
+def total_variation(  alpha, udf, derivatives ):
     f = 1 - torch.tanh(alpha * udf) ** 2
     return torch.where(
         udf != 0,
         torch.abs( 
-            torch.linalg.norm( dif.gradient( torch.linalg.norm(gradient, dim=-1), coords ), dim=-1 )[...,None] - 
+            torch.linalg.norm( dif.gradient( derivatives.gradient_norm, derivatives.x ), dim=-1 )[...,None] - 
             2 * alpha * torch.abs(f - udf * torch.tanh(alpha * udf) * f)
         ),
         torch.zeros_like(udf)
@@ -69,18 +70,28 @@ def grad_consistency( model, coords, gt_normals, alpha ):
     samples = coords + gt_normals * steps
 
     model_output = model(samples)
-    gradients = dif.gradient(model_output['model_out'], model_output['model_in'])
+    derivatives = dif.DerivativeContext.from_output(model_output)
+    gradients = derivatives.gradient
 
     tan = torch.tanh(alpha * torch.abs(steps))
 
     return (
         1 - F.cosine_similarity( F.normalize(gradients, dim=-1), gt_normals * torch.sign(steps) ,dim=-1 ), 
         torch.abs(model_output['model_out'] - steps * tan),
-        torch.abs( torch.linalg.norm(gradients.squeeze(0), dim=-1) - torch.abs( tan + torch.abs(steps) * alpha * (1 - tan ** 2) ).squeeze(-1) )
+        torch.abs( derivatives.gradient_norm.squeeze(0) - torch.abs( tan + torch.abs(steps) * alpha * (1 - tan ** 2) ).squeeze(-1) )
     )
 
+def model_mean( x ):
+    """
+    Mean over every dimension except the leading one, so that a batch
+    holding several independent models (see src/ensemble.py) yields one
+    value per model. For a single model it returns a tensor of shape (1,).
+    """
+    return x.reshape(x.shape[0], -1).mean(dim=-1)
+
 def loss_siren( model, model_input, gt,  loss_weights ):
-    model_output = model(model_input)
+    with timer.section('forward'):
+        model_output = model(model_input)
 
     gt_sdf = gt['sdf']
     gt_normals = gt['normals']
@@ -88,23 +99,42 @@ def loss_siren( model, model_input, gt,  loss_weights ):
     coords = model_output['model_in']
     pred_sdf = model_output['model_out']
 
-    gradient = dif.gradient(pred_sdf, coords).squeeze(0)
+    with timer.section('gradient'):
+        gradient = dif.DerivativeContext(pred_sdf, coords).gradient.squeeze(0)
 
-    off_surf_constraint = torch.where(
-        gt_sdf != 0,
-        torch.exp(-1e2 * torch.abs(pred_sdf)),
-        torch.zeros_like(gt_sdf)
-    )
+    loss = {}
+    with timer.section('sdf_on_surf'):
+        loss['sdf_on_surf'] = sdf_constraint_on_surf(gt_sdf, pred_sdf).mean() * loss_weights[0]
 
-    return {
-        'sdf_on_surf': sdf_constraint_on_surf(gt_sdf, pred_sdf).mean() * loss_weights[0],
-        'sdf_off_surf': off_surf_constraint.mean() * loss_weights[1],
-        'normal_constraint': vector_aligment_on_surf(gt_sdf, gt_normals, gradient).mean() * loss_weights[2] ,
-        'grad_constraint': eikonal_constraint(gradient).unsqueeze(-1).mean() * loss_weights[3]
-    }
+    with timer.section('sdf_off_surf'):
+        off_surf_constraint = torch.where(
+            gt_sdf != 0,
+            torch.exp(-1e2 * torch.abs(pred_sdf)),
+            torch.zeros_like(gt_sdf)
+        )
+        loss['sdf_off_surf'] = off_surf_constraint.mean() * loss_weights[1]
+
+    with timer.section('normal_constraint'):
+        loss['normal_constraint'] = vector_aligment_on_surf(gt_sdf, gt_normals, gradient).mean() * loss_weights[2]
+
+    with timer.section('grad_constraint'):
+        loss['grad_constraint'] = eikonal_constraint(gradient).unsqueeze(-1).mean() * loss_weights[3]
+
+    return loss
 
-def loss_s2( model, model_input, gt, loss_weights, alpha ):
-    model_output = model(model_input)
+def surface_statistics( surface_sdf, reduce_fn ):
+    """
+    Mean and (unbiased) standard deviation of values split in shards, where
+    reduce_fn sums a tensor across every shard.
+    """
+    count = reduce_fn( surface_sdf.new_tensor(float(surface_sdf.numel())) )
+    mean = reduce_fn( surface_sdf.sum() ) / count
+    std = torch.sqrt( reduce_fn( ((surface_sdf - mean) ** 2).sum() ) / (count - 1) )
+    return mean, std
+
+def loss_s2( model, model_input, gt, loss_weights, alpha, reduce_fn=None ):
+    with timer.section('forward'):
+        model_output = model(model_input)
     
     udf = gt['sdf']
     gt_normals = gt['normals']
@@ -112,44 +142,143 @@ def loss_s2( model, model_input, gt, loss_weights, alpha ):
     coords = model_output['model_in']
     pred_sdf = model_output['model_out']
 
-    std_on_surf = torch.std( pred_sdf[udf == 0])
-    mean_on_surf = torch.abs( torch.mean( pred_sdf[udf == 0]))
+    surface_sdf = [ p[m] for p, m in zip(pred_sdf, udf == 0) ]
+    if reduce_fn is None:
+        with timer.section('std_on_surf'):
+            std_on_surf = torch.stack([ torch.std( s ) for s in surface_sdf ])
+        with timer.section('sdf_on_surf'):
+            mean_on_surf = torch.abs( torch.stack([ torch.mean( s ) for s in surface_sdf ]))
+    else:
+        # the batch is sharded, statistics are taken over all of the shards
+        with timer.section('surface_statistics'):
+            statistics = [ surface_statistics( s, reduce_fn ) for s in surface_sdf ]
+        std_on_surf = torch.stack([ std for _, std in statistics ])
+        mean_on_surf = torch.abs( torch.stack([ mean for mean, _ in statistics ]))
 
     return {
         'sdf_on_surf': mean_on_surf * loss_weights[0],
         'std_on_surf': std_on_surf * loss_weights[1]
     }
 
-def loss_s1( model, model_input, gt, loss_weights, alpha ):
-    model_output = model(model_input)
-    
+def surface_split( udf ):
+    """
+    Mask of the on surface samples of each model of the batch, or None when
+    models have a different amount of them (or none, or only them) and the
+    batch can not be split in two regular blocks.
+    """
+    surface = udf[..., 0] == 0
+    counts = surface.sum(dim=-1)
+    if not bool(torch.all(counts == counts[0])) or counts[0] == 0 or counts[0] == surface.shape[-1]:
+        return None
+    return surface
+
+# order of the terms of loss_s1 in its weights
+S1_TERMS = ['sdf_on_surf', 'sdf_off_surf', 'hessian_constraint', 'grad_constraint']
+
+def lazy_weights( loss_weights, step, interval, terms=('hessian_constraint',) ):
+    """
+    Weights of loss_s1 for lazy regularization: the given terms are only
+    evaluated every `interval` steps, with their weight multiplied by
+    `interval` so that on average they contribute the same gradient. On the
+    other steps their weight is 0 and loss_s1 skips them.
+    """
+    if interval <= 1:
+        return loss_weights
+
+    scale = interval if step % interval == 0 else 0
+    return [ w * scale if name in terms else w for name, w in zip(S1_TERMS, loss_weights) ]
+
+def loss_s1( model, model_input, gt, loss_weights, alpha, surface_subset=True, residuals=None ):
+    """
+    With `surface_subset`, on and off surface samples are evaluated in two
+    separate forward passes, so that Hessians and their eigenvectors are
+    only computed for the on surface samples, the only ones the principal
+    direction term looks at. Values are scattered back in batch order and
+    the loss is the same as evaluating the whole batch at once.
+
+    If a list is given as `residuals`, the per sample errors of s1_residuals
+    are appended to it (detached), from the same forward pass.
+    """
     udf = gt['sdf']
     gt_normals = gt['normals']
+    surface = surface_split( udf ) if surface_subset and loss_weights[2] != 0 else None
 
-    coords = model_output['model_in']
-    pred_sdf = model_output['model_out']
     tan = torch.tanh( alpha * udf )
     tdf = udf * tan
 
-    if loss_weights[3] != 0:
-        gradient = dif.gradient(pred_sdf, coords)
-        grad_constraint = torch.abs(torch.linalg.norm(gradient.squeeze(0), dim=-1) - torch.abs( tan + udf * alpha * (1 - tan ** 2)).squeeze(-1))
-    else:
-        grad_constraint = torch.Tensor([0]).to(coords.device)
+    with timer.section('forward'):
+        if surface is None:
+            model_output = model(model_input)
+            derivatives = dif.DerivativeContext.from_output(model_output)
+
+            coords = model_output['model_in']
+            pred_sdf = model_output['model_out']
+        else:
+            n_models = model_input.shape[0]
+            surface_output = model(model_input[surface].view(n_models, -1, model_input.shape[-1]))
+            off_output = model(model_input[~surface].view(n_models, -1, model_input.shape[-1]))
+            surface_derivatives = dif.DerivativeContext.from_output(surface_output)
+            off_derivatives = dif.DerivativeContext.from_output(off_output)
+
+            coords = surface_output['model_in']
+            pred_sdf = torch.empty_like(udf)
+            pred_sdf[surface] = surface_output['model_out'].reshape(-1, 1)
+            pred_sdf[~surface] = off_output['model_out'].reshape(-1, 1)
+
+    with timer.section('grad_constraint'):
+        if loss_weights[3] != 0:
+            if surface is None:
+                gradient_norm = derivatives.gradient_norm
+            else:
+                gradient_norm = torch.empty_like(udf[..., 0])
+                gradient_norm[surface] = surface_derivatives.gradient_norm.reshape(-1)
+                gradient_norm[~surface] = off_derivatives.gradient_norm.reshape(-1)
+
+            grad_constraint = torch.abs(gradient_norm - torch.abs( tan + udf * alpha * (1 - tan ** 2)).squeeze(-1))
+        else:
+            grad_constraint = torch.Tensor([0]).to(coords.device)
     
-    if loss_weights[2] != 0:
-        hessians = dif.hessian(pred_sdf.squeeze(-1), coords)
-        eigenvalues, eigenvectors = torch.linalg.eigh( hessians )
-        pred_normals = eigenvectors[..., 2]
+    with timer.section('hessian_constraint'):
+        if loss_weights[2] != 0 and surface is None:
+            eigenvalues, eigenvectors = derivatives.eigh
+            pred_normals = eigenvectors[..., 2]
 
-        principal_direction_constraint = principal_curvature_alignment( udf, gt_normals, pred_normals )
-    else:
-        principal_direction_constraint=torch.Tensor([0]).to(coords.device)
+            principal_direction_constraint = principal_curvature_alignment( udf, gt_normals, pred_normals )
+        elif loss_weights[2] != 0:
+            # Hessians of the on surface samples only, reusing their gradients
+            eigenvalues, eigenvectors = surface_derivatives.eigh
+            pred_normals = eigenvectors[..., 2]
 
+            principal_direction_constraint = torch.zeros_like(udf[..., 0])
+            principal_direction_constraint[surface] = (
+                1 - torch.abs(F.cosine_similarity(gt_normals[surface], pred_normals.reshape(-1, 3), dim=-1))
+            )
+        else:
+            principal_direction_constraint=torch.Tensor([0]).to(coords.device)
 
-    return {
-        'sdf_on_surf': sdf_constraint_on_surf(udf, pred_sdf).mean() * loss_weights[0],
-        'sdf_off_surf': sdf_constraint_off_surf( udf, tdf, pred_sdf ).mean() * loss_weights[1],
-        'hessian_constraint': principal_direction_constraint.mean() * loss_weights[2],
-        'grad_constraint': grad_constraint.mean() * loss_weights[3]
-    }
\ No newline at end of file
+
+    if residuals is not None:
+        residuals.append( torch.abs( pred_sdf - tdf ).detach() )
+
+    # importance weights of the samples, see sampleTrainingData
+    weights = gt.get('weights', torch.ones_like(udf))
+
+    loss = {}
+    with timer.section('sdf_on_surf'):
+        loss['sdf_on_surf'] = model_mean( sdf_constraint_on_surf(udf, pred_sdf) * weights ) * loss_weights[0]
+    with timer.section('sdf_off_surf'):
+        loss['sdf_off_surf'] = model_mean( sdf_constraint_off_surf( udf, tdf, pred_sdf ) * weights ) * loss_weights[1]
+    loss['hessian_constraint'] = model_mean( principal_direction_constraint * weights.squeeze(-1) ) * loss_weights[2]
+    loss['grad_constraint'] = model_mean( grad_constraint * weights.squeeze(-1) ) * loss_weights[3]
+
+    return loss
+
+@torch.no_grad()
+def s1_residuals( model, model_input, gt, alpha ):
+    """
+    Per sample absolute error of the model with respect to the hyperbolic
+    scaled distance of loss_s1.
+    """
+    pred_sdf = model(model_input)['model_out']
+    udf = gt['sdf']
+    return torch.abs( pred_sdf - udf * torch.tanh( alpha * udf ) )
\ No newline at end of file
@@ -0,0 +1,76 @@
+# coding: utf-8
+
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from generate_mc import generate_mc
+
+
+def _mesh_checkpoint( kwargs ):
+    generate_mc( model=None, **kwargs )
+    return kwargs['output_path']
+
+
+class CheckpointMesher:
+    """Reconstructs meshes of saved checkpoints in background processes, so
+    that training does not wait for marching cubes.
+
+    Parameters
+    ----------
+    workers: int, optional
+        Amount of processes meshing at the same time. Default value is 1.
+
+    max_pending: int, optional
+        Maximum amount of checkpoints submitted and not yet meshed. When
+        reached, `submit` blocks until the oldest one finishes. Default value
+        is twice the amount of workers.
+    """
+    def __init__(self, workers=1, max_pending=None):
+        # CUDA can not be initialized again in forked processes
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.max_pending = max_pending if max_pending is not None else 2 * workers
+        self.pending = []
+
+    def _collect(self, future):
+        try:
+            print(f'Saved checkpoint mesh {future.result()}')
+        except Exception as e:
+            print(f'Checkpoint mesh failed: {e!r}')
+
+    def submit(self, model_path, network_params, **kwargs):
+        """Queues a call to generate_mc on the weights stored at `model_path`.
+        Keyword arguments are passed to generate_mc. Returns the seconds spent
+        waiting for a free slot.
+        """
+        start_time = time.time()
+        still_pending = []
+        for future in self.pending:
+            if future.done():
+                self._collect(future)
+            else:
+                still_pending.append(future)
+        self.pending = still_pending
+
+        while len(self.pending) >= self.max_pending:
+            self._collect(self.pending.pop(0))
+
+        kwargs['from_file'] = {
+            'model_path': model_path,
+            'w0': network_params['w0'],
+            'hidden_layer_nodes': network_params['hidden_layer_nodes'],
+            'activation': network_params.get('activation', 'sine'),
+            'fused_sine': network_params.get('fused_sine', False),
+            'encoding': network_params.get('encoding', None)
+        }
+        self.pending.append(self.executor.submit(_mesh_checkpoint, kwargs))
+        return time.time() - start_time
+
+    def close(self):
+        """Waits for every queued checkpoint. Returns the seconds waited.
+        """
+        start_time = time.time()
+        for future in self.pending:
+            self._collect(future)
+        self.pending = []
+        self.executor.shutdown(wait=True)
+        return time.time() - start_time
@@ -0,0 +1,109 @@
+# coding: utf-8
+
+import math
+import torch
+import torch.distributed as dist
+
+
+def split_batch( model_input, gt, chunks ):
+    """Splits a batch of shape (1, N, ...) in `chunks` interleaved
+    micro-batches, so that each of them keeps the proportions of on surface,
+    far and close samples of the batch.
+    """
+    for i in range(chunks):
+        yield model_input[:, i::chunks], { k: v[:, i::chunks] for k, v in gt.items() }
+
+
+def estimate_chunks( compute_loss, model_input, gt, memory_budget_mb, safety_factor=2.0, probe_size=2048 ):
+    """
+    Amount of micro-batches needed for the tensors that autograd keeps for
+    the backward pass of `compute_loss` to fit in `memory_budget_mb`. They
+    are measured on a strided probe of the batch and scaled linearly, and
+    `safety_factor` leaves room for the temporaries of the backward pass
+    itself.
+    """
+    n_samples = model_input.shape[1]
+    stride = max(1, n_samples // probe_size)
+    probe_input, probe_gt = model_input[:, ::stride], { k: v[:, ::stride] for k, v in gt.items() }
+
+    saved_bytes = 0
+    def pack( tensor ):
+        nonlocal saved_bytes
+        saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        compute_loss(probe_input, probe_gt)
+
+    bytes_per_sample = safety_factor * saved_bytes / probe_input.shape[1]
+    micro_batch = max(1, int(memory_budget_mb * 2 ** 20 / bytes_per_sample))
+    return math.ceil(n_samples / micro_batch)
+
+
+def accumulate_gradients( compute_loss, model_input, gt, chunks ):
+    """
+    Backpropagates a loss whose terms are means over the samples of the
+    batch, one micro-batch at a time. Every micro-batch is weighted by its
+    share of the samples, so gradients and returned (detached) terms are
+    the ones of the whole batch.
+    """
+    n_samples = model_input.shape[1]
+    loss = dict()
+    for micro_input, micro_gt in split_batch( model_input, gt, chunks ):
+        share = micro_input.shape[1] / n_samples
+        micro_loss = compute_loss(micro_input, micro_gt)
+
+        train_loss = 0
+        for it, l in micro_loss.items():
+            train_loss = train_loss + l
+            loss[it] = loss.get(it, 0) + l.detach() * share
+        (train_loss.sum() * share).backward()
+
+    return loss
+
+
+def accumulate_gradients_s2( model, model_input, gt, loss_weights, chunks, reduce_fn=None ):
+    """
+    Backpropagates loss_s2 one micro-batch at a time. Mean and standard
+    deviation of the on surface predictions depend on the whole batch, so a
+    first pass without gradients computes them, and a second one
+    backpropagates a surrogate that is linear in the predictions with the
+    gradient of loss_s2:
+
+        d(w0 |mean| + w1 std) / dp = w0 sign(mean) / n + w1 (p - mean) / ((n - 1) std)
+
+    With `reduce_fn` the batch is sharded and statistics cover every shard.
+    Returns the (detached) loss terms.
+    """
+    with torch.no_grad():
+        surface_sdf = [
+            model(micro_input)['model_out'][micro_gt['sdf'] == 0]
+            for micro_input, micro_gt in split_batch( model_input, gt, chunks )
+        ]
+        values = torch.cat(surface_sdf)
+        count = values.new_tensor(float(values.numel()))
+        total = values.sum()
+        if reduce_fn is not None:
+            count, total = reduce_fn(count), reduce_fn(total)
+        mean = total / count
+
+        squares = ((values - mean) ** 2).sum()
+        if reduce_fn is not None:
+            squares = reduce_fn(squares)
+        std = torch.sqrt(squares / (count - 1))
+
+    # gradients get averaged across ranks afterwards, but every rank holds
+    # the gradient of the loss of the whole batch wrt its own samples only
+    scale = dist.get_world_size() if reduce_fn is not None else 1
+    for (micro_input, micro_gt), pred in zip(split_batch( model_input, gt, chunks ), surface_sdf):
+        coefficients = scale * (
+            loss_weights[0] * torch.sign(mean) / count +
+            loss_weights[1] * (pred - mean) / ((count - 1) * std)
+        )
+        micro_pred = model(micro_input)['model_out'][micro_gt['sdf'] == 0]
+        (micro_pred * coefficients).sum().backward()
+
+    return {
+        'sdf_on_surf': torch.abs(mean).reshape(1) * loss_weights[0],
+        'std_on_surf': std.reshape(1) * loss_weights[1]
+    }
@@ -1,5 +1,6 @@
 # coding: utf-8
 
+import functools
 import torch
 from torch import nn
 import numpy as np
@@ -45,6 +46,222 @@ class ReLuLayer(nn.Module):
     def __repr__(self):
         return f"ReLuLayer(w0={self.w0})"
 
+def _detached(tensors, needs_grad):
+    return tuple( t.detach().requires_grad_(bool(needs)) for t, needs in zip(tensors, needs_grad) )
+
+
+def _block_outputs(block, x):
+    return (block(x),)
+
+
+def _vjp(fn, params, needs_grad, create_graph, *tensors):
+    """Products of the cotangents at the end of `tensors` with the Jacobian
+    of `fn` with respect to the inputs at the start of `tensors` and
+    `params`, only for those flagged in `needs_grad`.
+    """
+    n_inputs = len(needs_grad) - len(params)
+    inputs, cotangents = tensors[:n_inputs], tensors[n_inputs:]
+    outputs = fn(*inputs)
+
+    targets = [ t for t, needs in zip([*inputs, *params], needs_grad) if needs ]
+    pairs = [ (y, c) for y, c in zip(outputs, cotangents) if y.requires_grad ]
+    grads = torch.autograd.grad(
+        [ y for y, _ in pairs ], targets, [ c for _, c in pairs ], create_graph=create_graph, allow_unused=True
+    ) if len(pairs) > 0 and len(targets) > 0 else [ None ] * len(targets)
+    return tuple( torch.zeros_like(t) if g is None else g for g, t in zip(grads, targets) )
+
+
+class _Checkpointed(torch.autograd.Function):
+    """Evaluates `fn` on the first `n_inputs` tensors, which may also read
+    the remaining ones (leaf parameters), keeping only its inputs and not
+    its intermediate activations. `fn` is evaluated again when gradients are
+    needed. When they must be differentiable (for Hessians and the losses
+    on them) they are the output of another `_Checkpointed` node on the
+    product with the Jacobian of `fn`, so no derivative order holds the
+    activations of the blocks either.
+    """
+    @staticmethod
+    def forward(ctx, fn, n_inputs, *tensors):
+        inputs = tensors[:n_inputs]
+        ctx.fn = fn
+        ctx.params = tensors[n_inputs:]
+        ctx.save_for_backward(*inputs)
+
+        with torch.enable_grad():
+            outputs = fn(*_detached(inputs, ctx.needs_input_grad[2:]))
+        return tuple( y.detach() for y in outputs )
+
+    @staticmethod
+    def backward(ctx, *cotangents):
+        inputs = ctx.saved_tensors
+        needs_grad = ctx.needs_input_grad[2:]
+
+        if torch.is_grad_enabled():
+            vjp = functools.partial(_vjp, ctx.fn, ctx.params, needs_grad, True)
+            grads = iter(_Checkpointed.apply(vjp, len(inputs) + len(cotangents), *inputs, *cotangents, *ctx.params))
+        else:
+            with torch.enable_grad():
+                grads = iter(_vjp(ctx.fn, ctx.params, needs_grad, False, *_detached(inputs, needs_grad), *cotangents))
+
+        return (None, None, *( next(grads) if needs else None for needs in needs_grad ))
+
+
+class _SineDerivative(torch.autograd.Function):
+    """grad * w0 * cos(w0 z), the backward of a sine layer, in a single node
+    that only keeps `grad` and `z`. Its own backward is written with regular
+    operations, so it can be differentiated any number of times.
+    """
+    @staticmethod
+    def forward(ctx, grad, z, w0):
+        ctx.w0 = w0
+        ctx.save_for_backward(grad, z)
+        return grad * (w0 * torch.cos(w0 * z))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad, z = ctx.saved_tensors
+        w0 = ctx.w0
+        grad_grad = grad_z = None
+        if ctx.needs_input_grad[0]:
+            grad_grad = grad_output * (w0 * torch.cos(w0 * z))
+        if ctx.needs_input_grad[1]:
+            grad_z = -grad_output * grad * (w0 * w0 * torch.sin(w0 * z))
+        return grad_grad, grad_z, None
+
+
+class _SineLinear(torch.autograd.Function):
+    """sin(w0 (x W^T + b)) as a single autograd node. Only the input, the
+    weight and the pre-activation z are kept, both sine and cosine follow
+    from z. z is also returned so that, when this node is differentiated
+    again (for Hessians), it is connected to x, W and b through this same
+    node instead of being recomputed.
+    """
+    @staticmethod
+    def forward(ctx, x, weight, bias, w0):
+        z = torch.addmm(bias, x.reshape(-1, x.shape[-1]), weight.t()).reshape(*x.shape[:-1], -1)
+        ctx.w0 = w0
+        ctx.set_materialize_grads(False)
+        ctx.save_for_backward(x, weight, z)
+        return torch.sin(w0 * z), z
+
+    @staticmethod
+    def backward(ctx, grad_y, grad_z):
+        x, weight, z = ctx.saved_tensors
+        if grad_y is not None:
+            grad_sine = _SineDerivative.apply(grad_y, z, ctx.w0)
+            grad_z = grad_sine if grad_z is None else grad_z + grad_sine
+        if grad_z is None:
+            return None, None, None, None
+
+        grad_x = grad_z @ weight if ctx.needs_input_grad[0] else None
+        grad_z = grad_z.reshape(-1, grad_z.shape[-1])
+        grad_weight = grad_z.t() @ x.reshape(-1, x.shape[-1]) if ctx.needs_input_grad[1] else None
+        grad_bias = grad_z.sum(dim=0) if ctx.needs_input_grad[2] else None
+        return grad_x, grad_weight, grad_bias, None
+
+
+class HashGridEncoding(nn.Module):
+    """Multiresolution hash grid encoding of 3D points, as in [3].
+
+    Trainable feature vectors are stored at the vertices of `n_levels` grids
+    over [-1, 1]^3, from `base_resolution` to `max_resolution` cells per
+    side. Grids with fewer vertices than the table are indexed densely and
+    finer ones through a spatial hash. A point is encoded by interpolating
+    the features of the 8 vertices of its cell at every level and
+    concatenating them, along with the point itself. Interpolation weights
+    use a smoothstep instead of linear ramps, so the gradient of the encoding
+    is continuous and the second order terms of the first training step are
+    not zero inside cells.
+
+    Parameters
+    ----------
+    n_levels: int, optional
+        Number of grids. Default value is 16.
+
+    features_per_level: int, optional
+        Features stored at every vertex. Default value is 2.
+
+    log2_hashmap_size: int, optional
+        Base 2 logarithm of the maximum amount of vertices of a grid. A
+        value large enough for every grid gives a dense feature grid.
+        Default value is 19.
+
+    base_resolution: int, optional
+        Cells per side of the coarsest grid. Default value is 16.
+
+    max_resolution: int, optional
+        Cells per side of the finest grid. Default value is 2048.
+
+    include_input: boolean, optional
+        Concatenate the point to its features. Default value is True.
+
+    References
+    ----------
+    [3] Müller, T., Evans, A., Schied, C., & Keller, A. (2022). Instant
+    Neural Graphics Primitives with a Multiresolution Hash Encoding. ArXiv.
+    http://arxiv.org/abs/2201.05989
+    """
+    PRIMES = (1, 2654435761, 805459861)
+
+    def __init__(self, n_levels=16, features_per_level=2, log2_hashmap_size=19,
+                 base_resolution=16, max_resolution=2048, include_input=True):
+        super().__init__()
+        self.n_levels = n_levels
+        self.features_per_level = features_per_level
+        self.include_input = include_input
+        self.n_output_dims = n_levels * features_per_level + (3 if include_input else 0)
+
+        growth = np.exp((np.log(max_resolution) - np.log(base_resolution)) / max(n_levels - 1, 1))
+        resolutions = np.floor(base_resolution * growth ** np.arange(n_levels)).astype(np.int64)
+        sizes = np.minimum((resolutions + 1) ** 3, 2 ** log2_hashmap_size)
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+        self.register_buffer('resolutions', torch.from_numpy(resolutions), persistent=False)
+        self.register_buffer('sizes', torch.from_numpy(sizes), persistent=False)
+        self.register_buffer('offsets', torch.from_numpy(offsets), persistent=False)
+        self.register_buffer('dense', torch.from_numpy((resolutions + 1) ** 3 <= sizes), persistent=False)
+        self.register_buffer('primes', torch.tensor(self.PRIMES), persistent=False)
+        self.register_buffer('corners', torch.tensor(
+            [ [i, j, k] for i in range(2) for j in range(2) for k in range(2) ]
+        ), persistent=False)
+
+        self.embeddings = nn.Parameter(torch.empty(int(sizes.sum()), features_per_level).uniform_(-1e-4, 1e-4))
+
+    def _index(self, vertices):
+        """Row of the embedding table of every vertex, vertices are LxNx3."""
+        side = (self.resolutions + 1)[:, None]
+        dense = vertices[..., 0] + side * (vertices[..., 1] + side * vertices[..., 2])
+
+        hashed = vertices * self.primes
+        hashed = torch.bitwise_xor(torch.bitwise_xor(hashed[..., 0], hashed[..., 1]), hashed[..., 2])
+
+        index = torch.where(self.dense[:, None], dense, hashed) % self.sizes[:, None]
+        return index + self.offsets[:, None]
+
+    def forward(self, x):
+        # grid coordinates of the points at every level, LxNx3
+        resolutions = self.resolutions[:, None, None]
+        position = ((x.reshape(-1, 3) + 1) / 2).clamp(0, 1)[None] * resolutions
+        cell = torch.minimum(torch.floor(position).detach(), resolutions - 1)
+        t = position - cell
+        t = t * t * (3 - 2 * t)
+        cell = cell.long()
+
+        features = 0
+        for corner in self.corners:
+            weight = torch.where(corner.bool(), t, 1 - t).prod(dim=-1, keepdim=True)
+            features = features + weight * self.embeddings[self._index(cell + corner)]
+
+        features = features.permute(1, 0, 2).reshape(*x.shape[:-1], -1)
+        if self.include_input:
+            features = torch.cat([x, features], dim=-1)
+        return features
+
+    def __repr__(self):
+        return (f"HashGridEncoding(n_levels={self.n_levels}, features_per_level={self.features_per_level}, "
+                f"resolutions={self.resolutions.tolist()}, table_size={self.embeddings.shape[0]})")
+
+
 class SIREN(nn.Module):
     """SIREN Module
 
@@ -69,6 +286,25 @@ class SIREN(nn.Module):
         Frequency multiplier for the hidden Sine layers. Only useful for
         training the model. Default value is None.
 
+    checkpoint_activations: boolean, optional
+        Keep only the input of every layer for the backward pass and evaluate
+        the layer again to compute its gradients, trading compute for
+        memory when training with second order terms. Default value is
+        False.
+
+    fused_sine: boolean, optional
+        Evaluate every hidden layer and its sine as a single autograd node
+        that keeps only its pre-activation, which saves memory and time when
+        the network is differentiated twice. It does not change the weights,
+        so it can be toggled on trained models. Ignored with
+        `checkpoint_activations` or ReLU activations. Default value is False.
+
+    encoding: dict, optional
+        Keyword arguments of a `HashGridEncoding` applied to the input
+        before the first layer, which allows a much smaller network for the
+        same detail. Default value is None, the coordinates are fed
+        directly.
+
     delay_init: boolean, optional
         Indicates if we should perform the weight initialization or not.
         Default value is False, meaning that we perform the weight
@@ -83,14 +319,24 @@ class SIREN(nn.Module):
     Activation Functions. ArXiv. http://arxiv.org/abs/2006.09661
     """
     def __init__(self, n_in_features, n_out_features, hidden_layer_config=[],
-                 w0=30, ww=None, delay_init=False, activation='sine'):
+                 w0=30, ww=None, delay_init=False, activation='sine', checkpoint_activations=False,
+                 fused_sine=False, encoding=None):
         super().__init__()
         self.w0 = w0
+        self.activation = activation
+        self.hidden_layer_config = list(hidden_layer_config)
+        self.checkpoint_activations = checkpoint_activations
+        self.fused_sine = fused_sine
         if ww is None:
             self.ww = w0
         else:
             self.ww = ww
 
+        self.encoding = None
+        if encoding is not None:
+            self.encoding = HashGridEncoding(**encoding)
+            n_in_features = self.encoding.n_output_dims
+
         net = []
         net.append(nn.Sequential(
             nn.Linear(n_in_features, hidden_layer_config[0]),
@@ -113,6 +359,85 @@ class SIREN(nn.Module):
             self.net[1:].apply(lambda module: sine_init(module, self.ww))
 
 
+    @torch.no_grad()
+    def grow(self, hidden_layer_config, identity_scale=0.1):
+        """Grows the network to `hidden_layer_config` in place, keeping the
+        function it represents, as in Net2Net [2]. The model must be moved to
+        its device before and its optimizer built again after.
+
+        Layers are widened by replicating random neurons, with their
+        outgoing weights split in random shares that add up to the original
+        weight, so the output is unchanged and replicas do not stay
+        identical while training. New layers are appended after the last
+        hidden one. A sine can not represent the identity, so they are
+        initialized to sin(`identity_scale` x) and the following layer is
+        scaled by 1 / `identity_scale`, which changes the output by a
+        relative error below `identity_scale` ** 2 / 6.
+
+        Parameters
+        ----------
+        hidden_layer_config: list[int]
+            Target hidden layers. It can not have fewer layers, fewer neurons
+            in an existing layer, or new layers narrower than the last one.
+
+        identity_scale: float, optional
+            Scale of the (almost) identity new layers. Default value is 0.1.
+
+        References
+        ----------
+        [2] Chen, T., Goodfellow, I., & Shlens, J. (2016). Net2Net:
+        Accelerating Learning via Knowledge Transfer. ArXiv.
+        http://arxiv.org/abs/1511.05641
+        """
+        current = self.hidden_layer_config
+        if self.activation != 'sine':
+            raise ValueError('Only networks with sine activations can grow.')
+        if len(hidden_layer_config) < len(current) or any( n < c for n, c in zip(hidden_layer_config, current) ):
+            raise ValueError(f'Can not grow hidden layers {current} to {hidden_layer_config}.')
+        if any( n < p for n, p in zip(hidden_layer_config[len(current):], hidden_layer_config[len(current) - 1:]) ):
+            raise ValueError(f'New layers of {hidden_layer_config} can not be narrower than the previous one.')
+
+        linears = [ block[0] for block in self.net ]
+        for i in range(len(current), len(hidden_layer_config)):
+            # (almost) identity layer before the output
+            width = linears[-2].out_features
+            identity = nn.Linear(width, width).to(linears[-1].weight)
+            identity.weight.copy_(torch.eye(width) * identity_scale / self.ww)
+            identity.bias.zero_()
+            linears[-1].weight.div_(identity_scale)
+            linears.insert(-1, identity)
+
+        for i, width in enumerate(hidden_layer_config):
+            if linears[i].out_features < width:
+                linears[i], linears[i + 1] = self._widen(linears[i], linears[i + 1], width)
+
+        net = [ nn.Sequential(linears[0], SineLayer(self.w0)) ]
+        net += [ nn.Sequential(linear, SineLayer(self.ww)) for linear in linears[1:-1] ]
+        net.append(nn.Sequential(linears[-1]))
+        self.net = nn.Sequential(*net)
+        self.hidden_layer_config = list(hidden_layer_config)
+
+    @staticmethod
+    def _widen(linear, next_linear, width):
+        old_width = linear.out_features
+        mapping = torch.cat([
+            torch.arange(old_width),
+            torch.randint(0, old_width, (width - old_width,))
+        ]).to(linear.weight.device)
+
+        shares = torch.rand(width, device=linear.weight.device) + 0.5
+        totals = torch.zeros(old_width, device=shares.device).index_add_(0, mapping, shares)
+        shares = shares / totals[mapping]
+
+        wide = nn.Linear(linear.in_features, width).to(linear.weight)
+        wide.weight.copy_(linear.weight[mapping])
+        wide.bias.copy_(linear.bias[mapping])
+
+        wide_next = nn.Linear(width, next_linear.out_features).to(next_linear.weight)
+        wide_next.weight.copy_(next_linear.weight[:, mapping] * shares)
+        wide_next.bias.copy_(next_linear.bias)
+        return wide, wide_next
+
     def forward(self, x):
         """Forward pass of the model.
 
@@ -130,6 +455,18 @@ class SIREN(nn.Module):
         # Enables us to compute gradients w.r.t. coordinates
         coords_org = x.clone().detach().requires_grad_(True)
         coords = coords_org
-        y = self.net(coords)
+        if self.encoding is not None:
+            coords = self.encoding(coords)
+        if self.checkpoint_activations and torch.is_grad_enabled():
+            y = coords
+            for block in self.net:
+                y, = _Checkpointed.apply(functools.partial(_block_outputs, block), 1, y, *block.parameters())
+        elif self.fused_sine and self.activation == 'sine':
+            y = coords
+            for block in self.net[:-1]:
+                y, _ = _SineLinear.apply(y, block[0].weight, block[0].bias, block[1].w0)
+            y = self.net[-1](y)
+        else:
+            y = self.net(coords)
     
         return {"model_in": coords_org, "model_out": y}
@@ -0,0 +1,84 @@
+# coding: utf-8
+
+import os
+import os.path as osp
+import torch
+from torch.profiler import ProfilerActivity, profile, schedule
+
+
+class _DisabledProfiler:
+    """Stands in for torch.profiler.profile when profiling is off."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def step(self):
+        pass
+
+
+def _export( output_dir, name, sort_by, row_limit, group_by_shape ):
+    def handler( prof ):
+        os.makedirs(output_dir, exist_ok=True)
+        trace_path = osp.join(output_dir, f'{name}_trace.json')
+        summary_path = osp.join(output_dir, f'{name}_summary.txt')
+
+        prof.export_chrome_trace(trace_path)
+        with open(summary_path, 'w+') as fout:
+            fout.write(prof.key_averages(group_by_input_shape=group_by_shape).table(sort_by=sort_by, row_limit=row_limit))
+        print(f'Saved profile to {trace_path}, {summary_path}')
+    return handler
+
+
+def make_profiler( profile_config, output_dir, name ):
+    """
+    Profiler described by the 'profile' section of a config, to be used as a
+    context manager or with start / stop. Without that section it does
+    nothing.
+
+    With the 'steps' key, only that many calls to step() are recorded,
+    after skipping 'start_step' calls and 'warmup' more. Otherwise everything
+    between start and stop is recorded. The Chrome trace and a summary of the
+    top operators are written to `output_dir`, or the 'output_dir' of the
+    section if present, as {name}_trace.json and {name}_summary.txt.
+    """
+    if not profile_config or not profile_config.get('enabled', True):
+        return _DisabledProfiler()
+
+    activities = [ ProfilerActivity.CPU ]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+
+    window = None
+    if 'steps' in profile_config:
+        window = schedule(
+            skip_first=profile_config.get('start_step', 0),
+            wait=0,
+            warmup=profile_config.get('warmup', 1),
+            active=profile_config['steps'],
+            repeat=1
+        )
+
+    record_shapes = profile_config.get('record_shapes', True)
+    sort_by = profile_config.get('sort_by', 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total')
+    return profile(
+        activities=activities,
+        schedule=window,
+        on_trace_ready=_export(
+            profile_config.get('output_dir', output_dir),
+            name,
+            sort_by,
+            profile_config.get('row_limit', 30),
+            record_shapes
+        ),
+        record_shapes=record_shapes,
+        profile_memory=profile_config.get('profile_memory', True),
+        with_stack=profile_config.get('with_stack', False)
+    )
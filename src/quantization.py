@@ -0,0 +1,40 @@
+# coding: utf-8
+
+import copy
+import torch
+from torch import nn
+from src.model import SIREN
+
+
+def quantize_siren( model ):
+    """
+    int8 copy of `model` for CPU inference. The weights of every linear
+    layer are quantized ahead of time and activations dynamically at every
+    call (PyTorch dynamic quantization). Sines, the hash grid encoding if
+    any, and accumulations stay in float32. The copy has no autograd
+    support and must be called under `torch.no_grad()`.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    # both evaluate the layers through their weight tensors, quantized layers pack them
+    model.fused_sine = False
+    model.checkpoint_activations = False
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized_siren( model_path, network_config ):
+    """Loads the weights saved by quantize.py for the network described by
+    `network_config` (same keys as the configs of the generators).
+    """
+    model = SIREN(
+        n_in_features= 3,
+        n_out_features=1,
+        hidden_layer_config=network_config["hidden_layer_nodes"],
+        w0=network_config["w0"],
+        ww=network_config.get("ww", None),
+        delay_init=True,
+        activation=network_config.get('activation', 'sine'),
+        encoding=network_config.get('encoding', None)
+    )
+    model = quantize_siren( model )
+    model.load_state_dict( torch.load(model_path, map_location='cpu') )
+    return model
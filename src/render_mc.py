@@ -6,6 +6,7 @@ from torch.nn import functional as F
 import sys
 from collections import defaultdict
 from src.evaluate import evaluate
+from src.eigensolver import eigh3
 from src.inverses import inverse
 import numpy as np
 from skimage.measure import marching_cubes
@@ -74,8 +75,8 @@ def extract_fields(decoder, latent_vec, N, gt_mode, device, alpha ):
     gradients = torch.from_numpy( gradients )
     gradients = -1 * F.normalize(gradients, dim=-1)
 
-    eigenvalues, eigenvectors = torch.linalg.eigh( torch.from_numpy(hessians) )
-    pred_normals = eigenvectors[..., 2]
+    eigenvalues, eigenvectors = eigh3( hessians )
+    pred_normals = eigenvectors[..., 2].double()
 
     pred_normals = torch.where(
         torch.sum( gradients * pred_normals, dim=-1 )[..., None] < 0,
@@ -1,23 +1,33 @@
 import torch
 import numpy as np
 from src.model import SIREN
+from src.baked import BakedUDF
 from src.evaluate import evaluate
+from src.eigensolver import eigh3
 from src.util import normalize
 import warnings
 import tqdm
 from src.inverses import inverse
 
 class Sampler:
-    def __init__(self, n_in_features=3, hidden_layers=[256,256,256,256], w0=30, ww=None, checkpoint = None, device =0):
+    def __init__(self, n_in_features=3, hidden_layers=[256,256,256,256], w0=30, ww=None, checkpoint = None, device =0, encoding=None, fused_sine=False, baked_path=None):
+        self.features = n_in_features
+        self.device = torch.device(device)
+        if baked_path is not None:
+            # volume from bake.py instead of the network
+            self.decoder = BakedUDF.load( baked_path, second_order=True )
+            self.decoder.to( self.device )
+            return
+
         self.decoder = SIREN(
             n_in_features= n_in_features,
             n_out_features=1,
             hidden_layer_config=hidden_layers,
             w0=w0,
-            ww=ww
+            ww=ww,
+            fused_sine=fused_sine,
+            encoding=encoding
         )
-        self.features = n_in_features
-        self.device = torch.device(device)
         self.decoder.to( self.device )
         self.decoder.eval()
 
@@ -62,7 +72,7 @@ class Sampler:
                 if gt_mode == 'siren':
                     normals = np.vstack( ( normals, normalize(gradients)[mask_points_on_surf]) )
                 else:
-                    normals = np.vstack( ( normals, [ np.linalg.eigh(hessian)[1][:,2] for hessian in hessians[mask_points_on_surf] ]) )
+                    normals = np.vstack( ( normals, eigh3( hessians[mask_points_on_surf] )[1][..., 2].numpy() ) )
             
             if len(surface_points) >= num_points:
                 break
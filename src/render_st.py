@@ -9,6 +9,7 @@ import open3d as o3d
 import open3d.core as o3c
 import numpy as np
 from src.diff_operators import gradient, hessian, divergence, jacobian
+from src.eigensolver import eigh3
 
 def evaluate(model, samples, max_batch=64**2, device=torch.device(0)):
     head = 0
@@ -56,7 +57,7 @@ def compute_curvature( inputs, normals, curvature='mean', device=torch.device(0)
 
 def compute_normals_and_cd( inputs, outputs):
     hessians_torch = hessian(outputs,inputs)
-    eigenvalues, eigenvectors = torch.linalg.eigh( hessians_torch )
+    eigenvalues, eigenvectors = eigh3( hessians_torch )
     pred_normals = eigenvectors[..., 2]
     
     return pred_normals, eigenvectors[...,:2].detach().cpu()
@@ -71,8 +72,9 @@ def create_projectional_image(
         mask_rays,
         network_config,
         rendering_config,
-        device ): 
-    hits = propagate_rays(model, rays, t0, mask_rays, network_config, rendering_config, device)
+        device,
+        coarse_model=None ): 
+    hits = propagate_rays(model, rays, t0, mask_rays, network_config, rendering_config, device, coarse_model)
     grad_descent(model, t0, hits, network_config, rendering_config, device)
 
     inputs, udfs = evaluate( model, t0[ hits ], device=device)
@@ -133,27 +135,60 @@ def create_projectional_image(
                 color_map=curvatures ).reshape((rendering_config['height'],rendering_config['width'],3))     
 
 
-def propagate_rays(model, rays, t0, mask_rays, network_config, rendering_config, device):
+def coarse_steps(coarse_model, rays, t0, coarse_rays, network_config, rendering_config):
+    """Advances the rays in `coarse_rays` with the distances of
+    `coarse_model` (e.g. an int8 copy of the network on the CPU), reduced by
+    rendering_config['coarse_margin'] to absorb its error. Rays closer to the
+    surface than rendering_config['coarse_threshold'] are not advanced and
+    leave `coarse_rays`, the full model takes them from there, and so do
+    rays the margin would not advance.
+    """
+    threshold = rendering_config.get('coarse_threshold', 10 * rendering_config['surface_threshold'])
+    margin = rendering_config.get('coarse_margin', 0)
+    if margin >= threshold:
+        raise ValueError(f'coarse_margin ({margin}) must be lower than coarse_threshold ({threshold}).')
+
+    with torch.no_grad():
+        _, udfs = evaluate( coarse_model, t0[ coarse_rays ], device=torch.device('cpu'))
+    udfs = torch.hstack(udfs).squeeze(0).numpy()
+    steps = inverse( network_config['gt_mode'], np.abs(udfs), network_config['alpha'] ).reshape(-1, 1)
+
+    close = np.logical_or( steps.flatten() < threshold, steps.flatten() <= margin )
+    steps = (steps - margin) * np.logical_not(close)[:, None]
+    t0[coarse_rays] += rays[coarse_rays] * steps
+    coarse_rays[coarse_rays] = np.logical_not(close)
+
+def propagate_rays(model, rays, t0, mask_rays, network_config, rendering_config, device, coarse_model=None):
     hits = np.zeros_like(mask_rays, dtype=np.bool8)
+    # rays marched with the coarse model until they get close to the surface
+    coarse_rays = np.copy(mask_rays) if coarse_model is not None else np.zeros_like(mask_rays, dtype=bool)
 
     iteration = 0
     while np.sum(mask_rays) > 0 and iteration < rendering_config['max_iterations']:
-        _, udfs = evaluate( model, t0[ mask_rays ], device=device)
-        udfs = torch.hstack(udfs).squeeze(0).detach().cpu().numpy()
-        steps = inverse( network_config['gt_mode'], np.abs(udfs), network_config['alpha'] )
-        #steps = np.abs(udfs)
-
-        t0[mask_rays] += rays[mask_rays] * steps
+        if np.any(coarse_rays):
+            coarse_steps(coarse_model, rays, t0, coarse_rays, network_config, rendering_config)
+            indomain_mask = np.logical_and( np.all( t0[coarse_rays] > -1, axis=1 ), np.all( t0[coarse_rays] < 1, axis=1 ))
+            mask_rays[coarse_rays] *= indomain_mask
+            coarse_rays[coarse_rays] *= indomain_mask
+
+        fine_rays = np.logical_and( mask_rays, np.logical_not(coarse_rays) )
+        if np.any(fine_rays):
+            _, udfs = evaluate( model, t0[ fine_rays ], device=device)
+            udfs = torch.hstack(udfs).squeeze(0).detach().cpu().numpy()
+            steps = inverse( network_config['gt_mode'], np.abs(udfs), network_config['alpha'] )
+            #steps = np.abs(udfs)
+
+            t0[fine_rays] += rays[fine_rays] * steps
+
+            if network_config['gt_mode'] == 'siren':
+                threshold_mask = udfs.flatten() < rendering_config['surface_threshold']
+            else:
+                threshold_mask = np.abs(steps).flatten() < rendering_config['surface_threshold']
+
+            indomain_mask = np.logical_and( np.all( t0[fine_rays] > -1, axis=1 ), np.all( t0[fine_rays] < 1, axis=1 ))
+            hits[fine_rays] += np.logical_and( threshold_mask, indomain_mask)
+            mask_rays[fine_rays] *= np.logical_and( np.logical_not(threshold_mask), indomain_mask )
 
-        if network_config['gt_mode'] == 'siren':
-            threshold_mask = udfs.flatten() < rendering_config['surface_threshold']
-        else:
-            threshold_mask = np.abs(steps).flatten() < rendering_config['surface_threshold']
-            
-        indomain_mask = np.logical_and( np.all( t0[mask_rays] > -1, axis=1 ), np.all( t0[mask_rays] < 1, axis=1 ))
-        hits[mask_rays] += np.logical_and( threshold_mask, indomain_mask)
-        mask_rays[mask_rays] *= np.logical_and( np.logical_not(threshold_mask), indomain_mask )
-        
         iteration += 1
 
     if np.sum(hits) == 0:
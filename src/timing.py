@@ -0,0 +1,52 @@
+# coding: utf-8
+
+import contextlib
+import time
+from collections import defaultdict
+import torch
+
+
+class SectionTimer:
+    """Accumulates wall clock time spent in named sections of code. While
+    disabled, which is the default, sections cost a single attribute check.
+
+    Parameters
+    ----------
+    device: torch.device, optional
+        When a CUDA device is given, it is synchronized at the start and end
+        of every section so that asynchronous kernels are attributed to the
+        section that launched them. Default value is None.
+    """
+    def __init__(self, device=None):
+        self.enabled = False
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+
+    def _synchronize(self):
+        if self.device is not None and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        self._synchronize()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            self.seconds[name] += time.perf_counter() - start_time
+
+    def section(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed(name)
+
+    def milliseconds_per_step(self, steps):
+        return { name: 1000 * seconds / steps for name, seconds in self.seconds.items() }
+
+
+# shared by the loss functions and the training benchmark, see benchmark.py
+timer = SectionTimer()
@@ -4,7 +4,9 @@ import os
 import os.path as osp
 import shutil
 import logging
+import random
 import numpy as np
+import torch
 
 
 def create_output_paths(checkpoint_path, experiment_name, overwrite=True):
@@ -36,4 +38,53 @@ def normalize( arr ):
         return arr / np.linalg.norm(arr)
     
     norm_arr = np.linalg.norm( arr, axis=1 )
-    return arr / np.vstack( [norm_arr, norm_arr, norm_arr] ).T
\ No newline at end of file
+    return arr / np.vstack( [norm_arr, norm_arr, norm_arr] ).T
+
+def get_rng_state():
+    """Collects the state of every random number generator used in training.
+    """
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state( state ):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_training_state( path, state ):
+    """Saves through a temporary file, so an interruption while writing never
+    leaves a corrupt state behind.
+    """
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def check_pretrained_architecture( network_params ):
+    """Raises a ValueError when the architecture recorded next to the
+    pretrained weights of `network_params` (same path with extension .json,
+    as written by meta_train.py) does not match the one of the network.
+    """
+    architecture_path = osp.splitext(network_params['pretrained_dict'])[0] + '.json'
+    if not osp.exists(architecture_path):
+        return
+
+    architecture = load_experiment_parameters(architecture_path)
+    defaults = { 'ww': None, 'activation': 'sine', 'encoding': None }
+    for key in ['hidden_layer_nodes', 'w0', 'ww', 'activation', 'encoding']:
+        expected = architecture.get(key, defaults.get(key))
+        if network_params.get(key, defaults.get(key)) != expected:
+            raise ValueError(f'Pretrained weights {network_params["pretrained_dict"]} need {key} = {expected}.')
+
+def unsigned_sampling( parameter_dict ):
+    """Whether training samples can skip the sign of the distances. The
+    'tanh' ground truth only looks at their absolute value, the key
+    'unsigned_sampling' of the config overrides it.
+    """
+    return parameter_dict.get('unsigned_sampling', parameter_dict['gt_mode'] == 'tanh')
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import json
+import os
+import os.path as osp
+import queue as queue_module
+import time
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from src.dataset import PointCloud
+from src.util import load_experiment_parameters, unsigned_sampling
+from train import setup_train
+
+
+def shape_key( parameter_dict ):
+    """Runs with the same key can share the data of their shape."""
+    return (
+        parameter_dict["dataset"],
+        unsigned_sampling( parameter_dict ),
+        parameter_dict.get("point_cloud_only", False)
+    )
+
+
+def estimated_cost( parameter_dict ):
+    """Relative cost of a run: samples seen times multiply-adds of the network."""
+    layers = [ 3 ] + parameter_dict["network"]["hidden_layer_nodes"] + [ 1 ]
+    flops = sum( a * b for a, b in zip(layers[:-1], layers[1:]) )
+    return parameter_dict["num_epochs"] * parameter_dict["batches_per_epoch"] * parameter_dict["batch_size"] * flops
+
+
+def share_shapes( parameter_dicts, bank_samples ):
+    """
+    Loads every shape of the sweep once and returns, for each shape key, its
+    surface point cloud and a bank of precomputed off surface samples in
+    shared memory. Runs with adaptive sampling query distances themselves
+    and get nothing.
+    """
+    shared = {}
+    for parameter_dict in parameter_dicts:
+        key = shape_key( parameter_dict )
+        if parameter_dict.get("adaptive_sampling") is not None or key in shared:
+            continue
+
+        dataset = PointCloud(
+            meshPath= parameter_dict["dataset"],
+            batchSize= parameter_dict["batch_size"],
+            samplingPercentiles=parameter_dict["sampling_percentiles"],
+            batchesPerEpoch = 1,
+            unsignedDistances = key[1],
+            pointCloudOnly = key[2]
+        )
+        shared[key] = dataset.share( bank_samples )
+    return shared
+
+
+def _run( index, parameter_dict, device, cores, shared_data, queue ):
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    start_time = time.time()
+    try:
+        result = setup_train( parameter_dict, device, shared_data=shared_data )
+    except Exception as e:
+        queue.put( (index, 'failed', time.time() - start_time, None, repr(e)) )
+        raise
+    training_time = result[0] if isinstance(result, tuple) else None
+    queue.put( (index, 'done', time.time() - start_time, training_time, None) )
+
+
+def run_sweep( parameter_dicts, shared, device, jobs, threads, poll_seconds=5 ):
+    """
+    Runs every experiment in its own process, at most `jobs` at once, each
+    one pinned to its own `threads` cores. Longest runs start first.
+    Processes are polled every `poll_seconds`, and those that exit without
+    reporting (e.g. killed by the system) are recorded as failed.
+    Returns the status and timings of every run.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    if jobs * threads > len(cores):
+        raise ValueError(f'{jobs} jobs of {threads} threads do not fit in {len(cores)} cores.')
+    free_slots = [ cores[i * threads:(i + 1) * threads] for i in range(jobs) ]
+
+    context = mp.get_context('spawn')
+    queue = context.Queue()
+    pending = sorted(range(len(parameter_dicts)), key=lambda i: estimated_cost(parameter_dicts[i]), reverse=True)
+    running = {}
+    runs = [ None ] * len(parameter_dicts)
+
+    def finish( index, status, wall_time, training_time, error ):
+        process, slot, _ = running.pop(index)
+        process.join()
+        free_slots.append(slot)
+        runs[index] = {
+            'status': status,
+            'cores': slot,
+            'wall_time': wall_time,
+            'training_time': training_time,
+            'error': error
+        }
+        print(f'Finished {parameter_dicts[index]["experiment_name"]} ({status}) in {wall_time:.1f} s')
+
+    while pending or running:
+        while pending and free_slots:
+            index = pending.pop(0)
+            slot = free_slots.pop(0)
+            parameter_dict = parameter_dicts[index]
+            print(f'Starting {parameter_dict["experiment_name"]} on cores {slot}')
+            process = context.Process(
+                target=_run,
+                args=(index, parameter_dict, device, slot, shared.get(shape_key(parameter_dict)), queue)
+            )
+            process.start()
+            running[index] = (process, slot, time.time())
+
+        try:
+            finish( *queue.get(timeout=poll_seconds) )
+            continue
+        except queue_module.Empty:
+            pass
+
+        dead = [ index for index, (process, _, _) in running.items() if process.exitcode is not None ]
+        if len(dead) > 0:
+            # reports are flushed before a process exits, read them first
+            try:
+                while True:
+                    finish( *queue.get_nowait() )
+            except queue_module.Empty:
+                pass
+            for index in dead:
+                if index in running:
+                    process, _, start_time = running[index]
+                    finish( index, 'failed', time.time() - start_time, None, f'exited with code {process.exitcode} without reporting' )
+
+    return runs
+
+
+def summarize_run( parameter_dict ):
+    """Epochs and losses of a finished experiment, read from its folder."""
+    full_path = osp.join(parameter_dict["checkpoint_path"], parameter_dict["experiment_name"])
+    summary = {}
+
+    losses_path = osp.join(full_path, "losses.csv")
+    if osp.exists(losses_path):
+        losses = pd.read_csv(losses_path, sep=";")
+        total = losses.sum(axis=1)
+        summary['final_losses'] = losses.iloc[-1].to_dict()
+        summary['final_loss'] = float(total.iloc[-1])
+        summary['best_loss'] = float(total.min())
+        summary['epochs'] = len(losses)
+
+    params_path = osp.join(full_path, "params.json")
+    if osp.exists(params_path):
+        params = load_experiment_parameters(params_path)
+        if 'schedule' in params:
+            summary['schedule'] = params['schedule']
+    return summary
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description='Train several experiments in parallel on the cores of one machine, sharing the data of their shapes'
+    )
+    p.add_argument('configs', metavar='path/to/json', type=str, nargs='+', help='train configs')
+    p.add_argument('-j', '--jobs', type=int, default=None, help='runs at once, as many as fit in the available cores by default')
+    p.add_argument('-t', '--threads', type=int, default=1, help='cores pinned to each run')
+    p.add_argument('-b', '--bank_samples', type=int, default=2000000, help='precomputed off surface samples per shape')
+    p.add_argument('-d', '--device', type=int, default=0, help='cuda device, runs use CPU if there is none')
+    p.add_argument('-o', '--output', type=str, default='sweep.json', help='path to the output report')
+    args = p.parse_args()
+
+    parameter_dicts = []
+    for config in args.configs:
+        parameter_dict = load_experiment_parameters(config)
+        if not bool(parameter_dict):
+            raise ValueError(f"JSON experiment {config} not found")
+        parameter_dicts.append(parameter_dict)
+
+    names = [ osp.join(d["checkpoint_path"], d["experiment_name"]) for d in parameter_dicts ]
+    if len(set(names)) != len(names):
+        raise ValueError('Every config of a sweep needs its own checkpoint_path and experiment_name.')
+
+    jobs = args.jobs or max(1, len(os.sched_getaffinity(0)) // args.threads)
+
+    start_time = time.time()
+    shared = share_shapes( parameter_dicts, args.bank_samples )
+    sharing_time = time.time() - start_time
+    print(f'Loaded {len(shared)} shapes into shared memory in {sharing_time:.1f} s')
+
+    runs = run_sweep( parameter_dicts, shared, args.device, jobs, args.threads )
+    sweep_time = time.time() - start_time
+
+    report = []
+    for config, parameter_dict, run in zip(args.configs, parameter_dicts, runs):
+        report.append(dict(
+            config=config,
+            experiment=osp.join(parameter_dict["checkpoint_path"], parameter_dict["experiment_name"]),
+            dataset=parameter_dict["dataset"],
+            shared=shape_key(parameter_dict) in shared and parameter_dict.get("adaptive_sampling") is None,
+            **run,
+            **summarize_run( parameter_dict )
+        ))
+
+    with open(args.output, 'w+') as fout:
+        json.dump({
+            'jobs': jobs,
+            'threads': args.threads,
+            'bank_samples': args.bank_samples,
+            'sharing_time': sharing_time,
+            'sweep_time': sweep_time,
+            'sum_of_run_times': float(np.sum([ run['wall_time'] for run in runs ])),
+            'runs': report
+        }, fout, indent=4)
+
+    pd.DataFrame.from_records([
+        { k: v for k, v in run.items() if not isinstance(v, (dict, list)) } for run in report
+    ]).to_csv(osp.splitext(args.output)[0] + '.csv', sep=';', index=None)
+    print(f'Sweep of {len(runs)} runs took {sweep_time:.1f} s, saved to {args.output}')
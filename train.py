@@ -3,6 +3,7 @@
 
 import argparse
 import copy
+import functools
 import json
 import os
 import os.path as osp
@@ -12,28 +13,107 @@ import pandas as pd
 import torch
 from torch.utils.tensorboard import SummaryWriter
 from src.dataset import PointCloud
-from src.loss_functions import loss_siren, loss_s1, loss_s2
+from src.loss_functions import loss_siren, loss_s1, loss_s2, lazy_weights
 from src.model import SIREN
-from src.util import create_output_paths, load_experiment_parameters
+from src.convergence import PlateauDetector
+from src.util import create_output_paths, load_experiment_parameters, get_rng_state, set_rng_state, save_training_state, check_pretrained_architecture, unsigned_sampling
+from src.distributed import init_distributed, broadcast_parameters, average_gradients, average_loss_terms, all_reduce_sum
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from generate_df import generate_df
 from generate_mc import generate_mc
+from src.mesh_queue import CheckpointMesher
+from src.profiling import make_profiler
+from src.micro_batching import estimate_chunks, accumulate_gradients, accumulate_gradients_s2
 import time
 import open3d as o3d
 
+def load_training_state( config, model, optim ):
+    """
+    Restores the model, optimizer, statistics and random number generators
+    saved at the end of an epoch by an interrupted run. Learning rate and
+    training stage follow from the restored optimizer and epoch. Returns the
+    first epoch to train, best loss and weights so far, the loss history and
+    the training time already spent.
+    """
+    state = config["resume_state"]
+    model.load_state_dict(state['model'])
+    optim.load_state_dict(state['optimizer'])
+    set_rng_state(state['rng'])
+
+    print(f"Resuming training from epoch {state['epoch'] + 1}")
+    return state['epoch'] + 1, state['best_loss'], state['best_weights'], state['losses'], state['training_time']
+
+def architecture_at( growth, hidden_layer_nodes, epoch ):
+    """Hidden layers at `epoch` of a network that grows following the
+    'growth' section of a config up to `hidden_layer_nodes`.
+    """
+    stages = growth['hidden_layer_nodes'] + [ hidden_layer_nodes ]
+    return stages[ sum( 1 for e in growth['epochs'] if e <= epoch ) ]
+
+def rebuild_optimizer( optim, model ):
+    """Optimizer of the same type and settings as `optim` over the current
+    parameters of `model`, whose moments start from scratch.
+    """
+    lr = optim.param_groups[0]['lr']
+    optim = type(optim)(model.parameters(), **optim.defaults)
+    for g in optim.param_groups:
+        g['lr'] = lr
+    return optim
+
+def make_lbfgs( model, s2_optimizer ):
+    """L-BFGS optimizer for the second step, described by the 's2' key of
+    the optimizer section of a config.
+    """
+    return torch.optim.LBFGS(
+        model.parameters(),
+        lr=s2_optimizer.get('lr', 1.0),
+        max_iter=s2_optimizer.get('max_iter', 20),
+        history_size=s2_optimizer.get('history_size', 10),
+        line_search_fn=s2_optimizer.get('line_search', 'strong_wolfe')
+    )
+
+def report_growth( growth, hidden_layer_nodes, stage_seconds, stage_epochs, log_path ):
+    """Writes the time per first step epoch of every architecture of a
+    growing network to growth.json, and the wall clock saved with respect to
+    training those epochs with the final architecture.
+    """
+    stages = [
+        {
+            'hidden_layer_nodes': layers,
+            'epochs': epochs,
+            'seconds_per_epoch': seconds / epochs if epochs else None
+        }
+        for layers, seconds, epochs in zip(growth['hidden_layer_nodes'] + [ hidden_layer_nodes ], stage_seconds, stage_epochs)
+    ]
+
+    saved_seconds = None
+    final_seconds_per_epoch = stages[-1]['seconds_per_epoch']
+    if final_seconds_per_epoch is not None:
+        saved_seconds = sum( epochs * final_seconds_per_epoch - seconds for seconds, epochs in zip(stage_seconds[:-1], stage_epochs[:-1]) )
+        print(f'Growing the network saved {saved_seconds:.1f} s of the first step')
+
+    with open(osp.join(log_path, "growth.json"), "w+") as fout:
+        json.dump({ 'stages': stages, 'saved_seconds': saved_seconds }, fout, indent=4)
+
 def train_model_siren( dataset, model, device, config) -> torch.nn.Module:
     epochs = config["epochs"]
     epochs_til_checkpoint = config.get("epochs_to_checkpoint", 0)
 
     log_path = config["log_path"]
     optim = config["optimizer"]
+    rank = config.get("rank", 0)
+    world_size = config.get("world_size", 1)
 
     model.to(device)
 
     # Creating the summary storage folder
-    summary_path = osp.join(log_path, 'summaries')
-    if not osp.exists(summary_path):
-        os.makedirs(summary_path)
-    writer = SummaryWriter(summary_path)
+    writer = None
+    if rank == 0:
+        summary_path = osp.join(log_path, 'summaries')
+        if not osp.exists(summary_path):
+            os.makedirs(summary_path)
+        writer = SummaryWriter(summary_path)
 
     losses = dict()
     best_loss = np.inf
@@ -45,16 +125,33 @@ def train_model_siren( dataset, model, device, config) -> torch.nn.Module:
     for g in optim.param_groups:
         g['lr'] = current_lr
 
+    start_epoch = 0
+    elapsed_time = 0
+    if config.get("resume_state") is not None:
+        start_epoch, best_loss, best_weights, losses, elapsed_time = load_training_state( config, model, optim )
+        current_lr = optim.param_groups[0]['lr']
+
     recon_time = 0
-    start_ttime = time.time() 
-    for epoch in range(epochs):
+    mesher = None
+    if rank == 0 and epochs_til_checkpoint and config.get("checkpoint_workers", 1) > 0:
+        mesher = CheckpointMesher( workers=config["checkpoint_workers"], max_pending=config.get("checkpoint_max_pending") )
+    profiler = make_profiler( config.get("profile") if rank == 0 else None, osp.join(log_path, "profile"), "train" )
+    profiler.start()
+
+    # with micro-batching, the amount of micro-batches is estimated on the
+    # first batch unless given
+    micro_batching = config.get("micro_batching")
+    chunks = None
+
+    start_ttime = time.time() - elapsed_time
+    for epoch in range(start_epoch, epochs):
         if epoch == config['warmup_epochs']:
             current_lr = config['lr']
             for g in optim.param_groups:
                 g['lr'] = current_lr
 
         running_loss = dict()
-        for input_data, normals, sdf in iter(dataset):
+        for input_data, normals, sdf, _ in iter(dataset):
             # zero the parameter gradients
             optim.zero_grad()
             
@@ -63,26 +160,52 @@ def train_model_siren( dataset, model, device, config) -> torch.nn.Module:
             normals = normals.to(device)
             sdf = sdf.to(device)
             
-            loss = loss_fn( 
-                model, 
-                input_data, 
-                {'normals': normals, 'sdf': sdf}, 
-                loss_weights
-            )
-
-            train_loss = torch.zeros((1, 1), device=device)
-            for it, l in loss.items():
-                train_loss += l
+            gt = {'normals': normals, 'sdf': sdf}
+            if micro_batching is None:
+                loss = loss_fn( 
+                    model, 
+                    input_data, 
+                    gt, 
+                    loss_weights
+                )
+
+                train_loss = torch.zeros((1, 1), device=device)
+                for it, l in loss.items():
+                    train_loss += l
+                train_loss.backward()
+            else:
+                compute_loss = lambda x, g: loss_fn( model, x, g, loss_weights )
+                if chunks is None:
+                    chunks = micro_batching.get('chunks') or estimate_chunks(
+                        compute_loss, input_data, gt, micro_batching['memory_budget_mb'], micro_batching.get('safety_factor', 2.0)
+                    )
+                    print(f'Splitting every batch in {chunks} micro-batches')
+                loss = accumulate_gradients( compute_loss, input_data, gt, chunks )
+
+            # every rank only holds a shard of the batch
+            logged_loss = average_loss_terms(loss) if world_size > 1 else loss
+            for it, l in logged_loss.items():
                 # accumulating statistics per loss term
                 if it not in running_loss:
                     running_loss[it] = l.item()
                 else:
                     running_loss[it] += l.item()
 
-            train_loss.backward()
+            if world_size > 1:
+                average_gradients(model)
             optim.step()
+            profiler.step()
 
-            writer.add_scalar("train_loss", train_loss.item(), epoch)
+            if writer is not None:
+                writer.add_scalar("train_loss", sum(l.item() for l in logged_loss.values()), epoch)
+
+        # only the first rank keeps statistics and writes to disk
+        if rank != 0:
+            save_training_state(
+                osp.join(log_path, "models", f"training_state_{rank}.pth"),
+                {'epoch': epoch, 'rng': get_rng_state()}
+            )
+            continue
 
         # accumulate statistics
         for it, l in running_loss.items():
@@ -118,15 +241,26 @@ def train_model_siren( dataset, model, device, config) -> torch.nn.Module:
                 model.state_dict(),
                 osp.join(log_path, "models", f"model_{epoch}.pth")
             )
-            print(f"Generating mesh")
-            generate_mc( 
-                model=model, 
-                gt_mode=config["gt_mode"], 
-                device=device,
-                N=config.get('resolution', 256), 
-                output_path=osp.join(log_path, "reconstructions", f'mc_mesh_{epoch}.obj'), 
-                algorithm='siren'
-            )
+            if mesher is None:
+                print(f"Generating mesh")
+                generate_mc( 
+                    model=model, 
+                    gt_mode=config["gt_mode"], 
+                    device=device,
+                    N=config.get('resolution', 256), 
+                    output_path=osp.join(log_path, "reconstructions", f'mc_mesh_{epoch}.obj'), 
+                    algorithm='siren'
+                )
+            else:
+                mesher.submit(
+                    osp.join(log_path, "models", f"model_{epoch}.pth"),
+                    config["network"],
+                    gt_mode=config["gt_mode"],
+                    device=device,
+                    N=config.get('resolution', 256),
+                    output_path=osp.join(log_path, "reconstructions", f'mc_mesh_{epoch}.obj'),
+                    algorithm='siren'
+                )
 
         else:
             torch.save(
@@ -137,9 +271,30 @@ def train_model_siren( dataset, model, device, config) -> torch.nn.Module:
         end_rtime = time.time()
         recon_time += end_rtime - start_rtime
 
+        # everything needed to continue from the next epoch
+        save_training_state(
+            osp.join(log_path, "models", "training_state.pth"),
+            {
+                'epoch': epoch,
+                'model': model.state_dict(),
+                'hidden_layer_nodes': model.hidden_layer_config,
+                'optimizer': optim.state_dict(),
+                'best_loss': best_loss,
+                'best_weights': best_weights,
+                'losses': losses,
+                'training_time': time.time() - start_ttime - recon_time,
+                'rng': get_rng_state()
+            }
+        )
+
+    profiler.stop()
     end_ttime = time.time()
     total_training_time = end_ttime - start_ttime - recon_time
 
+    if mesher is not None:
+        print('Waiting for checkpoint meshes')
+        mesher.close()
+
     return losses, best_weights, total_training_time
 
 
@@ -149,14 +304,18 @@ def train_model_tanh(dataset, model, device, config) -> torch.nn.Module:
 
     log_path = config["log_path"]
     optim = config["optimizer"]
+    rank = config.get("rank", 0)
+    world_size = config.get("world_size", 1)
 
     model.to(device)
 
     # Creating the summary storage folder
-    summary_path = osp.join(log_path, 'summaries')
-    if not osp.exists(summary_path):
-        os.makedirs(summary_path)
-    writer = SummaryWriter(summary_path)
+    writer = None
+    if rank == 0:
+        summary_path = osp.join(log_path, 'summaries')
+        if not osp.exists(summary_path):
+            os.makedirs(summary_path)
+        writer = SummaryWriter(summary_path)
 
     losses = dict()
     best_loss = np.inf
@@ -168,22 +327,144 @@ def train_model_tanh(dataset, model, device, config) -> torch.nn.Module:
     for g in optim.param_groups:
         g['lr'] = current_lr
 
+    # Stage boundaries. With early stopping, the configured ones are upper
+    # bounds and the stages end as soon as the epoch loss plateaus.
+    warmup_end = config['warmup_epochs']
+    s2_start = config['s1_epochs']
+    s2_epochs = epochs - config['s1_epochs']
+    stop = False
+
+    stopping = config.get('early_stopping')
+    detector = None
+    if stopping is not None:
+        min_epochs = stopping.get('min_epochs', {})
+        detector = PlateauDetector(
+            smoothing=stopping.get('smoothing', 0.9),
+            patience=stopping.get('patience', 100),
+            min_delta=stopping.get('min_delta', 1e-3),
+            min_updates=min_epochs.get('warmup', 0)
+        )
+
+    # the network starts small and grows at the given epochs of the first step
+    growth = config.get("growth")
+    target_layers = config["network"]["hidden_layer_nodes"]
+    stage_seconds, stage_epochs = [], []
+    if growth is not None:
+        stage_seconds = [ 0. ] * (len(growth['epochs']) + 1)
+        stage_epochs = [ 0 ] * (len(growth['epochs']) + 1)
+
+    # with L-BFGS, the second step optimizes a fixed subset of the surface
+    s2_optimizer = config.get("s2_optimizer")
+    s2_subset = None
+
+    start_epoch = 0
+    elapsed_time = 0
+    if config.get("resume_state") is not None:
+        if growth is not None:
+            # the saved weights belong to the architecture of the last epoch,
+            # which states saved before it was stored follow from the schedule
+            saved_layers = config["resume_state"].get('hidden_layer_nodes')
+            if saved_layers is None:
+                saved_epoch = config["resume_state"]['epoch']
+                if saved_epoch >= config["resume_state"].get('schedule', {}).get('s2_start', s2_start):
+                    saved_layers = target_layers
+                else:
+                    saved_layers = architecture_at( growth, target_layers, saved_epoch )
+            model.grow( saved_layers )
+            model.to(device)
+            optim = rebuild_optimizer( optim, model )
+
+        if s2_optimizer is not None and config["resume_state"]['epoch'] >= config["resume_state"].get('schedule', {}).get('s2_start', s2_start):
+            optim = make_lbfgs( model, s2_optimizer )
+
+        start_epoch, best_loss, best_weights, losses, elapsed_time = load_training_state( config, model, optim )
+        current_lr = optim.param_groups[0]['lr']
+
+        schedule = config["resume_state"].get('schedule', {})
+        warmup_end = schedule.get('warmup_end', warmup_end)
+        s2_start = schedule.get('s2_start', s2_start)
+        stop = schedule.get('stop', stop)
+        if detector is not None and 'plateau' in config["resume_state"]:
+            detector.load_state_dict(config["resume_state"]['plateau'])
+        dataset.load_sampling_state( config["resume_state"].get('sampling') )
+        # the L-BFGS state just loaded belongs to this subset
+        s2_subset = config["resume_state"].get('s2_subset')
+
+        if start_epoch > s2_start:
+            loss_weights = config['loss_s2_weights']
+            loss_fn = loss_s2 if world_size == 1 else functools.partial(loss_s2, reduce_fn=all_reduce_sum)
+            if config.get("s2_surface_only", True):
+                dataset.sample_surface_only( config.get("s2_batch_size") or dataset.samplesOnSurface )
+
     recon_time = 0
-    start_ttime = time.time() 
-    for epoch in range(epochs):
-        if epoch == config['warmup_epochs']:
+    mesher = None
+    if rank == 0 and epochs_til_checkpoint and config.get("checkpoint_workers", 1) > 0:
+        mesher = CheckpointMesher( workers=config["checkpoint_workers"], max_pending=config.get("checkpoint_max_pending") )
+    profiler = make_profiler( config.get("profile") if rank == 0 else None, osp.join(log_path, "profile"), "train" )
+    profiler.start()
+
+    # with micro-batching, the amount of micro-batches is estimated on the
+    # first batch of each stage unless given
+    micro_batching = config.get("micro_batching")
+    chunks = None
+
+    # second order terms of the first step, only evaluated every few steps
+    lazy = config.get("lazy_regularization") or {}
+    lazy_interval = lazy.get('interval', 1)
+    lazy_terms = lazy.get('terms', ['hessian_constraint'])
+
+    trained_epochs = start_epoch
+    start_ttime = time.time() - elapsed_time
+    for epoch in range(start_epoch, epochs):
+        if stop or epoch >= s2_start + s2_epochs:
+            break
+
+        if epoch == warmup_end:
             current_lr = config['lr_s1']
             for g in optim.param_groups:
                 g['lr'] = current_lr
-
-        if epoch == config['s1_epochs']:
+            if detector is not None:
+                detector.reset(min_epochs.get('s1', 0))
+
+        # early stopping may start the second step, at the final
+        # architecture, before the last growth epochs
+        if growth is not None and epoch in growth['epochs'] and epoch < s2_start:
+            model.grow( architecture_at( growth, target_layers, epoch ), growth.get('identity_scale', 0.1) )
+            model.to(device)
+            if world_size > 1:
+                broadcast_parameters(model)
+            optim = rebuild_optimizer( optim, model )
+            chunks = None
+            # only weights of the final architecture can be exported
+            best_loss = np.inf
+            best_weights = None
+            if rank == 0:
+                print(f'Growing hidden layers to {model.hidden_layer_config}')
+
+        if epoch == s2_start:
             print('Starting second step...')
             loss_weights = config['loss_s2_weights']
-            loss_fn = loss_s2
+            loss_fn = loss_s2 if world_size == 1 else functools.partial(loss_s2, reduce_fn=all_reduce_sum)
+            chunks = None
+            if growth is not None and model.hidden_layer_config != target_layers:
+                # the first step ended before the last growth epoch
+                model.grow( target_layers, growth.get('identity_scale', 0.1) )
+                model.to(device)
+                if world_size > 1:
+                    broadcast_parameters(model)
+                optim = rebuild_optimizer( optim, model )
+                best_loss = np.inf
+                best_weights = None
+            if config.get("s2_surface_only", True):
+                # loss_s2 only looks at on surface samples
+                dataset.sample_surface_only( config.get("s2_batch_size") or dataset.samplesOnSurface )
+            if detector is not None:
+                detector.reset(min_epochs.get('s2', 0))
         
-        if epoch >= config['s1_epochs']:
+        if epoch >= s2_start and s2_optimizer is None:
             init_lr = config['lr_s2']
-            lr =  0.5 * (np.cos(epoch/(epochs - config['s1_epochs']) * np.pi) + 1) 
+            # same phase as the fixed schedule when s2_start == s1_epochs
+            lr =  0.5 * (np.cos((epoch - s2_start + config['s1_epochs'])/s2_epochs * np.pi) + 1) 
             lr = lr * init_lr
             current_lr = lr
             
@@ -191,8 +472,19 @@ def train_model_tanh(dataset, model, device, config) -> torch.nn.Module:
                 g['lr'] = lr
 
 
+        batches = iter(dataset)
+        if epoch >= s2_start and s2_optimizer is not None:
+            resample_epochs = s2_optimizer.get('resample_epochs', 0)
+            if s2_subset is None or (resample_epochs and (epoch - s2_start) % resample_epochs == 0):
+                s2_subset = next(iter(dataset))
+                # curvature pairs of another subset are of no use
+                optim = make_lbfgs( model, s2_optimizer )
+                current_lr = s2_optimizer.get('lr', 1.0)
+            batches = [ s2_subset ]
+
+        epoch_start = time.time()
         running_loss = dict()
-        for input_data, normals, sdf in iter(dataset):
+        for batch, (input_data, normals, sdf, weights) in enumerate(batches):
             # zero the parameter gradients
             optim.zero_grad()
             
@@ -200,28 +492,115 @@ def train_model_tanh(dataset, model, device, config) -> torch.nn.Module:
             input_data = input_data.to( device )
             normals = normals.to(device)
             sdf = sdf.to(device)
+            weights = weights.to(device)
+
+            step_weights = loss_weights
+            if epoch < s2_start:
+                step_weights = lazy_weights( loss_weights, epoch * dataset.batchesPerEpoch + batch, lazy_interval, lazy_terms )
             
-            loss = loss_fn( 
-                model, 
-                input_data, 
-                {'normals': normals, 'sdf': sdf}, 
-                loss_weights,
-                config["alpha"]
-            )
+            gt = {'normals': normals, 'sdf': sdf, 'weights': weights}
+            compute_loss = lambda x, g: loss_fn( model, x, g, step_weights, config["alpha"] )
+            if micro_batching is not None and chunks is None:
+                chunks = micro_batching.get('chunks') or estimate_chunks(
+                    compute_loss, input_data, gt, micro_batching['memory_budget_mb'], micro_batching.get('safety_factor', 2.0)
+                )
+                print(f'Splitting every batch in {chunks} micro-batches')
+
+            residuals = None
+            if dataset.errorGrid is not None and epoch < s2_start:
+                # errors of the loss forward pass for adaptive sampling, one
+                # tensor per micro-batch
+                residuals = []
+                compute_loss = lambda x, g: loss_fn( model, x, g, step_weights, config["alpha"], residuals=residuals )
+
+            if isinstance(optim, torch.optim.LBFGS):
+                # evaluated several times per step, loss terms are the ones
+                # of the last evaluation. L-BFGS only runs the second step,
+                # on a single process
+                loss = dict()
+                def closure():
+                    optim.zero_grad()
+                    if micro_batching is None:
+                        loss.update(compute_loss( input_data, gt ))
+                    else:
+                        loss.update(accumulate_gradients_s2( model, input_data, gt, loss_weights, chunks ))
+                    train_loss = torch.zeros((1, 1), device=device)
+                    for l in loss.values():
+                        train_loss += l
+                    if micro_batching is None:
+                        train_loss.backward()
+                    return train_loss
+                optim.step(closure)
+            elif micro_batching is None:
+                loss = compute_loss( input_data, gt )
+
+                train_loss = torch.zeros((1, 1), device=device)
+                for it, l in loss.items():
+                    train_loss += l
+                train_loss.backward()
+            elif epoch >= s2_start:
+                loss = accumulate_gradients_s2( model, input_data, gt, loss_weights, chunks, all_reduce_sum if world_size > 1 else None )
+            else:
+                loss = accumulate_gradients( compute_loss, input_data, gt, chunks )
 
-            train_loss = torch.zeros((1, 1), device=device)
-            for it, l in loss.items():
-                train_loss += l
+            # every rank only holds a shard of the batch
+            logged_loss = average_loss_terms(loss) if world_size > 1 else loss
+            for it, l in logged_loss.items():
                 # accumulating statistics per loss term
                 if it not in running_loss:
                     running_loss[it] = l.item()
                 else:
                     running_loss[it] += l.item()
 
-            train_loss.backward()
-            optim.step()
+            if world_size > 1:
+                average_gradients(model)
+            if not isinstance(optim, torch.optim.LBFGS):
+                optim.step()
+            profiler.step()
+
+            if residuals is not None:
+                # micro-batches interleave the samples of the batch
+                errors = torch.empty_like(sdf)
+                for i, r in enumerate(residuals):
+                    errors[:, i::len(residuals)] = r
+                dataset.update_errors( input_data[0].cpu().numpy(), errors.flatten().cpu().numpy() )
+
+            if writer is not None:
+                writer.add_scalar("train_loss", sum(l.item() for l in logged_loss.values()), epoch)
 
-            writer.add_scalar("train_loss", train_loss.item(), epoch)
+        if growth is not None and epoch < s2_start:
+            stage = sum( 1 for e in growth['epochs'] if e <= epoch )
+            stage_seconds[stage] += time.time() - epoch_start
+            stage_epochs[stage] += 1
+
+        epoch_loss = 0
+        for k, v in running_loss.items():
+            epoch_loss += v
+        epoch_loss /= batch + 1
+        trained_epochs = epoch + 1
+
+        # epoch losses are the same on every rank, and so are these decisions
+        if detector is not None and detector.update(epoch_loss):
+            if epoch < warmup_end:
+                warmup_end = epoch + 1
+                if rank == 0:
+                    print(f'Loss plateaued, ending warmup at epoch {warmup_end}')
+            elif epoch < s2_start:
+                s2_start = epoch + 1
+                if rank == 0:
+                    print(f'Loss plateaued, starting second step at epoch {s2_start}')
+            else:
+                stop = True
+                if rank == 0:
+                    print(f'Loss plateaued, stopping at epoch {epoch}')
+
+        # only the first rank keeps statistics and writes to disk
+        if rank != 0:
+            save_training_state(
+                osp.join(log_path, "models", f"training_state_{rank}.pth"),
+                {'epoch': epoch, 'rng': get_rng_state(), 'sampling': dataset.sampling_state()}
+            )
+            continue
 
         # accumulate statistics
         for it, l in running_loss.items():
@@ -232,10 +611,6 @@ def train_model_tanh(dataset, model, device, config) -> torch.nn.Module:
                 losses[it][epoch] = l
             writer.add_scalar(it, l, epoch)
 
-        epoch_loss = 0
-        for k, v in running_loss.items():
-            epoch_loss += v
-        epoch_loss /=+ dataset.batchesPerEpoch
         print(f"Epoch: {epoch} - Loss: {epoch_loss} - Learning Rate: {current_lr:.3e}")
 
 
@@ -257,16 +632,28 @@ def train_model_tanh(dataset, model, device, config) -> torch.nn.Module:
                 model.state_dict(),
                 osp.join(log_path, "models", f"model_{epoch}.pth")
             )
-            print(f"Generating mesh")
-            generate_mc( 
-                model=model, 
-                gt_mode=config["gt_mode"], 
-                device=device, 
-                N=config.get('resolution', 256), 
-                output_path=osp.join(log_path, "reconstructions", f'mc_mesh_{epoch}.obj'), 
-                alpha=config['alpha'], 
-                algorithm='both'
-            )
+            if mesher is None:
+                print(f"Generating mesh")
+                generate_mc( 
+                    model=model, 
+                    gt_mode=config["gt_mode"], 
+                    device=device, 
+                    N=config.get('resolution', 256), 
+                    output_path=osp.join(log_path, "reconstructions", f'mc_mesh_{epoch}.obj'), 
+                    alpha=config['alpha'], 
+                    algorithm='both'
+                )
+            else:
+                mesher.submit(
+                    osp.join(log_path, "models", f"model_{epoch}.pth"),
+                    dict(config["network"], hidden_layer_nodes=model.hidden_layer_config),
+                    gt_mode=config["gt_mode"],
+                    device=device,
+                    N=config.get('resolution', 256),
+                    output_path=osp.join(log_path, "reconstructions", f'mc_mesh_{epoch}.obj'),
+                    alpha=config['alpha'],
+                    algorithm='both'
+                )
 
         else:
             torch.save(
@@ -277,54 +664,150 @@ def train_model_tanh(dataset, model, device, config) -> torch.nn.Module:
         end_rtime = time.time()
         recon_time += end_rtime - start_rtime
 
+        # everything needed to continue from the next epoch
+        save_training_state(
+            osp.join(log_path, "models", "training_state.pth"),
+            {
+                'epoch': epoch,
+                'model': model.state_dict(),
+                'hidden_layer_nodes': model.hidden_layer_config,
+                'optimizer': optim.state_dict(),
+                'best_loss': best_loss,
+                'best_weights': best_weights,
+                'losses': losses,
+                'training_time': time.time() - start_ttime - recon_time,
+                'rng': get_rng_state(),
+                'schedule': {'warmup_end': warmup_end, 's2_start': s2_start, 'stop': stop},
+                'plateau': detector.state_dict() if detector is not None else None,
+                'sampling': dataset.sampling_state(),
+                's2_subset': s2_subset
+            }
+        )
+
+    profiler.stop()
     end_ttime = time.time()
     total_training_time = end_ttime - start_ttime - recon_time
 
-    return losses, best_weights, total_training_time
+    if mesher is not None:
+        print('Waiting for checkpoint meshes')
+        mesher.close()
+
+    if trained_epochs < epochs:
+        losses = { it: l[:trained_epochs] for it, l in losses.items() }
 
-def setup_train( parameter_dict, cuda_device ):
+    if growth is not None and rank == 0:
+        report_growth( growth, target_layers, stage_seconds, stage_epochs, log_path )
+
+    if detector is not None and rank == 0:
+        # log the stage boundaries that were actually used
+        params_path = osp.join(log_path, "params.json")
+        parameter_dict = load_experiment_parameters(params_path)
+        parameter_dict['schedule'] = {
+            'warmup_epochs': min(warmup_end, trained_epochs),
+            's1_epochs': min(s2_start, trained_epochs),
+            'num_epochs': trained_epochs
+        }
+        with open(params_path, "w+") as fout:
+            json.dump(parameter_dict, fout, indent=4)
 
-    if not torch.cuda.is_available():
+    return losses, best_weights, total_training_time
+
+def setup_train( parameter_dict, cuda_device, rank=0, world_size=1, resume=False, shared_data=None ):
+    """
+    Trains the model described by `parameter_dict`. When `world_size` > 1,
+    this is one of `world_size` processes of a data-parallel run started by
+    `distributed_worker`: every process samples and evaluates its own shard
+    of the batch and only rank 0 writes results. With `resume`, training
+    continues from the state saved at the end of the last finished epoch of
+    the experiment, if any. `shared_data` comes from PointCloud.share in
+    another process, see sweep.py.
+    """
+
+    if not torch.cuda.is_available() and rank == 0:
         print('Utilizing CPU')
 
         
     device = torch.device(cuda_device if torch.cuda.is_available() else "cpu")
-    seed = 123 
+    seed = 123 + rank
     torch.manual_seed(seed)
     np.random.seed(seed)
     random.seed(seed)
 
-    full_path = create_output_paths(
-        parameter_dict["checkpoint_path"],
-        parameter_dict["experiment_name"],
-        overwrite=False
-    )
+    if rank == 0:
+        full_path = create_output_paths(
+            parameter_dict["checkpoint_path"],
+            parameter_dict["experiment_name"],
+            overwrite=False
+        )
 
-    # Saving the parameters to the output path
-    with open(osp.join(full_path, "params.json"), "w+") as fout:
-        json.dump(parameter_dict, fout, indent=4)
+        # Saving the parameters to the output path
+        with open(osp.join(full_path, "params.json"), "w+") as fout:
+            json.dump(parameter_dict, fout, indent=4)
+    else:
+        full_path = osp.join(".", parameter_dict["checkpoint_path"], parameter_dict["experiment_name"])
+
+    if parameter_dict["batch_size"] % world_size != 0:
+        raise ValueError('Batch size must be divisible by the amount of processes.')
 
     dataset = PointCloud(
         meshPath= parameter_dict["dataset"],
-        batchSize= parameter_dict["batch_size"],
+        batchSize= parameter_dict["batch_size"] // world_size,
         samplingPercentiles=parameter_dict["sampling_percentiles"],
-        batchesPerEpoch = parameter_dict["batches_per_epoch"]
+        batchesPerEpoch = parameter_dict["batches_per_epoch"],
+        adaptiveSampling = parameter_dict.get("adaptive_sampling", None),
+        unsignedDistances = unsigned_sampling( parameter_dict ),
+        pointCloudOnly = parameter_dict.get("point_cloud_only", False),
+        sharedData = shared_data
     )
 
     network_params = parameter_dict["network"]
+    growth = parameter_dict.get("growth", None)
+    hidden_layer_nodes = network_params["hidden_layer_nodes"]
+    if growth is not None:
+        if parameter_dict['gt_mode'] != 'tanh' or network_params['pretrained_dict'] != 'None':
+            raise ValueError('Growing networks are only supported for gt_mode \'tanh\' without pretrained weights.')
+        if len(growth['epochs']) != len(growth['hidden_layer_nodes']) or growth['epochs'] != sorted(growth['epochs']) or \
+           growth['epochs'][-1] >= parameter_dict['s1_epochs']:
+            raise ValueError('Growth needs one increasing epoch per architecture, all of them before s1_epochs.')
+        hidden_layer_nodes = growth['hidden_layer_nodes'][0]
+
     model = SIREN(
         n_in_features= 3,
         n_out_features=1,
-        hidden_layer_config=network_params["hidden_layer_nodes"],
+        hidden_layer_config=hidden_layer_nodes,
         w0=network_params["w0"],
         ww=network_params.get("ww", None),
-        activation= network_params.get('activation', 'sine')
+        activation= network_params.get('activation', 'sine'),
+        checkpoint_activations=network_params.get('checkpoint_activations', False),
+        fused_sine=network_params.get('fused_sine', False),
+        encoding=network_params.get('encoding', None)
     )
-    print(model)
+    if rank == 0:
+        print(model)
 
     if network_params['pretrained_dict'] != 'None':
+        check_pretrained_architecture( network_params )
         model.load_state_dict(torch.load(network_params['pretrained_dict'], map_location=device))
 
+    if world_size > 1:
+        # every process starts from the weights of the first one
+        broadcast_parameters(model)
+
+    resume_state = None
+    state_path = osp.join(full_path, "models", "training_state.pth")
+    if resume and osp.exists(state_path):
+        # random number generator states must stay on CPU
+        resume_state = torch.load(state_path, map_location="cpu")
+        if rank != 0:
+            rank_state = torch.load(osp.join(full_path, "models", f"training_state_{rank}.pth"))
+            if rank_state['epoch'] != resume_state['epoch']:
+                raise ValueError('Training states of the processes belong to different epochs.')
+            resume_state['rng'] = rank_state['rng']
+            # every process estimates the errors of its own samples
+            resume_state['sampling'] = rank_state.get('sampling')
+    elif resume and rank == 0:
+        print('No training state found, starting from scratch.')
+
     opt_params = parameter_dict["optimizer"]
 
     if parameter_dict['gt_mode'] == 'tanh':
@@ -335,6 +818,13 @@ def setup_train( parameter_dict, cuda_device ):
             )
         else:
             raise ValueError('Unknown optimizer')
+
+        s2_optimizer = opt_params.get("s2", None)
+        if s2_optimizer is not None:
+            if s2_optimizer.get("type", "lbfgs") != "lbfgs":
+                raise ValueError('Unknown second step optimizer')
+            if world_size > 1:
+                raise ValueError('The L-BFGS second step needs a single process.')
         config_dict = {
             "epochs": parameter_dict["num_epochs"],
             "s1_epochs": parameter_dict["s1_epochs"],
@@ -347,10 +837,24 @@ def setup_train( parameter_dict, cuda_device ):
             "warmup_lr": parameter_dict.get('warmup_lr', 1e-4),
             "lr_s1": opt_params["lr_s1"],
             "lr_s2": opt_params["lr_s2"],
+            "early_stopping": parameter_dict.get('early_stopping', None),
+            "s2_surface_only": parameter_dict.get('s2_surface_only', True),
+            "s2_batch_size": parameter_dict['s2_batch_size'] // world_size if 's2_batch_size' in parameter_dict else None,
             "loss_s1_weights": parameter_dict["loss_s1_weights"],
             "loss_s2_weights": parameter_dict["loss_s2_weights"],
             "alpha": parameter_dict["alpha"],
-            "resolution": parameter_dict.get('resolution', 256)
+            "resolution": parameter_dict.get('resolution', 256),
+            "network": network_params,
+            "checkpoint_workers": parameter_dict.get('checkpoint_workers', 1),
+            "checkpoint_max_pending": parameter_dict.get('checkpoint_max_pending', None),
+            "profile": parameter_dict.get('profile', None),
+            "micro_batching": parameter_dict.get('micro_batching', None),
+            "lazy_regularization": parameter_dict.get('lazy_regularization', None),
+            "growth": growth,
+            "s2_optimizer": s2_optimizer,
+            "rank": rank,
+            "world_size": world_size,
+            "resume_state": resume_state
         }
         losses, best_weights, training_time = train_model_tanh(
             dataset,
@@ -377,7 +881,15 @@ def setup_train( parameter_dict, cuda_device ):
             "warmup_lr": parameter_dict.get('warmup_lr', 1e-4),
             "lr": opt_params["lr"],
             "loss_weights": parameter_dict["loss_weights"],
-            "resolution": parameter_dict.get('resolution', 256)
+            "resolution": parameter_dict.get('resolution', 256),
+            "network": network_params,
+            "checkpoint_workers": parameter_dict.get('checkpoint_workers', 1),
+            "checkpoint_max_pending": parameter_dict.get('checkpoint_max_pending', None),
+            "profile": parameter_dict.get('profile', None),
+            "micro_batching": parameter_dict.get('micro_batching', None),
+            "rank": rank,
+            "world_size": world_size,
+            "resume_state": resume_state
         }
         losses, best_weights, training_time = train_model_siren(
             dataset,
@@ -388,17 +900,23 @@ def setup_train( parameter_dict, cuda_device ):
     else:
         raise ValueError('Invalid ground truth mode. Valid options are \'tanh\' and \'siren\'.')
 
-        
+    if rank != 0:
+        return None
+
+    return export_results( parameter_dict, full_path, losses, model.state_dict(), training_time, cuda_device )
+
+def export_results( parameter_dict, full_path, losses, final_weights, training_time, cuda_device ):
+    network_params = parameter_dict["network"]
+
     loss_df = pd.DataFrame.from_dict(losses)
     loss_df.to_csv(osp.join(full_path, "losses.csv"), sep=";", index=None)
 
     # saving the final model.
     torch.save(
-        model.state_dict(),
+        final_weights,
         osp.join(full_path, "models", "model_final.pth")
     )
 
-    print('Generating distance field slices')
     df_options = {
         'device': cuda_device,
         'surf_thresh': 1e-3,
@@ -407,10 +925,16 @@ def setup_train( parameter_dict, cuda_device ):
         'gt_mode': parameter_dict["gt_mode"],
         'alpha': parameter_dict.get('alpha', 1),
         'hidden_layer_nodes': network_params["hidden_layer_nodes"],
-        'activation': network_params.get('activation', 'sine')
+        'activation': network_params.get('activation', 'sine'),
+        'fused_sine': network_params.get('fused_sine', False),
+        'encoding': network_params.get('encoding', None)
     }
 
-    generate_df( osp.join(full_path, "models", "model_best.pth"), parameter_dict['dataset'] + '_t.obj', osp.join(full_path, "reconstructions/"), df_options)
+    if parameter_dict.get('point_cloud_only', False):
+        print('No mesh to compare the distance field slices with, skipping them')
+    else:
+        print('Generating distance field slices')
+        generate_df( osp.join(full_path, "models", "model_best.pth"), parameter_dict['dataset'] + '_t.obj', osp.join(full_path, "reconstructions/"), df_options)
 
     if parameter_dict.get('resolution', 256) != 0:
         print('Generating mesh')
@@ -418,7 +942,9 @@ def setup_train( parameter_dict, cuda_device ):
             'w0': network_params["w0"],
             'model_path': osp.join(full_path, "models", "model_best.pth"),
             'hidden_layer_nodes': network_params["hidden_layer_nodes"],
-            'activation': network_params.get('activation', 'sine')
+            'activation': network_params.get('activation', 'sine'),
+            'fused_sine': network_params.get('fused_sine', False),
+            'encoding': network_params.get('encoding', None)
         }
 
         return training_time, generate_mc( 
@@ -432,6 +958,13 @@ def setup_train( parameter_dict, cuda_device ):
             algorithm='both' if parameter_dict['gt_mode'] == 'tanh' else 'siren'
         )
 
+def distributed_worker( rank, world_size, parameter_dict, cuda_device, resume=False ):
+    init_distributed( rank, world_size )
+    try:
+        setup_train( parameter_dict, cuda_device, rank=rank, world_size=world_size, resume=resume )
+    finally:
+        dist.destroy_process_group()
+
 if __name__ == "__main__":
     p = argparse.ArgumentParser(
         usage="python main.py path_to_experiments.json cuda_device"
@@ -444,11 +977,22 @@ if __name__ == "__main__":
     p.add_argument(
         "device", type=int, help="Cuda device"
     )
+    p.add_argument(
+        "-n", "--nprocs", type=int, default=1,
+        help="Amount of data-parallel processes (gloo backend) to split each batch across"
+    )
+    p.add_argument(
+        "-r", "--resume", action="store_true",
+        help="Continue an interrupted experiment from its last finished epoch"
+    )
     args = p.parse_args()
     parameter_dict = load_experiment_parameters(args.experiment_path)
     if not bool(parameter_dict):
         raise ValueError("JSON experiment not found")
     
-    setup_train( parameter_dict, args.device )
+    if args.nprocs > 1:
+        mp.spawn( distributed_worker, args=(args.nprocs, parameter_dict, args.device, args.resume), nprocs=args.nprocs )
+    else:
+        setup_train( parameter_dict, args.device, resume=args.resume )
 
 
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import json
+import os
+import os.path as osp
+import random
+import numpy as np
+import torch
+from torch.utils.tensorboard import SummaryWriter
+from src.dataset import PointCloud
+from src.ensemble import EnsembleSIREN
+from src.loss_functions import loss_s1, loss_s2, lazy_weights
+from src.model import SIREN
+from src.util import create_output_paths, load_experiment_parameters, check_pretrained_architecture, unsigned_sampling
+from train import export_results
+import time
+
+def train_model_ensemble(datasets, model, device, config):
+    epochs = config["epochs"]
+    epochs_til_checkpoint = config.get("epochs_to_checkpoint", 0)
+
+    log_paths = config["log_paths"]
+    optim = config["optimizer"]
+    n_models = model.n_models
+
+    model.to(device)
+
+    # Creating the summary storage folders
+    writers = []
+    for log_path in log_paths:
+        summary_path = osp.join(log_path, 'summaries')
+        if not osp.exists(summary_path):
+            os.makedirs(summary_path)
+        writers.append(SummaryWriter(summary_path))
+
+    losses = [ dict() for _ in range(n_models) ]
+    best_loss = np.full(n_models, np.inf)
+    best_weights = [ None ] * n_models
+
+    loss_fn = loss_s1
+    loss_weights = config['loss_s1_weights']
+    current_lr = config['warmup_lr']
+    for g in optim.param_groups:
+        g['lr'] = current_lr
+
+    lazy = config.get("lazy_regularization") or {}
+
+    start_ttime = time.time()
+    for epoch in range(epochs):
+        if epoch == config['warmup_epochs']:
+            current_lr = config['lr_s1']
+            for g in optim.param_groups:
+                g['lr'] = current_lr
+
+        if epoch == config['s1_epochs']:
+            print('Starting second step...')
+            loss_weights = config['loss_s2_weights']
+            loss_fn = loss_s2
+            if config.get("s2_surface_only", True):
+                # loss_s2 only looks at on surface samples
+                for dataset in datasets:
+                    dataset.sample_surface_only( config.get("s2_batch_size") or dataset.samplesOnSurface )
+
+        if epoch >= config['s1_epochs']:
+            init_lr = config['lr_s2']
+            lr =  0.5 * (np.cos(epoch/(epochs - config['s1_epochs']) * np.pi) + 1)
+            lr = lr * init_lr
+            current_lr = lr
+
+            for g in optim.param_groups:
+                g['lr'] = lr
+
+        running_loss = dict()
+        for batch, batches in enumerate(zip(*datasets)):
+            # zero the parameter gradients
+            optim.zero_grad()
+
+            # every network gets its own batch, stacked on the leading dimension
+            input_data = torch.cat([ b[0] for b in batches ]).to(device)
+            normals = torch.cat([ b[1] for b in batches ]).to(device)
+            sdf = torch.cat([ b[2] for b in batches ]).to(device)
+            weights = torch.cat([ b[3] for b in batches ]).to(device)
+
+            step_weights = loss_weights
+            if epoch < config['s1_epochs']:
+                step_weights = lazy_weights(
+                    loss_weights, epoch * datasets[0].batchesPerEpoch + batch, lazy.get('interval', 1), lazy.get('terms', ['hessian_constraint'])
+                )
+
+            loss = loss_fn(
+                model,
+                input_data,
+                {'normals': normals, 'sdf': sdf, 'weights': weights},
+                step_weights,
+                config["alpha"]
+            )
+
+            train_loss = torch.zeros(n_models, device=device)
+            for it, l in loss.items():
+                train_loss = train_loss + l
+                # accumulating statistics per loss term and model
+                values = l.detach().cpu().numpy() * np.ones(n_models)
+                if it not in running_loss:
+                    running_loss[it] = values
+                else:
+                    running_loss[it] += values
+
+            train_loss.sum().backward()
+            optim.step()
+
+            for k, writer in enumerate(writers):
+                writer.add_scalar("train_loss", train_loss[k].item(), epoch)
+
+        # accumulate statistics
+        for it, l in running_loss.items():
+            for k in range(n_models):
+                if it not in losses[k]:
+                    losses[k][it] = [0.] * epochs
+                losses[k][it][epoch] = l[k]
+                writers[k].add_scalar(it, l[k], epoch)
+
+        epoch_loss = np.zeros(n_models)
+        for k, v in running_loss.items():
+            epoch_loss += v
+        epoch_loss /= datasets[0].batchesPerEpoch
+        print(f"Epoch: {epoch} - Loss: {np.mean(epoch_loss)} (min {np.min(epoch_loss)}, max {np.max(epoch_loss)}) - Learning Rate: {current_lr:.3e}")
+
+        # Saving the best model of every network.
+        for k in np.flatnonzero(epoch_loss < best_loss):
+            best_loss[k] = epoch_loss[k]
+            best_weights[k] = model.model_state_dict(k)
+            torch.save(
+                best_weights[k],
+                osp.join(log_paths[k], "models", "model_best.pth")
+            )
+
+        # saving the models at checkpoints
+        if epoch and epochs_til_checkpoint and (not \
+           epoch % epochs_til_checkpoint):
+            print(f"Saving models for epoch {epoch}")
+            for k in range(n_models):
+                torch.save(
+                    model.model_state_dict(k),
+                    osp.join(log_paths[k], "models", f"model_{epoch}.pth")
+                )
+        else:
+            for k in range(n_models):
+                torch.save(
+                    model.model_state_dict(k),
+                    osp.join(log_paths[k], "models", "model_current.pth")
+                )
+
+    end_ttime = time.time()
+    total_training_time = end_ttime - start_ttime
+
+    return losses, best_weights, total_training_time
+
+def setup_train_ensemble( parameter_dicts, cuda_device ):
+    """
+    Trains one SIREN per experiment description in `parameter_dicts`, all at
+    the same time. Every description must share all hyperparameters but
+    'dataset' and 'experiment_name'. Returns the total training time and the
+    list of results of `export_results` for each experiment.
+    """
+    reference = { k: v for k, v in parameter_dicts[0].items() if k not in ['dataset', 'experiment_name'] }
+    for parameter_dict in parameter_dicts[1:]:
+        if { k: v for k, v in parameter_dict.items() if k not in ['dataset', 'experiment_name'] } != reference:
+            raise ValueError('Ensemble members must share every parameter except \'dataset\' and \'experiment_name\'.')
+
+    if reference['gt_mode'] != 'tanh':
+        raise ValueError('Ensemble training only supports the \'tanh\' ground truth mode.')
+    # options of train.py the stacked networks can not honour
+    unsupported = {
+        'micro_batching': reference.get('micro_batching'),
+        'early_stopping': reference.get('early_stopping'),
+        'growth': reference.get('growth'),
+        'adaptive_sampling': reference.get('adaptive_sampling'),
+        'profile': reference.get('profile'),
+        'optimizer.s2': reference['optimizer'].get('s2'),
+        'network.encoding': reference['network'].get('encoding'),
+        'network.fused_sine': reference['network'].get('fused_sine'),
+        'network.checkpoint_activations': reference['network'].get('checkpoint_activations')
+    }
+    for key, value in unsupported.items():
+        if value:
+            raise ValueError(f'Ensemble training does not support \'{key}\'.')
+
+    epochs_to_checkpoint = reference.get('epochs_to_checkpoint', 0)
+    if reference.get('checkpoint_workers', 1) > 0 and 0 < epochs_to_checkpoint < reference['num_epochs']:
+        raise ValueError('Ensemble training does not mesh checkpoints, set \'checkpoint_workers\' to 0.')
+
+    if not torch.cuda.is_available():
+        print('Utilizing CPU')
+
+    device = torch.device(cuda_device if torch.cuda.is_available() else "cpu")
+    seed = 123
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    full_paths = []
+    datasets = []
+    models = []
+    network_params = reference["network"]
+    for parameter_dict in parameter_dicts:
+        full_path = create_output_paths(
+            parameter_dict["checkpoint_path"],
+            parameter_dict["experiment_name"],
+            overwrite=False
+        )
+        full_paths.append(full_path)
+
+        # Saving the parameters to the output path
+        with open(osp.join(full_path, "params.json"), "w+") as fout:
+            json.dump(parameter_dict, fout, indent=4)
+
+        datasets.append(PointCloud(
+            meshPath= parameter_dict["dataset"],
+            batchSize= parameter_dict["batch_size"],
+            samplingPercentiles=parameter_dict["sampling_percentiles"],
+            batchesPerEpoch = parameter_dict["batches_per_epoch"],
+            unsignedDistances = unsigned_sampling( parameter_dict ),
+            pointCloudOnly = parameter_dict.get("point_cloud_only", False)
+        ))
+
+        # same initialization as a standalone run of train.py
+        torch.manual_seed(seed)
+        model = SIREN(
+            n_in_features= 3,
+            n_out_features=1,
+            hidden_layer_config=network_params["hidden_layer_nodes"],
+            w0=network_params["w0"],
+            ww=network_params.get("ww", None),
+            activation= network_params.get('activation', 'sine')
+        )
+        if network_params['pretrained_dict'] != 'None':
+            check_pretrained_architecture( network_params )
+            model.load_state_dict(torch.load(network_params['pretrained_dict'], map_location=device))
+        models.append(model)
+
+    print(models[0])
+    print(f'Training {len(models)} networks at once.')
+    model = EnsembleSIREN(models)
+
+    opt_params = reference["optimizer"]
+    if opt_params["type"] == "adam":
+        optimizer = torch.optim.Adam(
+            lr=opt_params["lr_s1"],
+            params=model.parameters()
+        )
+    else:
+        raise ValueError('Unknown optimizer')
+
+    config_dict = {
+        "epochs": reference["num_epochs"],
+        "s1_epochs": reference["s1_epochs"],
+        "batch_size": reference["batch_size"],
+        "epochs_to_checkpoint": reference["epochs_to_checkpoint"],
+        "gt_mode": reference["gt_mode"],
+        "log_paths": full_paths,
+        "optimizer": optimizer,
+        "warmup_epochs": reference.get('warmup_epochs',0),
+        "warmup_lr": reference.get('warmup_lr', 1e-4),
+        "lr_s1": opt_params["lr_s1"],
+        "lr_s2": opt_params["lr_s2"],
+        "loss_s1_weights": reference["loss_s1_weights"],
+        "loss_s2_weights": reference["loss_s2_weights"],
+        "alpha": reference["alpha"],
+        "s2_surface_only": reference.get('s2_surface_only', True),
+        "s2_batch_size": reference.get('s2_batch_size', None),
+        "lazy_regularization": reference.get('lazy_regularization', None)
+    }
+    losses, best_weights, training_time = train_model_ensemble(
+        datasets,
+        model,
+        device,
+        config_dict,
+    )
+
+    results = []
+    for k, parameter_dict in enumerate(parameter_dicts):
+        results.append(export_results(
+            parameter_dict,
+            full_paths[k],
+            losses[k],
+            model.model_state_dict(k),
+            training_time / len(parameter_dicts),
+            cuda_device
+        ))
+
+    return training_time, results
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(
+        usage="python train_ensemble.py path_to_experiment_1.json [path_to_experiment_2.json ...] -d cuda_device"
+    )
+
+    p.add_argument(
+        "experiment_paths", type=str, nargs='+',
+        help="Paths to the JSON experiment description files, one per network"
+    )
+    p.add_argument(
+        "-d", "--device", type=int, default=0, help="Cuda device"
+    )
+    args = p.parse_args()
+
+    parameter_dicts = [ load_experiment_parameters(path) for path in args.experiment_paths ]
+    if not all(bool(parameter_dict) for parameter_dict in parameter_dicts):
+        raise ValueError("JSON experiment not found")
+
+    setup_train_ensemble( parameter_dicts, args.device )